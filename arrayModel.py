@@ -0,0 +1,558 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: arrayModel.py
+
+This module contains an alternative engine for model.py, where the population
+is stored as NumPy arrays (struct-of-arrays) instead of one Person object per
+agent. Cliques are stored per layer as offset and member arrays, and the
+clique spread, random layer spread and the disease state machine run over
+whole arrays at once.
+"""
+
+import time
+import numpy as np
+
+from parameters import *
+import classes
+import modelFunctions
+import modelUtilities
+import networkCache
+
+
+S, E, Ia, Ip, Is, R, H, ICU, D = range(len(stateList))
+
+sickStates = np.zeros(len(stateList), dtype=bool)
+sickStates[[Ia, Ip, Is, H, ICU]] = True
+
+quarantineLayers = sum(layerBits[l] for l in ['W', 'US', 'VS', 'BS', 'BH', 'R'])
+symptomaticLayers = sum(layerBits[l] for l in ['BH', 'BS', 'US', 'VS', 'W', 'NH', 'R'])
+hospitalLayers = sum(layerBits[l] for l in ['HH', 'NH'])
+schoolLayers = ['BH', 'BS', 'US', 'VS']
+
+
+# ============================================================
+# POPULATION AND CLIQUES
+# ============================================================
+
+
+class Population:
+    '''All agents of a model, stored as one array per attribute.'''
+
+    def __init__(self, ages, ids=None, municipality=None):
+        n = len(ages)
+        self.ids = ids
+        self.age = np.asarray(ages, dtype=np.uint8)
+        self.decade = np.minimum(self.age - self.age % 10, 80).astype(np.uint8)
+        if municipality is None:
+            municipality = np.zeros(n, dtype=np.int16)
+        self.municipality = np.asarray(municipality, dtype=np.int16)
+        self.resident = np.ones(n, dtype=bool)
+        self.inNursing = np.zeros(n, dtype=bool)
+        self.commuter = np.zeros(n, dtype=bool)
+        self.activity = np.zeros(n, dtype=np.uint8)
+
+        self.state = np.full(n, S, dtype=np.int8)
+        self.nextState = np.full(n, -1, dtype=np.int8)
+        self.nextDay = np.full(n, -1, dtype=np.int32)
+        self.lastDay = np.full(n, -1, dtype=np.int32)
+        self.infDay = np.full(n, -1, dtype=np.int32)
+        self.relInfectivity = np.zeros(n, dtype=np.float32)
+        self.present = np.full(n, allLayers, dtype=np.uint8)
+        self.quarantine = np.zeros(n, dtype=bool)
+
+        self.calendar = classes.Calendar()
+        self.log = classes.TransmissionLog()
+
+    def __repr__(self):
+        return f'Population: {len(self)} agents.'
+
+    def __len__(self):
+        return len(self.age)
+
+    def sick(self, index=slice(None)):
+        return sickStates[self.state[index]]
+
+    def isPresent(self, layer, index=slice(None)):
+        return (self.present[index] & layerBits[layer]) > 0
+
+
+class Cliques(classes.CliqueIndex):
+    '''All cliques of one layer, as a clique index with open flags.'''
+
+    def __init__(self, name, offsets, members, owner=None):
+        super().__init__(offsets, members)
+        self.name = name
+        self.owner = self.rows() if owner is None else owner
+        self.open = np.ones(len(self), dtype=bool)
+        self.openRating = np.ones(len(self), dtype=np.float32)
+        self.layerOpen = True
+        self.cases = np.zeros(len(self), dtype=np.int32)
+        self.municipality = np.zeros(len(self), dtype=np.int16)
+        self.nodeCliques = None
+
+    def __repr__(self):
+        return f'Cliques: {self.name}, cliques: {len(self)}, persons: {len(self.members)}, open: {self.layerOpen}'
+
+    @classmethod
+    def fromLists(cls, name, cliques):
+        index = classes.CliqueIndex.fromLists(cliques)
+        return cls(name, index.offsets, index.members)
+
+
+def readPopulation(parameters):
+    '''Builds the population and the clique arrays from file, or from its cache.'''
+    network = networkCache.loadNetwork(*networkCache.cityFiles(parameters.cityName))
+
+    ids = [str(i) for i in network['ids'].tolist()]
+    population = Population(np.asarray(network['ages']), ids)
+    population.log.setMunicipality(parameters.cityName)
+    population.log.register(ids)
+
+    cliques = {}
+    for layer in layers:
+        if layer != 'R':
+            offsets, members = networkCache.layerIndex(network, layer)
+            cliques[layer] = Cliques(layer, offsets, members)
+    for layer in cliques.values():
+        layer.nodeCliques = layer.transpose(len(population))
+
+    nursing = cliques['NH'].members
+    population.inNursing[nursing[population.age[nursing] > 70]] = True
+    cliques['W'].openRating = np.random.random(len(cliques['W'])).astype(np.float32)
+
+    return population, cliques
+
+
+# ============================================================
+# SETUP
+# ============================================================
+
+
+def generateActivity(population, parameters):
+    '''Vectorized version of Person.generateActivity.'''
+    mode, var, exp = parameters.activity.values()
+    n = len(population)
+    activity = np.maximum(np.random.normal(mode, var, n), 1)
+    adults = (population.age >= 19) & (population.age < 80)
+    activity[adults] += np.power(np.random.random(adults.sum()), exp)
+    population.activity = np.minimum(activity, 100).astype(np.uint8)
+
+
+def seedState(population, parameters, index=None):
+    '''Set the state of n persons to be exposed.'''
+    if index is None:
+        index = np.arange(len(population))
+    if parameters.n:
+        n = min(parameters.n, len(index))
+    else:
+        n = int(len(index)*parameters.prevalence)
+
+    seeds = np.random.choice(index, n, replace=False)
+    population.state[seeds] = E
+    population.lastDay[seeds] = 0
+    population.infDay[seeds] = 0
+    population.log.addMany(-1, seeds, 'init', 0, population.municipality[seeds])
+    schedule(population, seeds, 1 + np.random.poisson(SARS_CoV_2.duration['I-E'], n))
+
+
+def setStrategy(cliques, population, parameters):
+    '''Array version of modelFunctions.setStrategy.'''
+    cliques['W'].layerOpen = bool(parameters.inputVector['W'])
+    for layer in schoolLayers:
+        cliques[layer].layerOpen = bool(parameters.strategy['S'])
+
+    age = parameters.strategy['S']
+    pupils = np.unique(np.concatenate([cliques[layer].members for layer in schoolLayers]))
+    closed = pupils[population.age[pupils] > age]
+    reopened = closed[population.age[closed] > 19]
+    bits = {'VS': age > 15, 'US': age > 12, 'BS': age > 5, 'BH': age > 0}
+    for layer, reopen in bits.items():
+        population.present[closed] &= ~np.uint8(layerBits[layer])
+        if reopen:
+            population.present[reopened] |= np.uint8(layerBits[layer])
+
+    cliques['W'].open = cliques['W'].openRating < float(parameters.inputVector['W'])
+
+
+def modelSetup(parameters):
+    population, cliques = readPopulation(parameters)
+    parameters.transmissionLog = population.log
+    generateActivity(population, parameters)
+    seedState(population, parameters)
+
+    parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
+    parameters.p = modelFunctions.setInfectionProbabilities(
+        parameters.inputVector, SARS_CoV_2.probability, parameters)
+    setStrategy(cliques, population, parameters)
+    countCases(population, cliques)
+
+    return population, cliques, parameters
+
+
+# ============================================================
+# CASE COUNTING
+# ============================================================
+
+
+def contributions(population, nodes):
+    '''Bitmask of the layers each node is sick and present in.'''
+    return np.where(population.sick(nodes), population.present[nodes], 0).astype(np.uint8)
+
+
+def countCases(population, cliques):
+    '''Recounts the sick and present members of every clique.'''
+    for layer in cliques.values():
+        counted = (contributions(population, layer.members) & layerBits[layer.name]) > 0
+        layer.cases = np.bincount(layer.owner[counted], minlength=len(layer)).astype(np.int32)
+
+
+def updateCases(population, cliques, nodes, before):
+    '''Updates the case counts of the cliques of nodes, given the bitmask
+    from contributions() before their state or presence changed.'''
+    after = contributions(population, nodes)
+    changed = before ^ after
+    for layer in cliques.values():
+        bit = layerBits[layer.name]
+        moved = np.flatnonzero(changed & bit)
+        if len(moved):
+            delta = np.where(after[moved] & bit, 1, -1)
+            rows, position = layer.nodeCliques.gather(nodes[moved])
+            np.add.at(layer.cases, rows, delta[position])
+
+
+# ============================================================
+# SPREAD
+# ============================================================
+
+
+def infect(population, nodes, ancestors, layer, day, where=None):
+    '''Array version of Person.infectNode. where is the municipality of 
+    each infection, by default that of the node.'''
+    population.state[nodes] = E
+    population.lastDay[nodes] = day
+    population.infDay[nodes] = day
+    if where is None:
+        where = population.municipality[nodes]
+    population.log.addMany(ancestors, nodes, layer, day, where)
+    schedule(population, nodes, day + 1 + np.random.poisson(SARS_CoV_2.duration['I-E'], len(nodes)))
+
+
+def cliqueDay(population, cliques, day):
+    '''Runs infections over a day for every open clique of a layer.
+
+    Every susceptible member of a clique is infected with the same
+    probability as in model.cliqueDay, and the ancestor is drawn among the
+    sick and present members, weighted by their relative infectivity.'''
+    layer = cliques.name
+    active = np.flatnonzero(cliques.open & (cliques.cases > 0))
+    if not len(active):
+        return np.empty(0, dtype=np.int32)
+
+    nodes, cliqueIndex = cliques.gather(active)
+    sick = population.sick(nodes) & population.isPresent(layer, nodes)
+    relInfectivity = np.where(sick, population.relInfectivity[nodes], 0).astype(np.float64)
+
+    exponent = np.bincount(cliqueIndex, weights=relInfectivity, minlength=len(active))
+    effP = 1 - np.power(1 - SARS_CoV_2.probability['inf'][layer], exponent)
+
+    susceptible = population.state[nodes] == S
+    young = np.flatnonzero(susceptible & (population.age[nodes] <= 10))
+    susceptible[young] = np.random.random(len(young)) < 0.3
+    hit = np.flatnonzero(susceptible & (np.random.random(len(nodes)) < effP[cliqueIndex]))
+    if not len(hit):
+        return np.empty(0, dtype=np.int32)
+
+    newlyInfected, first = np.unique(nodes[hit], return_index=True)
+    hit = hit[first]
+
+    cumulative = np.cumsum(relInfectivity)
+    start = np.searchsorted(cliqueIndex, cliqueIndex[hit])
+    base = np.where(start > 0, cumulative[start-1], 0)
+    total = exponent[cliqueIndex[hit]]
+    draw = base + np.random.random(len(hit)) * total
+    ancestors = nodes[np.searchsorted(cumulative, draw, side='right').clip(max=len(nodes)-1)]
+
+    infect(population, newlyInfected, ancestors, layer, day, cliques.municipality[active[cliqueIndex[hit]]])
+    return newlyInfected
+
+
+def randomLayerKernel(activity, commuter, relInfectivity, sick, susceptible, groups, groupSizes, effP):
+    '''Batched random layer spread for one or more groups of agents.
+
+    Equivalent to the loop in model.randomLayerSpread: every sick agent
+    draws an activity, which weighted with its infectivity gives the
+    prevalence of its group, and every susceptible agent draws an activity
+    and an infection trial against that prevalence. Returns the indices of
+    the newly infected agents and their ancestors.'''
+    sickNodes = np.flatnonzero(sick)
+    act = np.minimum(np.random.randint(0, activity[sickNodes].astype(np.int64)+1), groupSizes[groups[sickNodes]])
+    act = np.where(commuter[sickNodes], act//2, act)
+    prevalence = np.bincount(groups[sickNodes], weights=act*relInfectivity[sickNodes],
+                             minlength=len(groupSizes)) / np.maximum(groupSizes, 1)
+
+    candidates = np.flatnonzero(susceptible & (prevalence[groups] > 0))
+    act = np.minimum(np.random.randint(0, activity[candidates].astype(np.int64)+1), groupSizes[groups[candidates]])
+    act = np.where(commuter[candidates], act//2, act)
+    p = 1 - np.power(1 - effP*prevalence[groups[candidates]], act)
+    infected = candidates[np.random.random(len(candidates)) < p]
+
+    order = np.argsort(groups[sickNodes], kind='stable')
+    sortedSick = sickNodes[order]
+    groupStart = np.searchsorted(groups[sortedSick], groups[infected], side='left')
+    groupCount = np.searchsorted(groups[sortedSick], groups[infected], side='right') - groupStart
+    ancestors = sortedSick[groupStart + (np.random.random(len(infected))*groupCount).astype(np.int64)]
+
+    return infected, ancestors
+
+
+def randomLayerSpread(population, parameters, day):
+    '''Random layer spread within each municipality of the population,
+    among its residents.'''
+    present = population.isPresent('R') & population.resident
+    groups = population.municipality
+    groupSizes = np.bincount(groups[population.resident], minlength=groups.max()+1).astype(np.int64)
+    infected, ancestors = randomLayerKernel(
+        population.activity, population.commuter, population.relInfectivity,
+        population.sick() & present, (population.state == S) & present,
+        groups, groupSizes, parameters.p['inf']['dynR'])
+    infect(population, infected, ancestors, 'R', day)
+    return len(infected)
+
+
+# ============================================================
+# STATE MACHINE
+# ============================================================
+
+
+def decadeTable(probabilities):
+    table = np.zeros(81)
+    for decade, p in probabilities.items():
+        table[decade] = p
+    return table
+
+
+def schedule(population, nodes, days):
+    '''Sets the day of the next transition, and adds it to the calendar.'''
+    population.nextDay[nodes] = days
+    population.calendar.pushMany(nodes, population.nextDay[nodes])
+
+
+def scheduleNext(population, nodes, nextState, duration, day):
+    population.nextState[nodes] = nextState
+    schedule(population, nodes, day + 1 + np.random.poisson(SARS_CoV_2.duration[duration], len(nodes)))
+
+
+def branch(population, nodes, probabilities):
+    '''Split nodes in two, the first with the given probability by decade.'''
+    chance = np.random.random(len(nodes)) < decadeTable(probabilities)[population.decade[nodes]]
+    return nodes[chance], nodes[~chance]
+
+
+def recover(population, nodes, day):
+    population.state[nodes] = R
+    population.lastDay[nodes] = day
+    population.relInfectivity[nodes] = 0.0
+    population.present[nodes] = allLayers
+
+
+def die(population, nodes, day):
+    population.state[nodes] = D
+    population.lastDay[nodes] = day
+    population.nextDay[nodes] = -1
+    population.nextState[nodes] = -1
+    population.present[nodes] = 0
+
+
+def incubate(population, nodes, day):
+    presymp, asymp = branch(population, nodes, SARS_CoV_2.probability['S'])
+
+    population.state[asymp] = Ia
+    scheduleNext(population, asymp, R, 'AS-R', day)
+    population.relInfectivity[asymp] = 0.3
+
+    population.state[presymp] = Ip
+    scheduleNext(population, presymp, Is, 'PS-I', day)
+    population.relInfectivity[presymp] = np.where(population.age[presymp] < 13, 0.3, 3.0)
+
+
+def activateSymptoms(population, nodes, day):
+    population.state[nodes] = Is
+    population.lastDay[nodes] = day
+    population.present[nodes] &= ~np.uint8(symptomaticLayers)
+
+    nursing = population.inNursing[nodes]
+    dies, survives = branch(population, nodes[nursing], SARS_CoV_2.probability['NHDage'])
+    scheduleNext(population, dies, D, 'I-D', day)
+    scheduleNext(population, survives, R, 'I-R', day)
+
+    hospitalised, home = branch(population, nodes[~nursing], SARS_CoV_2.probability['HRage'])
+    scheduleNext(population, hospitalised, H, 'I-H', day)
+    scheduleNext(population, home, R, 'I-R', day)
+
+    population.relInfectivity[nodes] = np.where(population.age[nodes] < 13, 0.3, 1.0)
+
+
+def hospitalize(population, nodes, day):
+    population.state[nodes] = H
+    population.lastDay[nodes] = day
+    population.present[nodes] &= ~np.uint8(hospitalLayers)
+
+    icu, ward = branch(population, nodes, SARS_CoV_2.probability['ICUage'])
+    scheduleNext(population, icu, ICU, 'H-ICU', day)
+    dies, survives = branch(population, ward, SARS_CoV_2.probability['DRage'])
+    scheduleNext(population, dies, D, 'H-D', day)
+    scheduleNext(population, survives, R, 'H-R', day)
+
+
+def enterICU(population, nodes, day):
+    population.state[nodes] = ICU
+    population.lastDay[nodes] = day
+
+    dies, survives = branch(population, nodes, SARS_CoV_2.probability['DRage'])
+    scheduleNext(population, dies, D, 'ICU-D', day)
+    scheduleNext(population, survives, R, 'ICU-R', day)
+
+
+def sampleTrajectories(decade, inNursing, day):
+    '''Samples the whole course of disease of nodes exposed on the given
+    days, with the same branching and durations as the Person state 
+    machine. Returns two arrays of shape (n, 5), with the states entered
+    and the day each is entered, padded with -1.'''
+    n = len(decade)
+    probability, duration = SARS_CoV_2.probability, SARS_CoV_2.duration
+    states = np.full((n, 5), -1, dtype=np.int8)
+    days = np.full((n, 5), -1, dtype=np.int32)
+
+    def chance(key, nodes):
+        return np.random.random(len(nodes)) < decadeTable(probability[key])[decade[nodes]]
+
+    def enter(nodes, step, state, fromDay, key):
+        states[nodes, step] = state
+        days[nodes, step] = fromDay + 1 + np.random.poisson(duration[key], len(nodes))
+
+    nodes = np.arange(n)
+    symptomatic = chance('S', nodes)
+    enter(nodes[~symptomatic], 0, Ia, day[~symptomatic], 'I-E')
+    enter(nodes[symptomatic], 0, Ip, day[symptomatic], 'I-E')
+
+    asymp = nodes[~symptomatic]
+    enter(asymp, 1, R, days[asymp, 0], 'AS-R')
+
+    presymp = nodes[symptomatic]
+    enter(presymp, 1, Is, days[presymp, 0], 'PS-I')
+
+    nursing = presymp[inNursing[presymp]]
+    dies = chance('NHDage', nursing)
+    enter(nursing[dies], 2, D, days[nursing[dies], 1], 'I-D')
+    enter(nursing[~dies], 2, R, days[nursing[~dies], 1], 'I-R')
+
+    home = presymp[~inNursing[presymp]]
+    hospitalised = chance('HRage', home)
+    enter(home[~hospitalised], 2, R, days[home[~hospitalised], 1], 'I-R')
+    ward = home[hospitalised]
+    enter(ward, 2, H, days[ward, 1], 'I-H')
+
+    icu = chance('ICUage', ward)
+    dies = ~icu & chance('DRage', ward)
+    enter(ward[dies], 3, D, days[ward[dies], 2], 'H-D')
+    enter(ward[~icu & ~dies], 3, R, days[ward[~icu & ~dies], 2], 'H-R')
+    icu = ward[icu]
+    enter(icu, 3, ICU, days[icu, 2], 'H-ICU')
+
+    dies = chance('DRage', icu)
+    enter(icu[dies], 4, D, days[icu[dies], 3], 'ICU-D')
+    enter(icu[~dies], 4, R, days[icu[~dies], 3], 'ICU-R')
+
+    return states, days
+
+
+def progressStates(population, cliques, day, nodes=None):
+    '''Moves every agent with a transition today to its next state.'''
+    if nodes is None:
+        events = population.calendar.pop(day)
+        nodes = np.concatenate(events) if events else np.empty(0, dtype=np.int64)
+        nodes = nodes[population.nextDay[nodes] == day]
+    state, nextState = population.state[nodes], population.nextState[nodes]
+    before = contributions(population, nodes)
+
+    incubate(population, nodes[state == E], day)
+    activateSymptoms(population, nodes[state == Ip], day)
+
+    transition = np.isin(state, [Ia, Is, H, ICU])
+    recover(population, nodes[transition & (nextState == R)], day)
+    die(population, nodes[transition & (nextState == D)], day)
+    hospitalize(population, nodes[transition & (nextState == H)], day)
+    enterICU(population, nodes[transition & (nextState == ICU)], day)
+
+    updateCases(population, cliques, nodes, before)
+
+
+# ============================================================
+# RUNS
+# ============================================================
+
+
+def countStates(population, groups=None, nGroups=1):
+    '''Count the states of all agents, optionally per group.'''
+    if groups is None:
+        return dict(zip(stateList, np.bincount(population.state, minlength=len(stateList)).tolist()))
+    counts = np.bincount(groups.astype(np.int64)*len(stateList) + population.state,
+                         minlength=nGroups*len(stateList)).reshape(nGroups, len(stateList))
+    return [dict(zip(stateList, row)) for row in counts.tolist()]
+
+
+def systemDay(population, cliques, parameters, day):
+    '''Daily pulse of the system.'''
+    infectedList = {}
+    dailyInfected = 0
+    for layer in cliques:
+        infectedList[layer] = 0
+        if cliques[layer].layerOpen:
+            infs = cliqueDay(population, cliques[layer], day)
+            infectedList[layer] = len(infs)
+            dailyInfected += len(infs)
+
+    infectedList['R'] = randomLayerSpread(population, parameters, day)
+    dailyInfected += infectedList['R']
+
+    progressStates(population, cliques, day)
+    cont = bool(population.calendar)
+
+    return cont, infectedList, dailyInfected
+
+
+def timedRun(population, cliques, parameters, day=0):
+    '''Run of the model for a given number of days'''
+    stateLog, infectedLog, infectedLogByLayer = [], [], []
+    timeUsed = []
+
+    cont = 1
+    endDay = day + parameters.runDays
+
+    while cont and (day < endDay):
+        day += 1
+        dayTime = time.time()
+
+        cont, linfs, dailyInfected = systemDay(population, cliques, parameters, day)
+
+        stateLog.append(countStates(population))
+        infectedLog.append(dailyInfected)
+        infectedLogByLayer.append(linfs)
+
+        timeUsed.append(time.time() - dayTime)
+
+        if parameters.printResults:
+            modelUtilities.printProgress(day, parameters.runDays, timeUsed, bar_length=50)
+
+    return stateLog, infectedLog, infectedLogByLayer
+
+
+def runModel(parameters):
+    parameters.validate('arrays')
+    population, cliques, parameters = modelSetup(parameters)
+    stateLog, infLog, infLogByLayer = timedRun(population, cliques, parameters)
+    if parameters.saveResults:
+        modelUtilities.saveModelResults(stateLog, infLogByLayer, parameters)
+
+    return stateLog, infLog, infLogByLayer
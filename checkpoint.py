@@ -0,0 +1,270 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: checkpoint.py
+
+Checkpoints for long runs of the national model. Every
+parameters.checkpointDays days, fullRun and timedRun pack the state of all
+agents, the calendars, clique frontiers, daily R accumulators and nodes
+waiting to be sampled, the random generators, the state log and the
+transmission log into NumPy arrays, and write them to
+f'{parameters.checkpoint}.checkpoint.npz' on a background thread. A rerun
+with the same parameters resumes from the latest checkpoint. The random
+state before the setup is stored as well, so the rerun builds the same
+network before the checkpoint is loaded.
+"""
+
+import operator
+import os
+import random
+import threading
+import numpy as np
+
+from parameters import *
+import classes
+
+
+def checkpointFile(parameters):
+    return f'{parameters.checkpoint}.checkpoint.npz'
+
+
+def removeCheckpoint(parameters):
+    '''Deletes the checkpoint of a finished run.'''
+    if parameters.checkpoint and os.path.isfile(checkpointFile(parameters)):
+        os.remove(checkpointFile(parameters))
+
+
+def getRandomState(prefix=''):
+    '''State of both random generators, as arrays.'''
+    version, state, gauss = random.getstate()
+    name, keys, pos, hasGauss, cachedGaussian = np.random.get_state()
+    return {f'{prefix}random': np.array(state, dtype=np.uint64),
+            f'{prefix}randomGauss': np.array([np.nan if gauss is None else gauss]),
+            f'{prefix}numpy': keys,
+            f'{prefix}numpyPos': np.array([pos, hasGauss]),
+            f'{prefix}numpyGauss': np.array([cachedGaussian])}
+
+
+def setRandomState(data, prefix=''):
+    gauss = float(data[f'{prefix}randomGauss'][0])
+    random.setstate((3, tuple(data[f'{prefix}random'].tolist()), None if np.isnan(gauss) else gauss))
+    pos, hasGauss = data[f'{prefix}numpyPos'].tolist()
+    np.random.set_state(('MT19937', data[f'{prefix}numpy'], pos, hasGauss,
+                         float(data[f'{prefix}numpyGauss'][0])))
+
+
+def startSetup(parameters):
+    '''Called before the setup of the national model. If there is a
+    checkpoint, the random state of its setup is restored, so the same
+    network is built. The state is kept for the next checkpoints.'''
+    filename = checkpointFile(parameters)
+    if os.path.isfile(filename):
+        with np.load(filename) as data:
+            if 'setup_random' in data:
+                setRandomState(data, 'setup_')
+    parameters.setupRandomState = getRandomState('setup_')
+
+
+class Checkpointer:
+    '''Writes and loads the checkpoints of one run. Does nothing if
+    parameters.checkpoint is empty.'''
+
+    def __init__(self, municipalities, parameters):
+        self.municipalities = municipalities
+        self.parameters = parameters
+        self.enabled = bool(parameters.checkpoint)
+        self.filename = checkpointFile(parameters) if self.enabled else ''
+        self.thread = None
+        self.nodes = [m.nodes() for m in municipalities] if self.enabled else []
+
+    def __repr__(self):
+        return f'Checkpointer: {self.filename}, every {self.parameters.checkpointDays} days.'
+
+    def save(self, stateLog, day):
+        '''Writes a checkpoint at the end of every checkpointDays day. The
+        arrays are collected here, and written on a background thread.'''
+        if not self.enabled or not self.parameters.checkpointDays or day % self.parameters.checkpointDays:
+            return
+        self.wait()
+        arrays = self.encode(stateLog, day)
+        self.thread = threading.Thread(target=self.write, args=(arrays,))
+        self.thread.start()
+
+    def wait(self):
+        '''Waits for the checkpoint being written.'''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def write(self, arrays):
+        temporary = f'{self.filename}.tmp'
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temporary, self.filename)
+
+    def resume(self, stateLog, day):
+        '''Loads the latest checkpoint, if any. Returns the state log and day
+        to continue from.'''
+        if not self.enabled or not os.path.isfile(self.filename):
+            return stateLog, day
+        with np.load(self.filename) as data:
+            return self.decode(data)
+
+    def encode(self, stateLog, day):
+        names = [m.name for m in self.municipalities]
+        codes = dict(stateCodes, **{'': -1})
+        nodes = [node for nodes in self.nodes for node in nodes]
+        columns = dict(zip(classes.Person.mutable, zip(*map(operator.attrgetter(*classes.Person.mutable), nodes))))
+        trajectories = [t or [] for t in columns['trajectory']]
+
+        arrays = {
+            'day': np.array([day]),
+            'names': np.array(names),
+            'nodeOffsets': np.cumsum([0] + [len(nodes) for nodes in self.nodes]),
+            'state': np.array([codes[s] for s in columns['state']], dtype=np.int8),
+            'sick': np.array(columns['sick'], dtype=bool),
+            'present': np.array(columns['present'], dtype=np.uint8),
+            'quarantine': np.array(columns['quarantine'], dtype=bool),
+            'virus': np.array([v is not None for v in columns['virus']]),
+            'relInfectivity': np.array(columns['relInfectivity'], dtype=np.float32),
+            'nextState': np.array([codes[s] for s in columns['nextState']], dtype=np.int8),
+            'nextDay': np.array(columns['nextDay'], dtype=np.int32),
+            'lastDay': np.array(columns['lastDay'], dtype=np.int32),
+            'infDay': np.array(columns['infDay'], dtype=np.int32),
+            'diedFrom': np.array([codes[s] for s in columns['diedFrom']], dtype=np.int8),
+            'offspring': np.array(columns['offspring'], dtype=np.int32),
+            'uid': np.array(columns['uid'], dtype=np.int32),
+            'trajectoryOffsets': np.cumsum([0] + [len(t) for t in trajectories]),
+            'trajectoryDay': np.array([d for t in trajectories for d, s in t], dtype=np.int32),
+            'trajectoryState': np.array([codes[s] for t in trajectories for d, s in t], dtype=np.int8),
+            'layerOpen': np.array([[layer.open for layer in m.layers.values()] for m in self.municipalities]),
+            'dormant': np.array([m.dormant for m in self.municipalities]),
+            'dailyRTotal': np.array([m.dailyR.total for m in self.municipalities]),
+            'dailyRCount': np.array([m.dailyR.count for m in self.municipalities]),
+            'stateLog': np.array([[[row[s] for s in stateList] for row in stateLog[name]] for name in names],
+                                 dtype=np.int32).reshape(len(names), -1, len(stateList)),
+        }
+
+        pending = {node: k for k, node in enumerate(self.parameters.exposed)}
+        exposed = [0]*len(pending)
+        for i, node in enumerate(nodes):
+            if node in pending:
+                exposed[pending[node]] = i
+        arrays['exposed'] = np.array(exposed, dtype=np.int64)
+
+        calendar = []
+        for m, municipality in enumerate(self.municipalities):
+            visitors = {id(node): len(municipality.attrs) + k for k, node in enumerate(municipality.visitors)}
+            for d, events in municipality.calendar.buckets.items():
+                calendar.extend((m, d, visitors.get(id(node), node.index)) for node in events)
+        arrays['calendar'] = np.array(calendar, dtype=np.int32).reshape(-1, 3)
+
+        for name in layers:
+            if name == 'R':
+                continue
+            cases, open, frontier = [], [], []
+            for m, municipality in enumerate(self.municipalities):
+                layer = municipality.layers[name]
+                rank = {clique: k for k, clique in enumerate(layer.frontier)}
+                positions = [0]*len(rank)
+                for i, clique in enumerate(layer.cliques):
+                    cases.append(clique.cases)
+                    open.append(clique.open)
+                    if clique in rank:
+                        positions[rank[clique]] = i
+                frontier.extend((m, i) for i in positions)
+            arrays[f'cases_{name}'] = np.array(cases, dtype=np.int32)
+            arrays[f'open_{name}'] = np.array(open, dtype=bool)
+            arrays[f'frontier_{name}'] = np.array(frontier, dtype=np.int32).reshape(-1, 2)
+
+        log = self.parameters.transmissionLog
+        arrays.update({f'log_{column}': log[column].copy() for column in log.columns})
+        arrays.update({'log_ids': np.array(log.ids, dtype=str),
+                       'log_homes': np.array(log.homes, dtype=np.int16),
+                       'log_municipalities': np.array(log.municipalities, dtype=str),
+                       'log_municipality': np.array([log.municipality])})
+
+        arrays.update(getRandomState())
+        if self.parameters.setupRandomState is not None:
+            arrays.update(self.parameters.setupRandomState)
+        return arrays
+
+    def decode(self, data):
+        names = [m.name for m in self.municipalities]
+        if data['names'].tolist() != names:
+            raise ValueError(f'{self.filename} is a checkpoint of other municipalities.')
+
+        states = stateList + ['']
+        virus = SARS_CoV_2()
+        columns = {
+            'state': [states[s] for s in data['state'].tolist()],
+            'sick': data['sick'].tolist(),
+            'present': data['present'].tolist(),
+            'quarantine': data['quarantine'].tolist(),
+            'virus': [virus if v else None for v in data['virus'].tolist()],
+            'relInfectivity': data['relInfectivity'].tolist(),
+            'nextState': [states[s] for s in data['nextState'].tolist()],
+            'nextDay': data['nextDay'].tolist(),
+            'lastDay': data['lastDay'].tolist(),
+            'infDay': data['infDay'].tolist(),
+            'diedFrom': [states[s] for s in data['diedFrom'].tolist()],
+            'offspring': data['offspring'].tolist(),
+            'uid': data['uid'].tolist(),
+        }
+        offsets = data['trajectoryOffsets'].tolist()
+        trajectories = list(zip(data['trajectoryDay'].tolist(), [states[s] for s in data['trajectoryState'].tolist()]))
+        columns['trajectory'] = [trajectories[i:j] or None for i, j in zip(offsets[:-1], offsets[1:])]
+
+        nodes = [node for nodes in self.nodes for node in nodes]
+        if len(nodes) != len(columns['state']):
+            raise ValueError(f'{self.filename} does not match the network of this run.')
+        for node, values in zip(nodes, zip(*(columns[name] for name in classes.Person.mutable))):
+            for name, value in zip(classes.Person.mutable, values):
+                setattr(node, name, value)
+            node.updateResidentLayer()
+        self.parameters.exposed = [nodes[i] for i in data['exposed'].tolist()]
+
+        for m, municipality in enumerate(self.municipalities):
+            municipality.calendar.buckets = {}
+            municipality.dormant = bool(data['dormant'][m])
+            municipality.dailyR.total[:] = data['dailyRTotal'][m]
+            municipality.dailyR.count[:] = data['dailyRCount'][m]
+            for layer, open in zip(municipality.layers.values(), data['layerOpen'][m].tolist()):
+                layer.open = open
+            start = data['nodeOffsets'][m]
+            residents = data['state'][start:start+len(municipality.attrs)]
+            municipality.counts.update(zip(stateList, np.bincount(residents, minlength=len(stateList)).tolist()))
+        for m, d, i in data['calendar'].tolist():
+            municipality = self.municipalities[m]
+            municipality.calendar.push(self.nodes[m][i], d)
+
+        for name in layers:
+            if name == 'R':
+                continue
+            cases, open = data[f'cases_{name}'].tolist(), data[f'open_{name}'].tolist()
+            i = 0
+            for municipality in self.municipalities:
+                layer = municipality.layers[name]
+                for clique in layer.cliques:
+                    clique.cases, clique.open = cases[i], open[i]
+                    i += 1
+                layer.frontier.clear()
+            for m, i in data[f'frontier_{name}'].tolist():
+                layer = self.municipalities[m].layers[name]
+                layer.frontier[layer.cliques[i]] = None
+
+        log = self.parameters.transmissionLog
+        log.size = 0
+        log.reserve(len(data['log_day']))
+        for column in log.columns:
+            log.data[column][:len(data['log_day'])] = data[f'log_{column}']
+        log.size = len(data['log_day'])
+        log.ids = data['log_ids'].tolist()
+        log.homes = data['log_homes'].tolist()
+        log.municipalities = data['log_municipalities'].tolist()
+        log.municipality = int(data['log_municipality'][0])
+
+        setRandomState(data)
+        stateLog = {name: [dict(zip(stateList, row)) for row in rows]
+                    for name, rows in zip(names, data['stateLog'].tolist())}
+        return stateLog, int(data['day'][0])
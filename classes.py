@@ -7,28 +7,52 @@ This module contains defines the classes used in model.py.
 Includes the Person and Commuter classes, Clique, Layer and Municipality. 
 """
 
+import operator
 import random
 import numpy as np
 import modelFunctions
 from parameters import *
 
 class Person:
+    '''Person class. Attributes are slotted to keep the memory use per agent 
+    low, and presence in the layers is stored as a bitmask of layerBits.'''
+    
+    __slots__ = ('id_number', 'age', 'decade', 'ageGroup', 'inNursing', 'index', 'uid',
+                 'cliques', 'calendar', 'counts', 'residentLayer', 'trajectory', 'activity', 'state', 
+                 'sick', 'present', 'quarantine', 'virus', 'relInfectivity', 'nextState', 
+                 'nextDay', 'lastDay', 'infDay', 'diedFrom', 'offspring')
+
+    # attributes that change during a run, as saved by Municipality.snapshot
+    mutable = ('state', 'sick', 'present', 'quarantine', 'virus', 'relInfectivity', 
+               'nextState', 'nextDay', 'lastDay', 'infDay', 'diedFrom', 'offspring', 'uid', 'trajectory')
 
     def __init__(self, id_number, age, **kwargs):
         self.id_number = id_number
         self.age = age
         self.decade = min(age-age%10, 80)
         self.inNursing = False
+        self.index = kwargs.get('index', -1)
+        self.cliques = []
+        self.calendar = None
+        self.counts = None
+        self.residentLayer = None
+        self.trajectory = None
         
         self.state = 'S'
         self.sick = False
+        self.quarantine = False
+        self.virus = None
+        self.relInfectivity = 0.0
+        self.nextState = ''
+        self.nextDay = -1
+        self.lastDay = -1
+        self.infDay = -1
+        self.diedFrom = ''
+        self.offspring = 0
         
-        self.infAnc = -1
-        self.infDesc = []
+        self.uid = -1
 
-        self.present = {}
-        for layer in layers:
-            self.present[layer] = True
+        self.present = allLayers
 
         if age < 19:
             self.ageGroup = 'B'
@@ -53,16 +77,60 @@ class Person:
             self.activity = min(int(max(np.random.normal(mode, var), 1)),100)
 
     def infectNode(self, anc, layer, day, parameters):
-        self.state = 'E'
+        self.setState('E')
         self.lastDay = day
-        self.infAnc = [anc, layer, day]
-        anc.infDesc.append([self, layer, day])
+        parameters.transmissionLog.add(anc, self, layer, day)
+        anc.offspring += 1
         self.virus = anc.virus
         self.infDay = day
         
-        self.nextDay = day+1+np.random.poisson(self.virus.duration['I-E'])
+        self.scheduleIncubation(day, parameters)
 
     
+    def setState(self, state):
+        '''Changes state, and updates the state counter of the municipality.'''
+        if self.counts is not None:
+            self.counts[self.state] -= 1
+            self.counts[state] += 1
+        self.state = state
+        self.updateResidentLayer()
+
+    def setInfectivity(self, relInfectivity):
+        self.relInfectivity = relInfectivity
+        self.updateResidentLayer()
+
+    def updateResidentLayer(self):
+        '''Updates the arrays of the random layer the node is a resident of,
+        if the layer has them, see Layer.attach.'''
+        layer = self.residentLayer
+        if layer is not None:
+            present = self.present & layerBits['R'] != 0
+            layer.sick[self.index] = self.sick and present
+            layer.susceptible[self.index] = self.state == 'S' and present
+            layer.relInfectivity[self.index] = self.relInfectivity
+
+    def schedule(self, day):
+        '''Sets the day of the next state transition, and adds it to the calendar.'''
+        self.nextDay = day
+        if self.calendar is not None:
+            self.calendar.push(self, day)
+
+    def scheduleIncubation(self, day, parameters):
+        '''Schedules the end of the incubation period. With parameters.presample, 
+        the node is instead queued to have its whole course of disease 
+        sampled with the other nodes exposed that day.'''
+        if parameters.presample:
+            parameters.exposed.append(self)
+        else:
+            self.schedule(day+1+np.random.poisson(self.virus.duration['I-E']))
+
+    def setTrajectory(self, trajectory):
+        '''Sets a pre-sampled list of (day, state) transitions, and schedules 
+        the first one.'''
+        self.trajectory = trajectory[::-1]
+        self.nextState = self.trajectory[-1][1]
+        self.schedule(self.trajectory[-1][0])
+
     '''Testing and quarantine functions'''
     def test(self, fpr=0, fnr=0):
         if self.state in {'Ip', 'Ia'}:
@@ -73,13 +141,11 @@ class Person:
             return random.random() < fpr
     
     def quarantineNode(self):
-        for layer in {'W', 'US', 'VS', 'BS', 'BH', 'R'}:
-            self.present[layer] = False 
+        self.setPresent(['W', 'US', 'VS', 'BS', 'BH', 'R'], False)
         self.quarantine = True
     
     def dequarantineNode(self):
-        for layer in {'W', 'US', 'VS', 'BS', 'BH', 'R'}:
-            self.present[layer] = True 
+        self.setPresent(['W', 'US', 'VS', 'BS', 'BH', 'R'], True)
         self.quarantine = False
 
     def individualTestAndQuarantine(self, layers, day, parameters):
@@ -90,22 +156,36 @@ class Person:
                         clique.quarantineClique()
 
 
-    '''State change functions'''
-    def recover(self, params, day):
-        self.state = 'R'
-        self.lastDay = day
-        self.sick = False
-        
-        for clique in self.cliques:
-            clique.cases -= 1
+    '''Clique case counting functions'''
+    def setSick(self, sick):
+        '''Sets the sick flag, and updates the case count of every clique 
+        the node is present in.'''
+        if sick != self.sick:
+            self.sick = sick
+            for clique in self.cliques:
+                if self.present & layerBits[clique.name]:
+                    clique.addCases(1 if sick else -1)
+            self.updateResidentLayer()
 
-        for layer in self.present:
-            self.present[layer] = True
-            
-        if random.random() < params['NI']:
-            self.nextState = 'S'
+    def isPresent(self, layer):
+        return self.present & layerBits[layer] != 0
+
+    def setPresent(self, layers, present):
+        '''Sets the presence in the given layers, and updates the case count
+        of the cliques in these layers if the node is sick.'''
+        for layer in layers:
+            if self.isPresent(layer) != present:
+                self.present ^= layerBits[layer]
+                if self.sick:
+                    for clique in self.cliques:
+                        if clique.name == layer:
+                            clique.addCases(1 if present else -1)
+                if layer == 'R':
+                    self.updateResidentLayer()
 
     def stateFunction(self):
+        if self.trajectory:
+            return self.followTrajectory
         funcs = {
             'E': self.incubate,
             'Ia': self.asymptomatic,
@@ -117,6 +197,16 @@ class Person:
         return funcs[self.state]
     
     '''Daily state progress check and branching functions'''
+    def followTrajectory(self, p, day):
+        if day == self.nextDay:
+            nextDay, state = self.trajectory.pop()
+            self.enterState(state, p, day)
+            if self.trajectory:
+                self.nextState = self.trajectory[-1][1]
+                self.schedule(self.trajectory[-1][0])
+            else:
+                self.trajectory = None
+
     def incubate(self, p, day):
         if day == self.nextDay:
             if random.random() < p['S'][self.decade]:
@@ -159,103 +249,107 @@ class Person:
           
                 
     '''State change functions'''
+    def enterState(self, state, p, day):
+        '''Applies the effects of entering a state, without drawing the next.'''
+        if state == 'R':
+            self.recover(p, day)
+        elif state == 'D':
+            self.die(p, day)
+        else:
+            self.setState(state)
+            if state in ['Ia', 'Ip']:
+                self.setSick(True)
+            else:
+                self.lastDay = day
+            
+            if state == 'Ia':
+                self.setInfectivity(0.3)
+            elif state == 'Ip':
+                self.setInfectivity(0.3 if self.age < 13 else 3.0)
+            elif state == 'Is':
+                self.setPresent(['BH', 'BS', 'US', 'VS', 'W', 'NH', 'R'], False)
+                self.setInfectivity(0.3 if self.age < 13 else 1)
+            elif state == 'H':
+                self.setPresent(['HH', 'NH'], False)
+
     def recover(self, p, day):
-        self.state = 'R'
+        self.setState('R')
         self.lastDay = day
-        self.sick = False
-        self.relInfectivity = 0.0
+        self.setSick(False)
+        self.setInfectivity(0.0)
 
-        for layer in self.present:
-            self.present[layer] = True
+        self.setPresent(layerBits, True)
             
         if random.random() < p['NI']:
             self.nextState = 'S'
 
     def turnAsymp(self, p, day):
-        self.state = 'Ia'
+        self.enterState('Ia', p, day)
         self.nextState = 'R'
-        self.nextDay = day+1+np.random.poisson(self.virus.duration['AS-R'])
-        self.sick = True
-
-        self.relInfectivity = 0.3
+        self.schedule(day+1+np.random.poisson(self.virus.duration['AS-R']))
     
     def turnPresymp(self, p, day):
-        self.state = 'Ip'
+        self.enterState('Ip', p, day)
         self.nextState = 'Is'
-        self.nextDay = day+1+np.random.poisson(self.virus.duration['PS-I'])
-        self.sick = True
-        self.relInfectivity = 3.0
-        if self.age < 13:
-            self.relInfectivity = 0.3
+        self.schedule(day+1+np.random.poisson(self.virus.duration['PS-I']))
     
     def activateSymptoms(self, p, day):
-        self.state = 'Is'
-        self.lastDay = day
-        for layer in ['BH', 'BS', 'US', 'VS', 'W', 'NH', 'R']:
-            self.present[layer] = False
+        self.enterState('Is', p, day)
         
         if self.inNursing:
             if random.random() < self.virus.probability['NHDage'][self.decade]:
                 self.nextState = 'D'
-                self.nextDay = day+1+np.random.poisson(self.virus.duration['I-D'])
+                self.schedule(day+1+np.random.poisson(self.virus.duration['I-D']))
             else:
                 self.nextState = 'R'
-                self.nextDay = day+1+np.random.poisson(self.virus.duration['I-R'])
+                self.schedule(day+1+np.random.poisson(self.virus.duration['I-R']))
                 
         elif random.random() < self.virus.probability['HRage'][self.decade]:
             self.nextState = 'H'
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['I-H'])
+            self.schedule(day+1+np.random.poisson(self.virus.duration['I-H']))
         else:
             self.nextState = 'R'
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['I-R'])
-        self.relInfectivity = 1
-        if self.age < 13:
-            self.relInfectivity = 0.3
+            self.schedule(day+1+np.random.poisson(self.virus.duration['I-R']))
         
     def hospitalize(self, p, day):
-        self.state = 'H'
-        self.lastDay = day
-        for layer in ['HH', 'NH']:
-            self.present[layer] = False 
+        self.enterState('H', p, day)
 
         if random.random() < self.virus.probability['ICUage'][self.decade]:
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['H-ICU'])
+            self.schedule(day+1+np.random.poisson(self.virus.duration['H-ICU']))
             self.nextState = 'ICU'
             
         elif random.random() < self.virus.probability['DRage'][self.decade]:
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['H-D'])
+            self.schedule(day+1+np.random.poisson(self.virus.duration['H-D']))
             self.nextState = 'D'
         else:
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['H-R'])
+            self.schedule(day+1+np.random.poisson(self.virus.duration['H-R']))
             self.nextState = 'R'
     
     def enterICU(self, p, day):
-        self.state = 'ICU'
-        self.lastDay = day
+        self.enterState('ICU', p, day)
 
         if random.random() < self.virus.probability['DRage'][self.decade]:
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['ICU-D'])
+            self.schedule(day+1+np.random.poisson(self.virus.duration['ICU-D']))
             self.nextState = 'D'
         else:
-            self.nextDay = day+1+np.random.poisson(self.virus.duration['ICU-R'])
+            self.schedule(day+1+np.random.poisson(self.virus.duration['ICU-R']))
             self.nextState = 'R'
 
     def die(self, p, day):
         self.diedFrom = self.state
-        self.state = 'D'
+        self.setState('D')
         self.lastDay = day
         self.nextDay = -1
         self.nextState = ''
-        self.sick = False
-        for layer in self.present:
-            self.present[layer] = False
+        self.setSick(False)
+        self.setPresent(layerBits, False)
 
     def vaccinateNode(self, p=1.0):
         if random.random() < p:
-            self.state = 'R'
-            self.sick = False
-            for layer in self.present:
-                self.present[layer] = True
+            self.setState('R')
+            self.nextDay = -1
+            self.setSick(False)
+            self.setPresent(layerBits, True)
 
     """
     def partialVaccination(attrs, vaccPool, n, p):
@@ -268,8 +362,15 @@ class Person:
 
 class Commuter(Person):
     
+    __slots__ = ('municipality_home', 'municipality_commute', 'missingHome')
+
     def __init__(self, Person, municipality_home, municipality_commute):
-        super().__init__(Person.id_number, Person.age)
+        super().__init__(Person.id_number, Person.age, index=Person.index)
+        self.uid = Person.uid
+        self.inNursing = Person.inNursing
+        self.cliques = Person.cliques
+        for clique in self.cliques:
+            clique.nodes[clique.nodes.index(Person)] = self
         self.municipality_home = municipality_home
         self.municipality_commute = municipality_commute
 
@@ -280,12 +381,245 @@ class Commuter(Person):
         return 1
 
 
-class Commuter2(Person):
-    '''Simple class for commuters without a created home municipality'''
-    def __init__(self, municipality_commute):
-        super().__init__(Person.id_number, Person.age)
-        self.municipality_commute = municipality_commute
-        
+# ============================================================
+# CALENDAR CLASS 
+# ============================================================
+
+
+class Calendar:
+    '''Event calendar with one bucket per day, holding the nodes that have
+    a state transition on that day.'''
+
+    def __init__(self):
+        self.buckets = {}
+
+    def __repr__(self):
+        return f'Calendar: events on {len(self.buckets)} days.'
+
+    def __bool__(self):
+        return bool(self.buckets)
+
+    def attach(self, nodes):
+        for node in nodes:
+            node.calendar = self
+
+    def push(self, node, day):
+        self.buckets.setdefault(day, []).append(node)
+
+    def pushMany(self, nodes, days):
+        '''Pushes an array of node indices, with one day each.'''
+        if not len(nodes):
+            return
+        order = np.argsort(days, kind='stable')
+        days, nodes = days[order], nodes[order]
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        for day, group in zip(days[np.r_[0, bounds]], np.split(nodes, bounds)):
+            self.buckets.setdefault(int(day), []).append(group)
+
+    def pop(self, day):
+        '''Removes and returns the events of a day.'''
+        return self.buckets.pop(day, [])
+
+
+# ============================================================
+# TRANSMISSION LOG CLASS 
+# ============================================================
+
+
+class TransmissionLog:
+    '''Append-only log of all infections, as growable arrays of ancestor,
+    descendant, layer code, day and municipality code. Nodes are referred 
+    to by a uid, given the first time they appear in the log, and an 
+    ancestor of -1 means infected from outside the model.'''
+
+    columns = {'ancestor': np.int32, 'descendant': np.int32, 'layer': np.int8,
+               'day': np.int32, 'municipality': np.int16}
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.data = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+        self.ids = []
+        self.homes = []
+        self.municipalities = []
+        self.municipality = -1
+        self.foreign = {}
+
+    def __repr__(self):
+        return f'TransmissionLog: {self.size} infections, {len(self.ids)} nodes.'
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        return self.data[name][:self.size]
+
+    def code(self, municipality):
+        '''Integer code of a municipality name.'''
+        if municipality not in self.municipalities:
+            self.municipalities.append(municipality)
+        return self.municipalities.index(municipality)
+
+    def setMunicipality(self, municipality):
+        '''Sets the municipality where the following infections take place.'''
+        self.municipality = self.code(municipality)
+
+    def uid(self, node):
+        if node.uid < 0:
+            node.uid = len(self.ids)
+            self.ids.append(node.id_number)
+            home = getattr(node, 'municipality_home', None)
+            self.homes.append(self.municipality if home is None else self.code(home))
+        return node.uid
+
+    def foreignUid(self, id_number, home):
+        '''Uid of a node that is stepped in another process, given by its id
+        and home municipality.'''
+        key = (id_number, home)
+        if key not in self.foreign:
+            self.foreign[key] = len(self.ids)
+            self.ids.append(id_number)
+            self.homes.append(self.code(home))
+        return self.foreign[key]
+
+    def key(self, uid):
+        '''Id and home municipality of a uid, which identify a node across logs.'''
+        return self.ids[uid], self.municipalities[self.homes[uid]]
+
+    def register(self, ids):
+        '''Gives consecutive uids to nodes of the current municipality, given 
+        by id, as used by the array engine. Returns the first uid.'''
+        start = len(self.ids)
+        self.ids.extend(ids)
+        self.homes.extend([self.municipality]*len(ids))
+        return start
+
+    def reserve(self, n):
+        capacity = len(self.data['day'])
+        if self.size + n > capacity:
+            capacity = max(2*capacity, self.size + n)
+            for name, column in self.data.items():
+                self.data[name] = np.resize(column, capacity)
+
+    def add(self, anc, node, layer, day):
+        '''Logs the infection of a node, by anc, or from outside if anc is None.'''
+        self.reserve(1)
+        i = self.size
+        self.data['ancestor'][i] = -1 if anc is None else self.uid(anc)
+        self.data['descendant'][i] = self.uid(node)
+        self.data['layer'][i] = layerCodes.get(layer, -1)
+        self.data['day'][i] = day
+        self.data['municipality'][i] = self.municipality
+        self.size += 1
+
+    def addMany(self, ancestors, nodes, layer, day, municipality=None):
+        '''Logs infections given as arrays of uids, as used by the array engine.
+        The municipality codes can be given per infection.'''
+        n = len(nodes)
+        self.reserve(n)
+        i = self.size
+        self.data['ancestor'][i:i+n] = ancestors
+        self.data['descendant'][i:i+n] = nodes
+        self.data['layer'][i:i+n] = layerCodes.get(layer, -1)
+        self.data['day'][i:i+n] = day
+        self.data['municipality'][i:i+n] = self.municipality if municipality is None else municipality
+        self.size += n
+
+    def filter(self, keep, start=0):
+        '''Removes the entries from start on where keep is False.'''
+        n = start + int(np.count_nonzero(keep))
+        for column in self.data.values():
+            column[start:n] = column[start:self.size][keep]
+        self.size = n
+
+    def merge(self, other, start=0):
+        '''Appends the entries of another log from start on, matching nodes 
+        by id and home municipality.'''
+        keys = {self.key(uid): uid for uid in range(len(self.ids))}
+        uids = np.full(len(other.ids)+1, -1, dtype=np.int32)
+        for uid in range(len(other.ids)):
+            key = other.key(uid)
+            if key not in keys:
+                keys[key] = len(self.ids)
+                self.ids.append(key[0])
+                self.homes.append(self.code(key[1]))
+            uids[uid] = keys[key]
+        codes = np.array([self.code(name) for name in other.municipalities] + [-1])
+
+        n = other.size - start
+        self.reserve(n)
+        i = self.size
+        self.data['ancestor'][i:i+n] = uids[other['ancestor'][start:]]
+        self.data['descendant'][i:i+n] = uids[other['descendant'][start:]]
+        self.data['layer'][i:i+n] = other['layer'][start:]
+        self.data['day'][i:i+n] = other['day'][start:]
+        self.data['municipality'][i:i+n] = codes[other['municipality'][start:]]
+        self.size += n
+
+    def snapshot(self):
+        '''Length of the log, to be restored by restore().'''
+        return self.size, len(self.ids), len(self.municipalities), self.municipality
+
+    def restore(self, snapshot):
+        '''Removes the entries and uids added after a snapshot.'''
+        self.size, n, m, self.municipality = snapshot
+        del self.ids[n:]
+        del self.homes[n:]
+        del self.municipalities[m:]
+        self.foreign = {key: uid for key, uid in self.foreign.items() if uid < n}
+
+    def offspring(self, n=None):
+        '''Number of infections caused by each uid.'''
+        ancestors = self['ancestor']
+        return np.bincount(ancestors[ancestors >= 0], minlength=n or len(self.ids))
+
+
+# ============================================================
+# DAILY R CLASS 
+# ============================================================
+
+
+class DailyR:
+    '''Daily R, accumulated as nodes recover. Each recovered node adds the 
+    number of infections it caused to every day from its infection to its 
+    recovery, stored as difference arrays over the days of the run.'''
+
+    def __init__(self, runDays):
+        self.runDays = runDays
+        self.total = np.zeros(runDays+1)
+        self.count = np.zeros(runDays+1, dtype=np.int64)
+
+    def __repr__(self):
+        return f'DailyR: {self.runDays} days.'
+
+    def add(self, offspring, startDay, recDay):
+        startDay = min(max(startDay, 0), self.runDays)
+        recDay = min(max(recDay, startDay), self.runDays)
+        self.total[startDay] += offspring
+        self.total[recDay] -= offspring
+        self.count[startDay] += 1
+        self.count[recDay] -= 1
+
+    def addMany(self, offspring, startDay, recDay):
+        '''Adds arrays of nodes.'''
+        n = self.runDays + 1
+        startDay = np.clip(startDay, 0, self.runDays)
+        recDay = np.clip(recDay, startDay, self.runDays)
+        weights = np.asarray(offspring, dtype=float)
+        self.total += np.bincount(startDay, weights, n) - np.bincount(recDay, weights, n)
+        self.count += np.bincount(startDay, minlength=n) - np.bincount(recDay, minlength=n)
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
+    def estimate(self):
+        '''Mean number of infections caused by the nodes infectious on each 
+        day, nan for days without any. Can be called during the run.'''
+        total = np.cumsum(self.total)[:self.runDays]
+        count = np.cumsum(self.count)[:self.runDays]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return list(np.where(count > 0, total / count, np.nan))
+
 
 # ============================================================
 # CLIQUE CLASS 
@@ -295,11 +629,17 @@ class Commuter2(Person):
 class Clique:
     '''Clique class containing Persons'''
 
+    __slots__ = ('name', 'municipality', 'nodes', 'open', 'openRating', 'cases', 
+                 'frontier', 'commuteDestination', 'cliqueCommuters', 'testDay')
+
     def __init__(self, municipality='', nodes=None):
+        self.name = ''
         self.municipality = municipality
         self.nodes = nodes if nodes is not None else []
         self.open = True
         self.openRating = 1.0
+        self.cases = 0
+        self.frontier = {}
 
     def __repr__(self):
         return f'C: {len(self.nodes)} nodes.'
@@ -313,6 +653,18 @@ class Clique:
     def __getitem__(self, key):
         return self.nodes[key]
 
+    def addNode(self, node):
+        self.nodes.append(node)
+        node.cliques.append(self)
+
+    def addCases(self, n):
+        '''Changes the number of sick and present nodes, and keeps the clique
+        in the frontier of its layer while it has cases.'''
+        self.cases += n
+        if self.cases > 0:
+            self.frontier[self] = None
+        else:
+            self.frontier.pop(self, None)
 
     def hasCases(self):
         for node in self.nodes:
@@ -358,6 +710,8 @@ class Clique:
 
 class Commuter_Clique(Clique):
 
+    __slots__ = ('commuter_nodes',)
+
     def __init__(self, Clique, commuter_nodes):
         super().__init__(Clique.municipality)
         self.commuter_nodes = commuter_nodes
@@ -368,6 +722,60 @@ class Commuter_Clique(Clique):
 
 
 
+# ============================================================
+# CLIQUE INDEX CLASS 
+# ============================================================
+
+
+class CliqueIndex:
+    '''Compressed sparse row index of clique membership. Row i holds the
+    members of clique i, as members[offsets[i]:offsets[i+1]].'''
+
+    def __init__(self, offsets, members):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.members = np.asarray(members, dtype=np.int32)
+
+    def __repr__(self):
+        return f'CliqueIndex: {len(self)} rows, {len(self.members)} members.'
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.members[self.offsets[row]:self.offsets[row+1]]
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def rows(self):
+        '''Row number of every entry in members.'''
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.sizes())
+
+    def gather(self, rows):
+        '''Members of the given rows, concatenated, and for every entry the
+        position in rows it came from.'''
+        starts = self.offsets[rows]
+        counts = self.offsets[np.asarray(rows)+1] - starts
+        position = np.repeat(np.arange(len(starts)), counts)
+        entries = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return self.members[entries], position
+
+    def transpose(self, n):
+        '''Index from each of n members to the rows it is part of.'''
+        order = np.argsort(self.members, kind='stable')
+        offsets = np.zeros(n+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.members, minlength=n), out=offsets[1:])
+        return CliqueIndex(offsets, self.rows()[order])
+
+    @classmethod
+    def fromLists(cls, rows):
+        offsets = np.zeros(len(rows)+1, dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        members = np.fromiter((i for row in rows for i in row),
+                              dtype=np.int32, count=offsets[-1])
+        return cls(offsets, members)
+
+
 # ============================================================
 # LAYER CLASS 
 # ============================================================
@@ -380,6 +788,14 @@ class Layer:
         self.name = name
         self.cliques = []
         self.open = True
+        self.index = None
+        self.nodeCliques = None
+        self.frontier = {}
+        self.activity = None
+        self.commuter = None
+        self.sick = None
+        self.susceptible = None
+        self.relInfectivity = None
 
 
     def __repr__(self):
@@ -395,14 +811,46 @@ class Layer:
 
 
     def addClique(self, Clique):
+        Clique.name = self.name
+        Clique.frontier = self.frontier
         self.cliques.append(Clique)
 
+    def setIndex(self, index, nodes):
+        '''Sets the clique membership index of the layer, and its transpose
+        from persons to cliques.'''
+        self.index = index
+        self.nodeCliques = index.transpose(nodes)
+
+    def cliquesOf(self, node):
+        '''Cliques of a node in this layer, by its row in the index.'''
+        return [self.cliques[i] for i in self.nodeCliques[node.index]]
+
     def hasCases(self):
         for clique in self:
             if clique.hasCases():
                 return True
         return False
 
+    def activeCliques(self):
+        '''Cliques with sick and present nodes, in the order they got cases.'''
+        return list(self.frontier)
+
+    def attach(self, nodes):
+        '''Keeps the activity, commuter status, infectivity, and sick and
+        susceptible flags of the nodes of a random layer as arrays, indexed
+        by node.index, which the nodes update as they change. The nodes must
+        be in the order of their index.'''
+        if any(node.index != i for i, node in enumerate(nodes)):
+            raise ValueError(f'The nodes of layer {self.name} are not in the order of their index.')
+        self.activity = np.array([node.activity for node in nodes])
+        self.commuter = np.array([hasattr(node, 'municipality_commute') for node in nodes])
+        self.sick = np.zeros(len(nodes), dtype=bool)
+        self.susceptible = np.zeros(len(nodes), dtype=bool)
+        self.relInfectivity = np.zeros(len(nodes))
+        for node in nodes:
+            node.residentLayer = self
+            node.updateResidentLayer()
+
 
 # ============================================================
 # MUNICIPALITY CLASS 
@@ -412,12 +860,18 @@ class Layer:
 class Municipality:
     '''Municipality class containing cliques'''
 
-    def __init__(self, name, layers, attrs):
+    def __init__(self, name, layers, attrs, runDays=0):
         self.name = name
         self.layers = layers
         self.attrs = attrs
         self.population = len(attrs.values())
         self.pools = []
+        self.calendar = Calendar()
+        self.calendar.attach(attrs.values())
+        self.counts = modelFunctions.attachCounter(attrs)
+        self.dormant = False
+        self.dailyR = DailyR(runDays)
+        self.findVisitors()
 
 
     def __repr__(self):
@@ -433,6 +887,77 @@ class Municipality:
                 return True
         return False
 
+    def isDormant(self):
+        '''True if nothing can happen in the municipality today, with only 
+        S, R and D agents, no pending events and no cliques with cases. 
+        Sick commuters from other municipalities put their cliques in the 
+        frontier, and infected agents change the counts, which wakes it up.'''
+        counts = self.counts
+        if counts['S'] + counts['R'] + counts['D'] != self.population:
+            return False
+        if self.calendar:
+            return False
+        return not any(layer.frontier for layer in self.layers.values())
+
+    def findVisitors(self):
+        '''Index of the commuters from municipalities that are not loaded, 
+        which are only found in the cliques. They progress with the calendar
+        of this municipality.'''
+        self.visitors = [node for node in self.layers['R'].cliques[1:] if hasattr(node, 'missingHome')]
+        self.calendar.attach(self.visitors)
+
+    def nodes(self):
+        '''Persons of the municipality, and commuters from municipalities 
+        that are not loaded.'''
+        return list(self.attrs.values()) + self.visitors
+
+    def snapshot(self):
+        '''Saves the mutable state of the municipality: the Person.mutable
+        attributes of its nodes, the calendar, state counts and daily R, and 
+        the case counts, open flags and frontier of the cliques.'''
+        nodes = self.nodes()
+        states = []
+        for state in map(operator.attrgetter(*Person.mutable), nodes):
+            if state[-1]:
+                state = state[:-1] + (list(state[-1]),)
+            states.append(state)
+
+        cliques = {name: [(clique.cases, clique.open) for clique in layer] 
+                   for name, layer in self.layers.items() if name != 'R'}
+        
+        return {'nodes': nodes, 'states': states, 'cliques': cliques,
+                'open': {name: layer.open for name, layer in self.layers.items()},
+                'frontier': {name: dict(layer.frontier) for name, layer in self.layers.items()},
+                'calendar': {day: list(events) for day, events in self.calendar.buckets.items()},
+                'counts': dict(self.counts), 'pools': list(self.pools), 'dormant': self.dormant,
+                'dailyR': (self.dailyR.total.copy(), self.dailyR.count.copy())}
+
+    def restore(self, snapshot):
+        '''Restores the state saved by snapshot(). Only the nodes that have
+        changed since are written back.'''
+        getter = operator.attrgetter(*Person.mutable)
+        for node, state in zip(snapshot['nodes'], snapshot['states']):
+            if getter(node) != state:
+                for name, value in zip(Person.mutable, state):
+                    setattr(node, name, value)
+                if state[-1]:
+                    node.trajectory = list(state[-1])
+                node.updateResidentLayer()
+
+        for name, layer in self.layers.items():
+            layer.open = snapshot['open'][name]
+            layer.frontier.clear()
+            layer.frontier.update(snapshot['frontier'][name])
+            for clique, (cases, open) in zip(layer.cliques, snapshot['cliques'].get(name, [])):
+                clique.cases = cases
+                clique.open = open
+
+        self.calendar.buckets = {day: list(events) for day, events in snapshot['calendar'].items()}
+        self.counts.update(snapshot['counts'])
+        self.pools = list(snapshot['pools'])
+        self.dormant = snapshot['dormant']
+        self.dailyR.total[:], self.dailyR.count[:] = snapshot['dailyR']
+
     def setTestRules(self, parameters):
         self.pools = modelFunctions.setTestRules(
             parameters, self.layers, self.attrs)
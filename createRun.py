@@ -7,7 +7,6 @@ Script for running the simulations in Python.
 """
 
 import sys
-import copy
 import time
 import os
 import pickle
@@ -21,10 +20,21 @@ def createFilename(mutationChance, runID, frac, region, nameAppend=''):
 
 
 def isSimulated(filename):
-    return os.path.isfile(filename)
+    '''True if the results of a run are saved, or it is running. A run that
+    was stopped and left its placeholder and checkpoint is resumed.'''
+    return os.path.isfile(filename) and not os.path.isfile(f'{filename}.checkpoint.npz')
 
 
-def initAndTimedSim(mutationChance, runID, commuterFracs, region='trondelag', overwrite=False, nameAppend=''):
+def timedBranch(municipalities, parameters, frac, day, runDays):
+    [m.setTestRules(parameters) for m in municipalities]
+    parameters.commuterFraction = frac
+    return timedRun(municipalities, parameters, day, runDays)
+
+
+def initAndTimedSim(mutationChance, runID, commuterFracs, region='trondelag', overwrite=False, nameAppend='', branching='snapshot'):
+    '''Initial run up to a threshold, then one timed run per commuter 
+    fraction from the same point. The branches start from a snapshot of the 
+    model, or with branching='fork', each in a forked process.'''
     start_time = time.time()
     print(f'  Run {runID}; Initialising model... ', end='\r', flush=True)
 
@@ -46,6 +56,7 @@ def initAndTimedSim(mutationChance, runID, commuterFracs, region='trondelag', ov
     
     stateLog1, infLog1, infLogByLayer1, i1 = initRun(municipalities, parameters, treshold=1000)
     print(f'  Run {runID}; Initial run finished in {i1} days...       ', end='\r', flush=True)
+    snapshot = takeSnapshot(municipalities, parameters)
 
     for frac in commuterFracs:
         filename = createFilename(mutationChance, runID, frac, region, nameAppend)
@@ -53,14 +64,14 @@ def initAndTimedSim(mutationChance, runID, commuterFracs, region='trondelag', ov
         if not overwrite and os.path.isfile(filename):
             continue
         
-        municipalitiesFork = copy.deepcopy(municipalities)
         print(f'  Run {runID}; Starting timed run, frac: {frac}...   ', end='\r', flush=True)
 
-        [m.setTestRules(parameters) for m in municipalities]
-        parameters.commuterFraction = frac
-        
         testTime = 30
-        stateLog = timedRun(municipalitiesFork, parameters, i1, testTime)
+        if branching == 'fork':
+            stateLog = forkRun(timedBranch, municipalities, parameters, frac, i1, testTime)
+        else:
+            restoreSnapshot(municipalities, parameters, snapshot)
+            stateLog = timedBranch(municipalities, parameters, frac, i1, testTime)
         pickle.dump(stateLog, open(filename, 'wb'))
         print(f'  Run {runID}; Completed frac: {frac}...              ', end='\r', flush=True)
     
@@ -90,6 +101,7 @@ def fullSim(mutationChance, runID, runParams, overwrite=False):
             pickle.dump(0, open(filename, 'wb')) # create temp file
             
             parameters.commuterFraction = frac
+            parameters.checkpoint = filename
             municipalities, parameters = nationalModelSetup(parameters, runParams['region'])
             
             print(f'  Mutation {mutationChance:.2f}; Fraction {frac}; Full run...       ', end='\r', flush=True)
@@ -97,16 +109,20 @@ def fullSim(mutationChance, runID, runParams, overwrite=False):
             stateLog, dailyR = fullRun(municipalities, parameters)
             
             if runParams['createNetwork']:
-                nationalModelFunctions.createEdgeNetwork(municipalities, filename)
+                nationalModelFunctions.createEdgeNetwork(parameters.transmissionLog, filename)
             
             pickle.dump(stateLog, open(filename, 'wb'))
             pickle.dump(dailyR, open(filename.replace('StateLog','R'), 'wb'))
+            checkpoint.removeCheckpoint(parameters)
             
             print(f'  Run {runID}; Fraction {frac}; Completed...              ', end='\r', flush=True)
             
         except KeyboardInterrupt: # delete temporary file if simulation is interrupted
             os.remove(filename)
             sys.exit(0)
+        except Exception: # delete temp file if simulation fails, the checkpoint is kept
+            os.remove(filename)
+            raise
     
     print(f'  Mutation {mutationChance:.2f}; Finished in {(time.time()-start_time)/60:.1f} min.        ', flush=True)
 
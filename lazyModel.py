@@ -0,0 +1,217 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: lazyModel.py
+
+Lazy version of the national model, for runs seeded in one municipality.
+Only the seeded municipality is read at the start. The rest of the region
+is kept as stubs, with the number of persons of each municipality and of
+commuters to it from outside the region, and logged as fully susceptible.
+
+A stub is read, linked to the agents already loaded and run as in
+nationalModel.py from the day the epidemic reaches it: when one of its
+residents is infected while commuting to a loaded municipality, when an
+agent commuting to it is infected, or when one of the commuters to it from
+outside the region is infected with probability commuter_prevalence, with
+commuterImports as in nationalModel.dailyCommuterSpread. The
+setup time and memory then grow with the reach of the epidemic, and not
+with the size of the region.
+
+Until a stub is read, its residents commuting to loaded municipalities are
+made as in linkCommuters for homes that are not loaded. When it is read,
+they are replaced by its agents, which take over their course of disease.
+
+The lazy mode needs the cache of networkCache.py to be cheap: the stubs are
+counted from the memory-mapped arrays of every municipality of the region.
+The cache of a municipality that has none, or a stale one, is written by
+the first run that counts it, which then parses all of its network once.
+
+"""
+
+import time
+import numpy as np
+
+from parameters import *
+import classes
+import metapopulation
+import modelFunctions
+import modelUtilities
+import nationalModel
+import nationalModelFunctions
+import networkCache
+
+
+def readStub(municipality, region):
+    '''Number of persons of a municipality, and of the commuters to it from
+    municipalities that are not in the region, as linked by linkVisitors.
+    They are counted from the cache of the municipality, which is written
+    first if it is missing or stale.'''
+    files = networkCache.municipalityFiles(municipality)
+    if not networkCache.isFresh(*files):
+        networkCache.writeCache(*files)
+    network = networkCache.loadNetwork(*files)
+    sizes = np.diff(network['visitorOffsets'])
+    linked = np.repeat(np.asarray(network['cliqueLayer']) != layerCodes['HH'], sizes)
+    homes = network['homes'].tolist()
+    counts = np.bincount(np.asarray(network['visitorHomes'])[linked], minlength=len(homes))
+    outside = sum(n for home, n in zip(homes, counts.tolist()) if not region.isLoaded(home))
+    return len(network['ids']), outside
+
+
+class LazyModel:
+    '''Agent-based municipalities, read as the epidemic reaches them, and
+    stubs for the rest of the region.'''
+
+    def __init__(self, parameters, region='trondelag'):
+        self.parameters = parameters
+        parameters.municipalityList = nationalModelFunctions.getMunicipalityList(region)
+        self.names = [m for m in parameters.municipalityList if metapopulation.Hybrid.readable(m)]
+        self.region = nationalModelFunctions.CommuterIndex()
+        for name in self.names:
+            self.region.addMunicipality(name, [])
+        seeded = [m for m in self.names if not parameters.seedMunicipality or m == parameters.seedMunicipality]
+
+        self.layers, self.attrs = {}, {}
+        self.index = nationalModelFunctions.CommuterIndex()
+        for name in seeded:
+            self.layers[name], self.attrs[name] = nationalModelFunctions.readMunicipality(name)
+            self.saveCommuters(name)
+        nationalModelFunctions.linkCommuters(self.layers, self.attrs, parameters)
+
+        parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
+        parameters.p = modelFunctions.setInfectionProbabilities(
+            parameters.inputVector, SARS_CoV_2.probability, parameters)
+        parameters.transmissionLog = classes.TransmissionLog()
+
+        self.municipalities = []
+        for name in seeded:
+            municipality = nationalModel.municipalitySetup(self.layers[name], self.attrs[name], parameters, name)
+            self.municipalities.append(municipality)
+
+        self.stubs = {}
+        for name in self.names:
+            if name not in self.layers:
+                population, outside = readStub(name, self.region)
+                self.stubs[name] = population, np.random.binomial(outside, parameters.commuterFraction)
+        self.findCommuters()
+
+    def __repr__(self):
+        return f'LazyModel: {len(self.municipalities)} of {len(self.names)} municipalities read.'
+
+    def saveCommuters(self, name):
+        '''Keeps the members of the commuter cliques of a municipality, to
+        link it to the stubs read later.'''
+        layers = self.layers[name]
+        self.index.addMunicipality(name, [(clique.commuteDestination, list(clique.nodes)) for clique in layers['C']])
+
+    def stub(self, name):
+        '''The stub a municipality in the network files refers to, or None.'''
+        name = self.region.name(name)
+        return name if name in self.stubs else None
+
+    def outsiders(self, municipality):
+        '''Commuters to a municipality from outside the region.'''
+        return [node for node in municipality.visitors if not self.region.isLoaded(node.municipality_home)]
+
+    def findCommuters(self):
+        '''Commuters between the agents and the stubs, with the name of the
+        stub, and the commuters to each agent municipality from outside the
+        region.'''
+        self.boundary, self.outside = [], {}
+        for municipality in self.municipalities:
+            self.outside[municipality.name] = self.outsiders(municipality)
+            for node in municipality.visitors:
+                stub = self.stub(node.municipality_home)
+                if stub is not None:
+                    self.boundary.append((node, stub))
+            for node in municipality.attrs.values():
+                if isinstance(node, classes.Commuter):
+                    stub = self.stub(node.municipality_commute)
+                    if stub is not None:
+                        self.boundary.append((node, stub))
+
+    def importInfections(self, day):
+        '''Reads the stubs reached by the epidemic today, and infects the
+        commuters to them from outside the region if commuterImports is set.
+        Returns the names of the stubs read.'''
+        names = list(self.stubs)
+        imports = np.zeros(len(names), dtype=np.int64)
+        if self.parameters.commuterImports:
+            imports = np.random.binomial([self.stubs[name][1] for name in names], self.parameters.commuter_prevalence)
+        reached = {stub for node, stub in self.boundary if node.state != 'S'}
+        reached.update(name for name, n in zip(names, imports.tolist()) if n)
+
+        read = [name for name in names if name in reached]
+        for name, n in zip(names, imports.tolist()):
+            if name not in reached:
+                continue
+            municipality = self.materialize(name, day)
+            visitors = self.outsiders(municipality)
+            for i in np.random.choice(len(visitors), min(n, len(visitors)), replace=False).tolist():
+                if visitors[i].state == 'S':
+                    nationalModel.infectCommuter(visitors[i], day, self.parameters)
+        if read:
+            self.findCommuters()
+        return read
+
+    def materialize(self, name, day):
+        '''Reads a stub, links it to the agents already loaded, and replaces
+        its residents commuting to them with its agents.'''
+        parameters = self.parameters
+        layers, attrs = nationalModelFunctions.readMunicipality(name)
+        self.layers[name], self.attrs[name] = layers, attrs
+        self.saveCommuters(name)
+        for clique in layers['C']:
+            for node in clique:
+                node.cliques.remove(clique)
+        del layers['C']
+        nationalModelFunctions.linkVisitors(layers, self.index, parameters)
+
+        municipality = nationalModel.municipalitySetup(layers, attrs, parameters, name)
+        del self.stubs[name]
+        self.municipalities.append(municipality)
+
+        others = [other for other in self.municipalities if other is not municipality]
+        nationalModelFunctions.replaceVisitors(others, name, self.index, day, parameters)
+        modelFunctions.indexCliques(layers, attrs)
+        return municipality
+
+    def stubStates(self, name):
+        '''State counts of a stub, for the state log.'''
+        return dict(dict.fromkeys(stateList, 0), S=self.stubs[name][0])
+
+    def run(self):
+        '''Full run of the lazy model.'''
+        parameters = self.parameters
+        stateLog = {name: [] for name in self.names}
+        timeUsed = []
+        day = 0
+
+        while day < parameters.runDays:
+            day += 1
+            dayTime = time.time()
+            for municipality in self.municipalities:
+                nationalModel.municipalityDay(municipality, parameters, day)
+                if parameters.testRules:
+                    nationalModel.testing(municipality, parameters, day)
+                nationalModel.dailyCommuterSpread(municipality, day, parameters, self.outside[municipality.name])
+
+            self.importInfections(day)
+            for municipality in self.municipalities:
+                stateLog[municipality.name].append(nationalModel.logMunicipality(
+                    municipality, stateLog[municipality.name], parameters))
+            for name in self.stubs:
+                stateLog[name].append(self.stubStates(name))
+
+            timeUsed.append(time.time() - dayTime)
+            if parameters.printResults:
+                modelUtilities.printProgress(day, parameters.runDays, timeUsed, bar_length=50)
+
+        dailyR = {name: [np.nan]*parameters.runDays for name in self.names}
+        region = classes.DailyR(parameters.runDays)
+        for municipality in self.municipalities:
+            dailyR[municipality.name] = municipality.dailyR.estimate()
+            region.merge(municipality.dailyR)
+        dailyR[parameters.region] = region.estimate()
+
+        return stateLog, dailyR
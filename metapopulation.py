@@ -0,0 +1,396 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: metapopulation.py
+
+Hybrid version of the national model. The municipalities in parameters.focus
+are run with the agent-based model, as in nationalModel.py, while the rest of
+the region is run as a stochastic SEIR metapopulation, with one set of
+compartments per municipality and decade. The course of disease in the
+compartments is sampled with arrayModel.sampleTrajectories, so it follows
+the same SARS_CoV_2 tables as the agents.
+
+The municipalities are coupled through data/commuter_df.csv. Commuters from
+compartmental municipalities to the agents, and agents commuting to them,
+are infected with the force of infection of the compartmental municipality.
+When the prevalence of a compartmental municipality crosses
+parameters.promotionThreshold, its network is read, linked to the agents
+already loaded, and its agents are given states drawn from its compartments.
+
+"""
+
+import os
+import random
+import time
+import numpy as np
+
+from parameters import *
+import arrayModel
+import classes
+import modelFunctions
+import modelUtilities
+import nationalModel
+import nationalModelFunctions
+import networkCache
+
+
+# share of the contacts of a commuter made in the municipality it commutes to
+workShare = 0.3
+
+# susceptibility and relative infectivity by decade, as in model.cliqueDay
+# and Person.enterState, where children are counted as the first decade
+susceptibility = np.array([0.3] + [1.0]*8)
+relInfectivity = np.zeros((len(stateList), 9))
+relInfectivity[stateCodes['Ia']] = 0.3
+relInfectivity[stateCodes['Ip']] = [0.3] + [3.0]*8
+relInfectivity[stateCodes['Is']] = [0.3] + [1.0]*8
+
+
+def readDecades(municipality):
+    '''Number of persons in each decade of a municipality, from its age file.'''
+    ageFile, cliqueFile = networkCache.municipalityFiles(municipality)
+    if networkCache.isFresh(ageFile, cliqueFile):
+        ages = np.asarray(networkCache.loadNetwork(ageFile, cliqueFile)['ages'])
+    else:
+        with open(ageFile) as f:
+            ages = np.array([int(line.split(';')[1]) for line in f])
+    return np.bincount(np.minimum(ages // 10, 8), minlength=9)
+
+
+def infectiousDays():
+    '''Expected infectivity of an exposed person, weighted by relInfectivity
+    and summed over the days of the disease, for each decade.'''
+    probability, duration = SARS_CoV_2.probability, SARS_CoV_2.duration
+    days = np.zeros(9)
+    for a in range(9):
+        symptomatic = probability['S'][10*a]
+        hospitalised = probability['HRage'][10*a]
+        days[a] = ((1 - symptomatic) * relInfectivity[stateCodes['Ia'], a] * (duration['AS-R'] + 1)
+                   + symptomatic * relInfectivity[stateCodes['Ip'], a] * (duration['PS-I'] + 1)
+                   + symptomatic * relInfectivity[stateCodes['Is'], a] * (
+                       hospitalised * (duration['I-H'] + 1) + (1 - hospitalised) * (duration['I-R'] + 1)))
+    return days
+
+
+def mixingMatrix(flows, size, commuterFraction=1.0):
+    '''Share of the contacts of the persons of each municipality made with 
+    each municipality, from a symmetric matrix of commuters.'''
+    mixing = workShare * commuterFraction * flows / size[:, None]
+    mixing /= np.maximum(mixing.sum(axis=1), 1)[:, None]
+    mixing[np.diag_indices(len(size))] = 1 - mixing.sum(axis=1)
+    return mixing
+
+
+class Metapopulation:
+    '''Compartments of the municipalities that are not run with agents. The
+    counts are kept by municipality, state and decade, and the transitions
+    sampled for the exposed are stored in a ring of future days.'''
+
+    horizon = 128
+
+    def __init__(self, names, parameters):
+        self.names = names
+        self.keys = {nationalModelFunctions.normalizeName(name): m for m, name in enumerate(names)}
+        self.words = {}
+        for key in self.keys:
+            self.words.setdefault(key.split('_')[0], []).append(key)
+        self.population = np.array([readDecades(name) for name in names]).reshape(-1, 9)
+        self.size = np.maximum(self.population.sum(axis=1), 1)
+        self.agent = np.zeros(len(names), dtype=bool)
+        self.weights = np.zeros((len(names), len(stateList)))
+        self.municipalities = {}
+
+        self.counts = np.zeros((len(names), len(stateList), 9), dtype=np.int64)
+        self.counts[:, stateCodes['S']] = self.population
+        self.pending = np.zeros((self.horizon, len(names), len(stateList), 9), dtype=np.int64)
+
+        weights, flows, missing = nationalModelFunctions.commuterGraph(names)
+        self.mixing = mixingMatrix(flows, self.size, parameters.commuterFraction)
+
+        shares = self.population.sum(axis=0) / max(self.population.sum(), 1)
+        self.beta = parameters.metapopulationR / (shares * susceptibility * infectiousDays()).sum()
+
+    def __repr__(self):
+        return f'Metapopulation: {(~self.agent).sum()} of {len(self.names)} municipalities.'
+
+    def find(self, name):
+        '''Index of a municipality, by name as written in the network files,
+        resolved with nationalModelFunctions.matchName, or None.'''
+        key = nationalModelFunctions.matchName(nationalModelFunctions.normalizeName(name), self.keys, self.words)
+        return self.keys[key] if isinstance(key, str) else None
+
+    def setAgent(self, m, municipality):
+        '''Marks a municipality as run with agents, and removes its compartments.
+        Its infectivity is then counted from the state counter of the agents,
+        with the relative infectivity averaged over its decades.'''
+        self.agent[m] = True
+        self.counts[m] = 0
+        self.pending[:, m] = 0
+        self.weights[m] = relInfectivity @ self.population[m] / max(self.population[m].sum(), 1)
+        self.municipalities[m] = municipality
+
+    def expose(self, m, decades, day):
+        '''Exposes persons of the given decades in municipalities m, and
+        schedules their whole course of disease.'''
+        if not len(decades):
+            return
+        np.add.at(self.counts, (m, stateCodes['S'], decades), -1)
+        np.add.at(self.counts, (m, stateCodes['E'], decades), 1)
+
+        states, days = arrayModel.sampleTrajectories(
+            10*decades, np.zeros(len(decades), dtype=bool), np.full(len(decades), day))
+        days = np.minimum(days, day + self.horizon - 1) % self.horizon
+        previous = np.full(len(decades), stateCodes['E'])
+        for step in range(states.shape[1]):
+            entered = states[:, step] >= 0
+            np.add.at(self.pending, (days[entered, step], m[entered], previous[entered], decades[entered]), -1)
+            np.add.at(self.pending, (days[entered, step], m[entered], states[entered, step], decades[entered]), 1)
+            previous = np.where(entered, states[:, step], previous)
+
+    def seed(self, m, n, day=0):
+        '''Exposes n random persons of municipality m.'''
+        decades = np.repeat(np.arange(9), self.population[m])
+        decades = np.random.permutation(decades)[:n]
+        self.expose(np.full(len(decades), m), decades, day)
+
+    def prevalence(self):
+        '''Infectivity per person of every municipality.'''
+        infectious = np.einsum('msa,sa->m', self.counts, relInfectivity)
+        for m, municipality in self.municipalities.items():
+            counts = np.array([municipality.counts[s] for s in stateList])
+            infectious[m] = counts @ self.weights[m]
+        return infectious / self.size
+
+    def hazards(self):
+        '''Force of infection per unit of susceptibility: in every
+        municipality, at home for its commuters, and at work for the
+        commuters to it.'''
+        prevalence = self.prevalence()
+        force = self.beta * self.mixing @ prevalence
+        return force, self.beta * (1 - workShare) * prevalence, self.beta * workShare * prevalence
+
+    def step(self, day):
+        '''One day of the compartments: new exposures from the infectivity at
+        the start of the day, then the transitions sampled for today.'''
+        force, home, work = self.hazards()
+        compartments = np.flatnonzero(~self.agent)
+        probability = 1 - np.exp(-force[compartments, None] * susceptibility)
+        exposed = np.random.binomial(self.counts[compartments, stateCodes['S']], probability)
+        m, decades = np.nonzero(exposed)
+        counts = exposed[m, decades]
+        self.expose(np.repeat(compartments[m], counts), np.repeat(decades, counts), day)
+
+        today = day % self.horizon
+        self.counts += self.pending[today]
+        self.pending[today] = 0
+        return exposed.sum()
+
+    def states(self, m):
+        '''State counts of a compartmental municipality, for the state log.'''
+        return dict(zip(stateList, self.counts[m].sum(axis=1).tolist()))
+
+    def infected(self):
+        '''Exposed and infectious persons per person of every municipality.'''
+        sick = [stateCodes[s] for s in ['E', 'Ia', 'Ip', 'Is', 'H', 'ICU']]
+        return self.counts[:, sick].sum(axis=(1, 2)) / self.size
+
+
+class Hybrid:
+    '''Agent-based municipalities and the metapopulation around them.'''
+
+    def __init__(self, parameters, region='trondelag'):
+        self.parameters = parameters
+        parameters.municipalityList = nationalModelFunctions.getMunicipalityList(region)
+        names = [m for m in parameters.municipalityList if self.readable(m)]
+        focus = [m for m in names if m in parameters.focus]
+
+        self.layers, self.attrs = {}, {}
+        self.index = nationalModelFunctions.CommuterIndex()
+        for name in focus:
+            self.layers[name], self.attrs[name] = nationalModelFunctions.readMunicipality(name)
+            self.saveCommuters(name)
+        nationalModelFunctions.linkCommuters(self.layers, self.attrs, parameters)
+
+        parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
+        parameters.p = modelFunctions.setInfectionProbabilities(
+            parameters.inputVector, SARS_CoV_2.probability, parameters)
+        parameters.transmissionLog = classes.TransmissionLog()
+
+        self.meta = Metapopulation(names, parameters)
+        self.municipalities = []
+        for name in focus:
+            municipality = nationalModel.municipalitySetup(self.layers[name], self.attrs[name], parameters, name)
+            self.municipalities.append(municipality)
+            self.meta.setAgent(self.meta.find(name), municipality)
+
+        for m, name in enumerate(names):
+            if not self.meta.agent[m] and (not parameters.seedMunicipality or name == parameters.seedMunicipality):
+                n = parameters.n if parameters.n else int(self.meta.population[m].sum()*parameters.prevalence)
+                self.meta.seed(m, min(n, self.meta.population[m].sum()))
+        self.findCommuters()
+
+    def __repr__(self):
+        return f'Hybrid: {len(self.municipalities)} agent municipalities, {self.meta}'
+
+    @staticmethod
+    def readable(municipality):
+        return os.path.isfile(networkCache.municipalityFiles(municipality)[0])
+
+    def saveCommuters(self, name):
+        '''Keeps the members of the commuter cliques of a municipality, to
+        link it to municipalities read later. promote removes the cliques
+        from the network.'''
+        layers = self.layers[name]
+        self.index.addMunicipality(name, [(clique.commuteDestination, list(clique.nodes)) for clique in layers['C']])
+
+    def findCommuters(self):
+        '''Commuters from compartmental municipalities to the agents, and agents
+        commuting to compartmental municipalities, with the index of that
+        municipality, and the commuters to each agent municipality from
+        outside the region.'''
+        self.visitors, self.outbound, self.outside = [], [], {}
+        for municipality in self.municipalities:
+            self.outside[municipality.name] = []
+            for node in municipality.visitors:
+                m = self.meta.find(node.municipality_home)
+                if m is None:
+                    self.outside[municipality.name].append(node)
+                elif not self.meta.agent[m]:
+                    self.visitors.append((node, m))
+            for node in municipality.attrs.values():
+                if isinstance(node, classes.Commuter):
+                    m = self.meta.find(node.municipality_commute)
+                    if m is not None and not self.meta.agent[m]:
+                        self.outbound.append((node, m))
+
+    def importInfections(self, day):
+        '''Infects the commuters between agents and compartments, with the
+        force of infection of the compartmental municipality.'''
+        force, home, work = self.meta.hazards()
+        home = 1 - np.exp(-home[:, None] * susceptibility)
+        work = 1 - np.exp(-work[:, None] * susceptibility)
+        infected = 0
+        for nodes, probability in [(self.visitors, home), (self.outbound, work)]:
+            for node, m in nodes:
+                if node.state == 'S' and random.random() < probability[m, node.decade // 10]:
+                    nationalModel.infectCommuter(node, day, self.parameters)
+                    infected += 1
+        return infected
+
+    def promote(self, m, day):
+        '''Switches a compartmental municipality to agents. The network is read
+        and linked to the agents already loaded, and the agents are given the
+        states of the compartments, with new state durations.'''
+        parameters = self.parameters
+        name = self.meta.names[m]
+        counts = self.meta.counts[m].copy()
+        layers, attrs = nationalModelFunctions.readMunicipality(name)
+        self.layers[name], self.attrs[name] = layers, attrs
+        self.saveCommuters(name)
+        for clique in layers['C']:
+            for node in clique:
+                node.cliques.remove(clique)
+        del layers['C']
+
+        nationalModelFunctions.linkVisitors(layers, self.index, parameters)
+
+        for node in attrs.values():
+            node.generateActivity(parameters)
+            node.activity = min(node.activity, 100)
+        municipality = classes.Municipality(name, layers, attrs, parameters.runDays)
+        modelFunctions.setStrategy(layers, attrs, parameters)
+        parameters.transmissionLog.setMunicipality(name)
+        self.setStates(attrs, counts, day)
+        self.meta.setAgent(m, municipality)
+        self.municipalities.append(municipality)
+
+        others = [other for other in self.municipalities if other is not municipality]
+        nationalModelFunctions.replaceVisitors(others, name, self.index, day, parameters)
+        modelFunctions.indexCliques(layers, attrs)
+        self.findCommuters()
+        return municipality
+
+    def setStates(self, attrs, counts, day):
+        '''Gives the persons of each decade the states of the compartments.'''
+        byDecade = [[] for a in range(9)]
+        for node in attrs.values():
+            byDecade[node.decade // 10].append(node)
+        for a, nodes in enumerate(byDecade):
+            random.shuffle(nodes)
+            i = 0
+            for s, state in enumerate(stateList):
+                if state == 'S':
+                    continue
+                for node in nodes[i:i+counts[s, a]]:
+                    self.setState(node, state, day)
+                i += counts[s, a]
+
+    def setState(self, node, state, day):
+        '''Puts a susceptible agent in the given state, through the same state
+        changes as the disease would, and schedules its next transition.'''
+        p = self.parameters.p
+        if state == 'R':
+            node.setState('R')
+            node.lastDay = day
+            return
+        if state == 'D':
+            node.die(p, day)
+            node.diedFrom = ''
+            return
+
+        node.virus = SARS_CoV_2()
+        node.infDay = day
+        self.parameters.transmissionLog.add(None, node, 'mun', day)
+        if state == 'E':
+            node.setState('E')
+            node.lastDay = day
+            node.scheduleIncubation(day, self.parameters)
+            return
+
+        path = {'Ia': [], 'Ip': [], 'Is': ['Ip'], 'H': ['Ip', 'Is'], 'ICU': ['Ip', 'Is', 'H']}
+        for previous in path[state]:
+            node.enterState(previous, p, day)
+        {'Ia': node.turnAsymp, 'Ip': node.turnPresymp, 'Is': node.activateSymptoms,
+         'H': node.hospitalize, 'ICU': node.enterICU}[state](p, day)
+
+    def run(self):
+        '''Full run of the hybrid model.'''
+        parameters = self.parameters
+        names = self.meta.names
+        stateLog = {name: [] for name in names}
+        timeUsed = []
+        day = 0
+
+        while day < parameters.runDays:
+            day += 1
+            dayTime = time.time()
+            for municipality in self.municipalities:
+                nationalModel.municipalityDay(municipality, parameters, day)
+                if parameters.testRules:
+                    nationalModel.testing(municipality, parameters, day)
+                nationalModel.dailyCommuterSpread(municipality, day, parameters, self.outside[municipality.name])
+                stateLog[municipality.name].append(nationalModel.logMunicipality(
+                    municipality, stateLog[municipality.name], parameters))
+
+            self.importInfections(day)
+            self.meta.step(day)
+            for m in np.flatnonzero(~self.meta.agent):
+                stateLog[names[m]].append(self.meta.states(m))
+
+            promotions = (~self.meta.agent) & (self.meta.infected() > parameters.promotionThreshold)
+            for m in np.flatnonzero(promotions):
+                self.promote(m, day)
+
+            timeUsed.append(time.time() - dayTime)
+            if parameters.printResults:
+                modelUtilities.printProgress(day, parameters.runDays, timeUsed, bar_length=50)
+
+        dailyR = {name: [np.nan]*parameters.runDays for name in names}
+        region = classes.DailyR(parameters.runDays)
+        for municipality in self.municipalities:
+            dailyR[municipality.name] = municipality.dailyR.estimate()
+            region.merge(municipality.dailyR)
+        dailyR[parameters.region] = region.estimate()
+
+        return stateLog, dailyR
+
@@ -12,11 +12,17 @@ from classes import *
 from parameters import *
 import modelFunctions
 import modelUtilities
+import arrayModel
 
 
 def initialiseModel(parameters):
     '''Create the layers and agents("attrs"). '''
     layers, attrs = modelFunctions.readModel(parameters)
+    parameters.calendar = Calendar()
+    parameters.calendar.attach(attrs.values())
+    parameters.counts = modelFunctions.attachCounter(attrs)
+    parameters.transmissionLog = TransmissionLog()
+    parameters.transmissionLog.setMunicipality(parameters.cityName)
     
     [n.generateActivity(parameters) for n in attrs.values()]
     
@@ -33,37 +39,36 @@ def seedState(attrs, parameters):
         n = int(len(attrs)*parameters.prevalence)
     
     for node in random.sample(list(attrs.values()), n):
-        node.state = 'E'
+        node.setState('E')
         node.lastDay = 0
-        node.infAnc = ['init', 'init', 'init']
+        parameters.transmissionLog.add(None, node, 'init', 0)
         node.virus = SARS_CoV_2()
         node.infDay = 0
-        node.nextDay = 1 + np.random.poisson(node.virus.duration['I-E'])
+        node.scheduleIncubation(0, parameters)
 
 
 def systemDay(layers, attrs, parameters, day):
     '''Daily pulse of the system.'''
-    cont = 0
-
     infectedList = {}
     dailyInfected = 0
     for layer in layers:
         infectedList[layer] = 0
 
         if (layers[layer].open) and (layers[layer].name not in ['R','C']): 
-            for clique in layers[layer]:
-                if clique.open & clique.cases > 0: 
+            for clique in layers[layer].activeCliques():
+                if clique.open: 
                     infs = cliqueDay(clique, layer, parameters, day)
                     infectedList[layer] += len(infs)
                     dailyInfected += len(infs)
     
-    infectedList['R'] = randomLayerSpread(layers['R'].cliques[0], parameters, day)
+    infectedList['R'] = randomLayerDay(layers['R'], parameters, day)
     dailyInfected += infectedList['R']
     
-    for node in attrs.values():
-        if node.sick or (node.state=='E'):
+    sampleExposed(parameters)
+    for node in parameters.calendar.pop(day):
+        if node.nextDay == day:
             node.stateFunction()(node.virus.probability, day)
-            cont = True
+    cont = bool(parameters.calendar)
 
     tests = 0
     if parameters.testRules:
@@ -72,6 +77,23 @@ def systemDay(layers, attrs, parameters, day):
     return cont, infectedList, dailyInfected
 
 
+def sampleExposed(parameters):
+    '''Samples the course of disease of all nodes exposed since the last 
+    call, as one batch. Only used with parameters.presample.'''
+    nodes = parameters.exposed
+    if not nodes:
+        return
+    parameters.exposed = []
+    
+    states, days = arrayModel.sampleTrajectories(
+        np.array([node.decade for node in nodes]), 
+        np.array([node.inNursing for node in nodes]),
+        np.array([node.lastDay for node in nodes]))
+    
+    for node, nodeStates, nodeDays in zip(nodes, states.tolist(), days.tolist()):
+        node.setTrajectory([(d, stateList[s]) for d, s in zip(nodeDays, nodeStates) if s >= 0])
+
+
 def cliqueDay(clique, layer, parameters, day):
     '''Runs infections over a day for a given clique'''
     susceptibleNodes, sickNodes = [], []
@@ -83,7 +105,7 @@ def cliqueDay(clique, layer, parameters, day):
             else:
                 if random.random() < 0.3:
                     susceptibleNodes.append(node)
-        if node.sick and node.present[layer]:
+        if node.sick and node.isPresent(layer):
             sickNodes.append(node)
     effP = 1
     for node in sickNodes:
@@ -105,7 +127,7 @@ def randomLayerSpread(clique, parameters, day):
     prevalence = 0
 
     for node in clique:
-        if node.sick and node.present['R']:
+        if node.sick and node.isPresent('R'):
             act = min(random.randint(0, node.activity), len(clique))
             if hasattr(node, 'municipality_commute'):
                 act = int(act/2)
@@ -116,7 +138,7 @@ def randomLayerSpread(clique, parameters, day):
     infs = 0         
     
     for node in clique:
-        if node.state=='S' and node.present['R']:
+        if node.state=='S' and node.isPresent('R'):
             act = min(random.randint(0, node.activity), len(clique))
             if hasattr(node, 'municipality_commute'):
                 act = int(act/2)
@@ -127,6 +149,32 @@ def randomLayerSpread(clique, parameters, day):
     return infs
 
 
+def randomLayerSpreadVectorized(layer, parameters, day):
+    '''Random layer spread with one batch of draws for the whole layer, 
+    through arrayModel.randomLayerKernel. Same distribution as 
+    randomLayerSpread, but the nodes are attached to the layer the first 
+    day, see Layer.attach, and keep its arrays up to date.'''
+    nodes = layer.cliques[0]
+    if layer.activity is None:
+        layer.attach(nodes)
+    
+    infected, ancestors = arrayModel.randomLayerKernel(
+        layer.activity, layer.commuter, layer.relInfectivity, layer.sick, layer.susceptible,
+        np.zeros(len(nodes), dtype=np.int64), np.array([len(nodes)]), 
+        parameters.p['inf']['dynR'])
+    
+    for i, j in zip(infected, ancestors):
+        nodes[i].infectNode(nodes[j], 'R', day, parameters)
+    return len(infected)
+
+
+def randomLayerDay(layer, parameters, day):
+    '''Random layer spread with the kernel chosen by parameters.randomLayer.'''
+    if parameters.randomLayer == 'vectorized':
+        return randomLayerSpreadVectorized(layer, parameters, day)
+    return randomLayerSpread(layer.cliques[0], parameters, day)
+
+
 def testing(layers, attrs, parameters, day):
     tests = 0
     testRules = parameters.testRules
@@ -163,7 +211,7 @@ def timedRun(attrs, layers, parameters, day):
     
         cont, linfs, dailyInfected = systemDay(layers, attrs, parameters, day)
 
-        states_ = modelFunctions.countStates(attrs, stateList)
+        states_ = modelFunctions.logStates(parameters.counts, attrs, parameters)
         # states_['T'] = tests
         stateLog.append(states_)
         infectedLog.append(dailyInfected)
@@ -190,7 +238,7 @@ def initRun(attrs, layers, parameters, threshold):
         
         cont, linfs, dailyInfected = systemDay(layers, attrs, parameters, day)
 
-        stateLog.append(modelFunctions.countState(attrs, stateList))
+        stateLog.append(modelFunctions.logStates(parameters.counts, attrs, parameters))
         if stateLog[-1]['Is'] > threshold:
             cont = False
             
@@ -219,8 +267,11 @@ def modelSummary(stateLog, infLog, infLogByLayer, parameters, attrs):
 
 
 def runModel(parameters):
+    if parameters.engine == 'arrays':
+        return arrayModel.runModel(parameters)
+    
     layers, attrs, parameters = modelSetup(parameters)
-    stateLog, infLog, infLogByLayer = timedRun(attrs, layers, parameters)
+    stateLog, infLog, infLogByLayer = timedRun(attrs, layers, parameters, parameters.startDay)
     modelSummary(stateLog, infLog, infLogByLayer, parameters, attrs)
     
     return stateLog, infLog, infLogByLayer
@@ -13,65 +13,88 @@ import numpy as np
 
 from parameters import *
 import classes
+import networkCache
 
 
 def readModel(parameters):
-    '''Builds household/school/work structure from file'''
-    ageFile = 'data/idAndAge_{}.txt'.format(parameters.cityName)
-    cliqueFile = 'data/socialNetwork_{}.txt'.format(parameters.cityName)
+    '''Builds household/school/work structure from file, or from its cache'''
+    network = networkCache.loadNetwork(*networkCache.cityFiles(parameters.cityName))
 
-    f = open(ageFile)
-    nodeID = -1
     attrs = {}
-
-    for line in f:
-        line = line.rstrip().split(';')
-        nodeID = line[0]
-        age = int(line[1])
-
-        node = classes.Person(nodeID, age)
-        attrs[nodeID] = node
-
-    f.close()
+    for nodeID, age in zip(network['ids'].tolist(), network['ages'].tolist()):
+        node = classes.Person(str(nodeID), age, index=len(attrs))
+        attrs[node.id_number] = node
+    nodes = list(attrs.values())
 
     layers = {'BH':{}, 'BS':{}, 'US':{}, 'VS':{}, 'W':{}, 'HH':{}, 'NH':{}, 'R':{}}
-    translations = {'Kindergarten': 'BH', 'PrimarySchool': 'BS', 'Household':'HH', 'SecondarySchool': 'US',
-                    'UpperSecondarySchool': 'VS', 'Workplace': 'W', 'NursingHome':'NH'}
 
     for layer in layers:
         layers[layer] = classes.Layer(layer)
 
+    for cliqueName, members, visitors in networkCache.cliques(network):
+        clique = classes.Clique()
 
-    f = open(cliqueFile)
-    for line in f:
-
-        splitLine = line.rstrip().split(';')
-
-        if (splitLine[1] != '') & (splitLine[0].split('_')[0] != 'Commuters'):
-            clique = classes.Clique()
-
-            for i in splitLine[1:]:
-                if i.isdigit():
-                    clique.nodes.append(attrs[i])
+        for i in members:
+            clique.addNode(nodes[i])
 
-            cliqueName = translations[splitLine[0]]
-            if cliqueName == 'NH':
-                for node in clique:
-                    if node.age > 70:
-                        node.inNursing = True
+        if cliqueName == 'NH':
+            for node in clique:
+                if node.age > 70:
+                    node.inNursing = True
 
-            layers[cliqueName].addClique(clique)
-
-    f.close()
+        layers[cliqueName].addClique(clique)
 
     for clique in layers['W'].cliques:
         clique.openRating = random.random()
 
     layers['R'].cliques = [list(attrs.values())]
 
+    indexNetwork(layers, network)
+
     return layers, attrs
 
 
+def indexNetwork(layers, network):
+    '''Sets the clique membership index of every clique layer from the 
+    arrays of a network, the same as indexCliques() gives before any 
+    commuters from other municipalities are added.'''
+    for layer in layers.values():
+        if layer.name not in ['R', 'C']:
+            offsets, members = networkCache.layerIndex(network, layer.name)
+            layer.setIndex(classes.CliqueIndex(offsets, members), len(network['ids']))
+
+
+def indexCliques(layers, attrs):
+    '''Builds the CSR clique membership index of every clique layer, using
+    node.index as the row of each person. Persons that are not in attrs,
+    like commuters from other municipalities, get rows after the residents.
+    Returns the list of all persons, ordered by row.'''
+    table = list(attrs.values())
+    visitors = {}
+    layerRows = {}
+
+    for layer in layers.values():
+        if layer.name in ['R', 'C']:
+            continue
+        layerRows[layer.name] = []
+        for clique in layer:
+            row = []
+            for node in clique:
+                i = node.index
+                if not (0 <= i < len(attrs) and table[i] is node):
+                    if id(node) not in visitors:
+                        visitors[id(node)] = len(table)
+                        table.append(node)
+                    i = visitors[id(node)]
+                row.append(i)
+            layerRows[layer.name].append(row)
+
+    for name, rows in layerRows.items():
+        layers[name].setIndex(classes.CliqueIndex.fromLists(rows), len(table))
+
+    return table
+
+
 def convertVector(inputVector):
     newVec = {}
     for layer in inputVector:
@@ -262,30 +285,23 @@ def genVaccPoolAllAboveAge(attrs, layers, age):
 
 def openAllGrades(school, attrs):
     for node in school:
-        node.present['VS'] = True
-        node.present['VS'] = True
-        node.present['BS'] = True
-        node.present['US'] = True
-        node.present['BH'] = True
+        node.setPresent(['VS', 'BS', 'US', 'BH'], True)
 
 
 def closeGradesAbove(school, age, attrs):
     for node in school.nodes:
         if node.age > age:
-            node.present['VS'] = False
-            node.present['BS'] = False
-            node.present['US'] = False
-            node.present['BH'] = False
+            node.setPresent(['VS', 'BS', 'US', 'BH'], False)
     for node in school:
         if node.age > 19:
             if age > 15:
-                node.present['VS'] = True
+                node.setPresent(['VS'], True)
             if age > 12:
-                node.present['US'] = True
+                node.setPresent(['US'], True)
             if age > 5:
-                node.present['BS'] = True
+                node.setPresent(['BS'], True)
             if age > 0:
-                node.present['BH'] = True
+                node.setPresent(['BH'], True)
 
 
 def workFrac(layers, frac):
@@ -305,37 +321,58 @@ def countStates(attrs, stateList):
     return count
 
 
-def getDailyR(attrs, runDays):
+def attachCounter(attrs):
+    '''Creates a state counter for attrs, kept up to date by Person.setState.'''
+    counts = countStates(attrs, stateList)
+    for node in attrs.values():
+        node.counts = counts
+    return counts
+
+
+def logStates(counts, attrs, parameters):
+    '''Snapshot of a state counter for the stateLog. With 
+    parameters.debugCounters, the counter is checked against a full recount.'''
+    if parameters.debugCounters:
+        recount = countStates(attrs, stateList)
+        if recount != counts:
+            raise RuntimeError(f'State counter out of sync: {counts} != {recount}')
+    return dict(counts)
+
+
+def getDailyR(attrs, runDays, log):
     """New version of daily R calculations, using actual descendants of recovered
     individuals instead."""
     
-    infsCaused = []
-    recDay = []
-    startDay =[]
-    for node in attrs.values():
-        if node.state == 'R':
-            infsCaused.append(len(node.infDesc))
-            recDay.append(node.lastDay)
-            startDay.append(node.infDay)
-    lastDay = runDays
-    infsByRecDay = [[] for i in range(lastDay)]
-    for i in range(len(recDay)):
-        for j in range(startDay[i], recDay[i]):
-            infsByRecDay[j].append(infsCaused[i])
-    avgRByDay = [np.nanmean(infsByRecDay[i]) for i in range(lastDay)]
+    offspring = log.offspring()
+    recovered = [node for node in attrs.values() if node.state == 'R' and node.uid >= 0]
+    infsCaused = offspring[[node.uid for node in recovered]]
+    recDay = np.array([node.lastDay for node in recovered], dtype=np.int64)
+    startDay = np.array([node.infDay for node in recovered], dtype=np.int64)
     
-    return avgRByDay
+    return dailyR(infsCaused, startDay, recDay, runDays)
 
 
-def createEdgeNetwork(attrs):
+def dailyR(infsCaused, startDay, recDay, runDays):
+    """Mean number of infections caused by the nodes infectious on each day, 
+    from startDay up to recDay, using difference arrays. Days without any 
+    such nodes are nan."""
+    
+    estimate = classes.DailyR(runDays)
+    estimate.addMany(infsCaused, startDay, recDay)
+    
+    return estimate.estimate()
+
+
+def createEdgeNetwork(log):
     """Creates a simple edge network of all infected nodes that has spread 
     the disease. Not used at the moment, but could be useful in the future."""
     
-    edges = ['ancestor','descendant','day','layer','municipality']
-    for node in attrs.values():
-        if len(node.infDesc) > 0:
-            for desc in node.infDesc:
-                edges.append(node.id_number, desc[0].id_number, 
-                             desc[2], desc[1], node.municipality)
+    edges = [['ancestor','descendant','day','layer','municipality']]
+    layerNames = list(layers)
+    ids = log.ids
+    for anc, desc, layer, day, municipality in zip(*(log[c].tolist() for c in log.columns)):
+        if anc >= 0:
+            edges.append([ids[anc], ids[desc], day, layerNames[layer], 
+                          log.municipalities[municipality]])
                 
     return edges
@@ -52,9 +52,11 @@ def printResults(stateLog, infLogByLayer, parameters, runtime):
         print(f'\nFinished {parameters.cityName} simulation in {runtime:.0f} seconds; {runtime/parameters.runDays:.1f} sec/day.\n')
 
 
-def profiler(function=model.main, filename='model', saveStats=True):
+def profiler(function=None, filename='model', saveStats=True):
     '''Profiling to benchmark the code'''
     import cProfile, pstats
+    if function is None:
+        function = model.main
     profiler = cProfile.Profile()
     profiler.enable()
     function()
@@ -69,6 +71,21 @@ def profiler(function=model.main, filename='model', saveStats=True):
         stats.dump_stats(f'{folder_path}/{filename}_profile')
 
 
+def memoryReport(cityName='Trondheim'):
+    '''Measures the memory used by the object model of a city, in bytes per agent.'''
+    import tracemalloc
+    tracemalloc.start()
+    layers, attrs = model.initialiseModel(Parameters(cityName=cityName))
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    perAgent = size / len(attrs)
+    print(f'{cityName}: {len(attrs)} agents, {size/1e6:.0f} MB in total, '
+          f'{perAgent:.0f} bytes per agent, peak {peak/1e6:.0f} MB.')
+    
+    return perAgent
+
+
 def saveModelResults(stateLog, infLogByLayer, parameters, *attrs):
     simulationName = f'{parameters.cityName[0]}-{parameters.runDays}D-{parameters.n}N'
     saveToCSV(stateLog, f'{simulationName}-states')
@@ -0,0 +1,299 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: nationalArrayModel.py
+
+Array version of the national model. All municipalities are read into one
+arrayModel.Population with a municipality id column, and one set of clique
+arrays per layer, so a day of the whole region is a single vectorized step.
+State logs and daily R per municipality are found by grouping on the
+municipality id.
+
+Commuters from municipalities that are not loaded are added after the
+residents, with the id of the municipality they commute to, and are not
+counted in the state log of any municipality.
+
+The linked network is the same for every run, and can be kept in a store
+with networkStore.py, which concurrent runs memory-map and share.
+
+"""
+
+import time
+import numpy as np
+
+from parameters import *
+import arrayModel
+import classes
+import modelFunctions
+import modelUtilities
+import nationalModelFunctions
+import networkCache
+import networkStore
+
+
+def readMunicipality(municipality, network=None):
+    '''Reads the age and clique files of a municipality, or their cache, 
+    unless the network is given. Returns the ids and ages, the cliques of 
+    every layer as lists of local indices, the commuters from other 
+    municipalities in each of these cliques as (home, index), and the 
+    commuter cliques as [destination, members].'''
+    if network is None:
+        network = networkCache.loadNetwork(*networkCache.municipalityFiles(municipality))
+    ids = [str(i) for i in network['ids'].tolist()]
+    ages = network['ages'].tolist()
+
+    cliqueLists = {layer: [] for layer in layers if layer != 'R'}
+    visitorLists = {layer: [] for layer in layers if layer != 'R'}
+    for layer, members, visitors in networkCache.cliques(network):
+        cliqueLists[layer].append(members)
+        visitorLists[layer].append(visitors)
+
+    commuters, groups = [], {}
+    for destination, members in networkCache.commuters(network):
+        group = groups.get(nationalModelFunctions.normalizeName(destination))
+        if group is None:
+            group = [destination, []]
+            commuters.append(group)
+            groups[nationalModelFunctions.normalizeName(destination)] = group
+        group[1].extend(members)
+
+    return ids, ages, cliqueLists, visitorLists, commuters
+
+
+def linkNational(municipalityList, parameters):
+    '''Reads all municipalities and links every commuter as in
+    nationalModelFunctions.linkCommuters. Returns the arrays of the linked
+    network, which are the same for every run:
+        names: the municipalities read
+        ids, ages: the residents, in the order of names
+        visitorIds, visitorHomes: commuters from municipalities that are not
+            loaded, added after the residents
+        municipality, commuter, inNursing: one row per agent
+        and for every layer, e.g. for W:
+        WOffsets, WMembers, WOwner, WMunicipality: the cliques as CSR, with
+            the clique of every entry and the municipality of every clique
+        WLinked: True for the entries of linked commuters
+        WNodeOffsets, WNodeCliques: the cliques of every agent'''
+    networks, failures = networkCache.loadNetworks(municipalityList, parameters)
+    networkCache.reportFailures(failures, parameters)
+    names = list(networks)
+    data = {name: readMunicipality(name, network) for name, network in networks.items()}
+
+    offsets = np.cumsum([0] + [len(data[name][0]) for name in names])
+    ages = [age for name in names for age in data[name][1]]
+    inNursing, commuter = [], []
+    for name, offset in zip(names, offsets):
+        members = np.array([i for clique in data[name][2]['NH'] for i in clique], dtype=np.int64)
+        inNursing.append(offset + members[np.array(data[name][1])[members] > 70] if len(members) else members)
+        commuter.extend(offset + i for group in data[name][4] for i in group[1])
+
+    index = nationalModelFunctions.CommuterIndex()
+    for name, offset in zip(names, offsets):
+        index.addMunicipality(name, [(destination, [offset + i for i in members])
+                                     for destination, members in data[name][4]])
+
+    cliqueLists = {layer: [] for layer in layers if layer != 'R'}
+    cliqueLinked = {layer: [] for layer in cliqueLists}
+    cliqueMunicipality = {layer: [] for layer in cliqueLists}
+    visitors = {'ids': [], 'municipality': [], 'homes': []}
+    for m, (name, offset) in enumerate(zip(names, offsets)):
+        for layer, cliques in data[name][2].items():
+            cliqueLists[layer].extend([offset + i for i in clique] for clique in cliques)
+            cliqueLinked[layer].extend([False]*len(clique) for clique in cliques)
+            cliqueMunicipality[layer].extend([m]*len(cliques))
+
+        for layer, cliques in data[name][3].items():
+            if layer == 'HH':
+                continue
+            first = len(cliqueLists[layer]) - len(cliques)
+            for c, cliqueVisitors in enumerate(cliques):
+                for home, i in cliqueVisitors:
+                    if index.isLoaded(home):
+                        node = index.commuter(home, name, i)
+                        if node is None:
+                            continue
+                    else:
+                        node = offsets[-1] + len(visitors['ids'])
+                        visitors['ids'].append(f'{i}_{name}')
+                        visitors['municipality'].append(m)
+                        visitors['homes'].append(home)
+                    cliqueLists[layer][first + c].append(node)
+                    cliqueLinked[layer][first + c].append(True)
+    index.report()
+    parameters.commuterFailures = index.failures()
+
+    n = offsets[-1] + len(visitors['ids'])
+    network = {
+        'names': np.array(names, dtype=str).reshape(-1),
+        'ids': np.concatenate([networks[name]['ids'] for name in names]).astype(np.int64),
+        'ages': np.array(ages, dtype=np.uint8),
+        'visitorIds': np.array(visitors['ids'], dtype=str).reshape(-1),
+        'visitorHomes': np.array(visitors['homes'], dtype=str).reshape(-1),
+        'municipality': np.concatenate([np.repeat(np.arange(len(names)), np.diff(offsets)),
+                                        visitors['municipality']]).astype(np.int16),
+        'commuter': np.zeros(n, dtype=bool),
+        'inNursing': np.zeros(n, dtype=bool),
+    }
+    network['commuter'][np.array(commuter, dtype=np.int64)] = True
+    network['commuter'][offsets[-1]:] = True
+    network['inNursing'][np.concatenate(inNursing).astype(np.int64)] = True
+
+    for layer, cliqueList in cliqueLists.items():
+        cliques = arrayModel.Cliques.fromLists(layer, cliqueList)
+        nodeCliques = cliques.transpose(n)
+        network[f'{layer}Offsets'], network[f'{layer}Members'] = cliques.offsets, cliques.members
+        network[f'{layer}Owner'] = cliques.owner
+        network[f'{layer}Municipality'] = np.array(cliqueMunicipality[layer], dtype=np.int16)
+        network[f'{layer}Linked'] = np.fromiter((linked for clique in cliqueLinked[layer] for linked in clique),
+                                                dtype=bool, count=len(cliques.members))
+        network[f'{layer}NodeOffsets'], network[f'{layer}NodeCliques'] = nodeCliques.offsets, nodeCliques.members
+
+    return network
+
+
+def buildNationalPopulation(municipalityList, parameters, network=None):
+    '''Builds the population and one set of clique arrays of all
+    municipalities, from the arrays of linkNational, which are read and
+    linked here if not given. Each linked commuter is kept with probability
+    commuterFraction. If all are kept, the clique arrays are those of the
+    network, so a network memory-mapped from networkStore is shared with
+    other runs, and only the states of the agents and cliques are new.
+    Commuters from municipalities that are not loaded, and are not kept,
+    are not commuters in this run.'''
+    if network is None:
+        network = linkNational(municipalityList, parameters)
+    names = network['names'].tolist()
+    residents = len(network['ages'])
+    ids = [str(i) for i in network['ids'].tolist()]
+    visitorIds, visitorHomes = network['visitorIds'].tolist(), network['visitorHomes'].tolist()
+    n = residents + len(visitorIds)
+    visitorAges = np.random.randint(20, 61, len(visitorIds))
+
+    population = arrayModel.Population(np.concatenate([network['ages'], visitorAges]), ids + visitorIds,
+                                       network['municipality'])
+    population.names = names
+    population.resident[residents:] = False
+    population.commuter[:] = network['commuter']
+    population.inNursing[:] = network['inNursing']
+    population.present[residents:] &= ~np.uint8(layerBits['R'])
+
+    log = population.log
+    offsets = np.searchsorted(network['municipality'][:residents], np.arange(len(names)+1))
+    for name, start, stop in zip(names, offsets[:-1], offsets[1:]):
+        log.setMunicipality(name)
+        log.register(ids[start:stop])
+    for nodeID, home in zip(visitorIds, visitorHomes):
+        log.setMunicipality(home)
+        log.register([nodeID])
+
+    cliques = {}
+    for layer in layers:
+        if layer == 'R':
+            continue
+        members, linked = network[f'{layer}Members'], network[f'{layer}Linked']
+        if parameters.commuterFraction >= 1:
+            cliques[layer] = arrayModel.Cliques(layer, network[f'{layer}Offsets'], members, network[f'{layer}Owner'])
+            cliques[layer].nodeCliques = classes.CliqueIndex(network[f'{layer}NodeOffsets'], network[f'{layer}NodeCliques'])
+        else:
+            kept = ~linked | (np.random.random(len(members)) < parameters.commuterFraction)
+            population.commuter[members[linked & ~kept & (members >= residents)]] = False
+            sizes = np.bincount(network[f'{layer}Owner'][kept], minlength=len(network[f'{layer}Offsets'])-1)
+            cliques[layer] = arrayModel.Cliques(layer, np.concatenate([[0], np.cumsum(sizes)]), members[kept])
+            cliques[layer].nodeCliques = cliques[layer].transpose(n)
+        cliques[layer].municipality = network[f'{layer}Municipality']
+    cliques['W'].openRating = np.random.random(len(cliques['W'])).astype(np.float32)
+
+    return population, cliques
+
+
+def sharedNetwork(region, parameters):
+    '''The linked network of a region, memory-mapped from its store, which
+    is written first if it is missing or older than the network files.'''
+    with networkStore.lock(region):
+        if not networkStore.isFresh(region, parameters.municipalityList):
+            networkStore.writeStore(region, linkNational(parameters.municipalityList, parameters),
+                                    parameters.loadFailures)
+    return networkStore.loadStore(region, parameters)
+
+
+def nationalModelSetup(parameters, region='trondelag'):
+    parameters.municipalityList = nationalModelFunctions.getMunicipalityList(region)
+    network = sharedNetwork(region, parameters) if parameters.store else None
+    population, cliques = buildNationalPopulation(parameters.municipalityList, parameters, network)
+    parameters.transmissionLog = population.log
+
+    arrayModel.generateActivity(population, parameters)
+    residents = np.flatnonzero(population.resident)
+    for m, name in enumerate(population.names):
+        if not parameters.seedMunicipality or name == parameters.seedMunicipality:
+            arrayModel.seedState(population, parameters, residents[population.municipality[residents] == m])
+
+    parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
+    parameters.p = modelFunctions.setInfectionProbabilities(
+        parameters.inputVector, SARS_CoV_2.probability, parameters)
+    arrayModel.setStrategy(cliques, population, parameters)
+    arrayModel.countCases(population, cliques)
+
+    return population, cliques, parameters
+
+
+def groups(population):
+    '''Municipality id of every resident, and one more for the rest.'''
+    return np.where(population.resident, population.municipality, len(population.names))
+
+
+def dailyCommuterSpread(population, parameters, day):
+    '''Infects susceptible commuters from municipalities that are not loaded,
+    each with probability commuter_prevalence, if parameters.commuterImports
+    is set.'''
+    if not parameters.commuterImports:
+        return 0
+    candidates = np.flatnonzero(population.commuter & ~population.resident & (population.state == arrayModel.S))
+    infected = candidates[np.random.random(len(candidates)) < parameters.commuter_prevalence]
+    arrayModel.infect(population, infected, -1, 'mun', day)
+    return len(infected)
+
+
+def fullRun(population, cliques, parameters):
+    '''Full run of the national model'''
+    parameters.validate('arrays')
+    names = population.names
+    stateLog = {name: [] for name in names}
+    timeUsed = []
+    cont = 1
+    day = 0
+
+    while cont and (day < parameters.runDays):
+        day += 1
+        dayTime = time.time()
+        cont, linfs, dailyInfected = arrayModel.systemDay(population, cliques, parameters, day)
+        dailyCommuterSpread(population, parameters, day)
+
+        rows = arrayModel.countStates(population, groups(population), len(names)+1)
+        for name, row in zip(names, rows):
+            stateLog[name].append(row)
+
+        timeUsed.append(time.time() - dayTime)
+        if parameters.printResults:
+            modelUtilities.printProgress(day, parameters.runDays, timeUsed, bar_length=50)
+
+    return stateLog, getDailyR(population, parameters)
+
+
+def getDailyR(population, parameters):
+    '''Daily R of every municipality and the whole region, from the recovered
+    residents.'''
+    offspring = population.log.offspring(len(population))
+    recovered = np.flatnonzero(population.resident & (population.state == arrayModel.R))
+    municipality = population.municipality[recovered]
+
+    dailyR = {}
+    for m, name in enumerate(population.names):
+        nodes = recovered[municipality == m]
+        dailyR[name] = modelFunctions.dailyR(offspring[nodes], population.infDay[nodes],
+                                             population.lastDay[nodes], parameters.runDays)
+    dailyR[parameters.region] = modelFunctions.dailyR(
+        offspring[recovered], population.infDay[recovered],
+        population.lastDay[recovered], parameters.runDays)
+
+    return dailyR
@@ -6,59 +6,91 @@ File: nationalModel.py
 This script contains the national model, building on model.py. 
 """
 
-import random
+import os
+import pickle
 import time
 import numpy as np
 
 from parameters import *
+import checkpoint
 import classes
+import lazyModel
 import model
 import modelFunctions
+import metapopulation
 import modelUtilities
+import nationalArrayModel
 import nationalModelFunctions
-
-
-def dailyCommuterSpread(attrs, day, parameters):
-    for node in attrs.values():
-        if hasattr(node, 'missingHome') and not node.sick:
-            if random.random() < parameters.commuter_prevalence:
-                infectCommuter(node, day, parameters)
+import parallelModel
+
+
+def dailyCommuterSpread(municipality, day, parameters, visitors=None):
+    '''Infects each susceptible commuter from a municipality that is not 
+    loaded, or each of the given visitors, with probability 
+    commuter_prevalence, if parameters.commuterImports is set. The number 
+    of draws is sampled at once, and the commuters drawn without 
+    replacement.'''
+    if not parameters.commuterImports:
+        return 0
+    if visitors is None:
+        visitors = municipality.visitors
+    n = np.random.binomial(len(visitors), parameters.commuter_prevalence)
+    infected = 0
+    for i in np.random.choice(len(visitors), n, replace=False).tolist():
+        if visitors[i].state == 'S':
+            infectCommuter(visitors[i], day, parameters)
+            infected += 1
+    return infected
 
 
 def infectCommuter(node, day, parameters):
-    node.state = 'E'
+    node.setState('E')
     node.lastDay = day
-    node.infAnc = ['mun', 'mun', day]
+    node.infDay = day
+    parameters.transmissionLog.add(None, node, 'mun', day)
     node.virus = SARS_CoV_2()
-    node.nextDay = 1 + np.random.poisson(node.virus.duration['I-E'])
+    node.scheduleIncubation(day, parameters)
 
 
 def municipalityDay(municipality, parameters, day):
-    cont = 0
-
+    municipality.dormant = municipality.isDormant()
+    if municipality.dormant:
+        return False, dict.fromkeys(municipality.layers, 0), 0
+    
+    parameters.transmissionLog.setMunicipality(municipality.name)
     infectedList = {}
     dailyInfected = 0
     for layer in municipality.layers:
         infectedList[layer] = 0
 
         if (municipality.layers[layer].open) and (municipality.layers[layer].name not in ['R','C']): 
-            for clique in municipality.layers[layer]:
-                if clique.open & clique.hasCases(): 
+            for clique in municipality.layers[layer].activeCliques():
+                if clique.open: 
                     infs = model.cliqueDay(clique, layer, parameters, day)
                     infectedList[layer] += len(infs)
                     dailyInfected += len(infs)
     
-    infectedList['R'] = model.randomLayerSpread(municipality.layers['R'].cliques[0], parameters, day)
+    infectedList['R'] = model.randomLayerDay(municipality.layers['R'], parameters, day)
     dailyInfected += infectedList['R']
     
-    for node in municipality.attrs.values():
-        if node.sick or (node.state=='E'):
+    model.sampleExposed(parameters)
+    for node in municipality.calendar.pop(day):
+        if node.nextDay == day:
             node.stateFunction()(node.virus.probability, day)
-            cont = True
+            if node.state == 'R' and not hasattr(node, 'missingHome'):
+                municipality.dailyR.add(node.offspring, node.infDay, node.lastDay)
+    cont = bool(municipality.calendar)
     
     return cont, infectedList, dailyInfected
 
 
+def logMunicipality(municipality, stateLog, parameters):
+    '''State counts of a municipality, copied from the day before if it was dormant.'''
+    if municipality.dormant and stateLog:
+        return dict(stateLog[-1])
+    return modelFunctions.logStates(municipality.counts, municipality.attrs, parameters)
+
+
 def testing(municipality, parameters, day):
     tests = 0
     testRules = parameters.testRules
@@ -92,6 +124,9 @@ def fullRun(municipalities, parameters):
     for municipality in municipalities:
         stateLog[municipality.name] = []
     
+    checkpoints = checkpoint.Checkpointer(municipalities, parameters)
+    stateLog, day = checkpoints.resume(stateLog, day)
+    
     while cont and (day < parameters.runDays):
         day += 1
         cont = 0
@@ -101,28 +136,23 @@ def fullRun(municipalities, parameters):
 
             if parameters.testRules:
                 tests = testing(municipality, parameters, day)
-            dailyCommuterSpread(municipality.attrs, day, parameters)
+            dailyCommuterSpread(municipality, day, parameters)
 
-            stateLog[municipality.name].append(modelFunctions.countStates(municipality.attrs, stateList))
+            stateLog[municipality.name].append(logMunicipality(municipality, stateLog[municipality.name], parameters))
             
             if cont_:
                 cont += 1
+        checkpoints.save(stateLog, day)
         timeUsed.append(time.time() - dayTime)
         if parameters.printResults:
             modelUtilities.printProgress(day, parameters.runDays, timeUsed, bar_length=50)
+    checkpoints.wait()
         
+    region = classes.DailyR(parameters.runDays)
     for municipality in municipalities:
-        try:
-            dailyR[municipality.name] = modelFunctions.getDailyR(municipality.attrs, parameters.runDays)
-        except (ValueError, TypeError) as e:
-            dailyR[municipality.name] = np.full([parameters.runDays-1,1], np.nan)
-    
-    attrs = {}
-    for municipality in municipalities:
-        for key, node in municipality.attrs.items():
-            attrs[key] = node
-    
-    dailyR[parameters.region] = modelFunctions.getDailyR(attrs, parameters.runDays)
+        dailyR[municipality.name] = municipality.dailyR.estimate()
+        region.merge(municipality.dailyR)
+    dailyR[parameters.region] = region.estimate()
     
     return stateLog, dailyR
 
@@ -149,7 +179,7 @@ def initRun(municipalities, parameters, treshold):
             if parameters.testRules:
                 tests = testing(municipality, parameters, day)
             
-            stateLog[municipality.name].append(modelFunctions.countStates(municipality.attrs, stateList))
+            stateLog[municipality.name].append(logMunicipality(municipality, stateLog[municipality.name], parameters))
             #infectedLog[municipality.name].append(dailyInfected)
             #infectedLogByLayer[municipality.name].append(linfs)
         
@@ -178,6 +208,9 @@ def timedRun(municipalities, parameters, day, runDays):
     cont = 1
     endDay = runDays + day
     
+    checkpoints = checkpoint.Checkpointer(municipalities, parameters)
+    stateLog, day = checkpoints.resume(stateLog, day)
+    
     while cont and (day < endDay):
         day += 1
         cont = 0
@@ -189,43 +222,91 @@ def timedRun(municipalities, parameters, day, runDays):
             if parameters.testRules:
                 tests = testing(municipality, parameters, day)
             
-            dailyCommuterSpread(municipality.attrs, day, parameters)
+            dailyCommuterSpread(municipality, day, parameters)
 
-            stateLog[municipality.name].append(modelFunctions.countStates(municipality.attrs, stateList))
+            stateLog[municipality.name].append(logMunicipality(municipality, stateLog[municipality.name], parameters))
             
             if cont_:
                 cont += 1
 
+        checkpoints.save(stateLog, day)
         timeUsed.append(time.time() - dayTime)
         if parameters.printResults:
             modelUtilities.printProgress(day, endDay, timeUsed, bar_length=30)
+    checkpoints.wait()
 
     return stateLog
 
 
+def takeSnapshot(municipalities, parameters):
+    '''Saves the mutable state of all municipalities and the length of the
+    transmission log, to branch several runs from the same point.'''
+    return {'municipalities': [m.snapshot() for m in municipalities],
+            'log': parameters.transmissionLog.snapshot()}
+
+
+def restoreSnapshot(municipalities, parameters, snapshot):
+    '''Restores the state saved by takeSnapshot(). The random generators 
+    are not restored, so branches draw different random numbers.'''
+    for municipality, state in zip(municipalities, snapshot['municipalities']):
+        municipality.restore(state)
+    parameters.transmissionLog.restore(snapshot['log'])
+
+
+def forkRun(function, *args):
+    '''Runs function(*args) in a forked child process, and returns its 
+    result. The child gets a copy-on-write copy of the whole model, so the 
+    state of the parent is left unchanged. Both random generators are 
+    reseeded in the child, so forks draw different random numbers.'''
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        np.random.seed()
+        try:
+            result = (True, function(*args))
+        except Exception as e:
+            result = (False, e)
+        with os.fdopen(write, 'wb') as f:
+            pickle.dump(result, f)
+        os._exit(0)
+
+    os.close(write)
+    with os.fdopen(read, 'rb') as f:
+        success, result = pickle.load(f)
+    os.waitpid(pid, 0)
+    if not success:
+        raise result
+    return result
+
+
 def municipalitySetup(layers, attrs, parameters, municipality):
     [n.generateActivity(parameters) for n in attrs.values()]
     for node in attrs.values():
         node.activity = min(node.activity, 100)
     
-    if not parameters.seedMunicipality or municipality == parameters.seedMunicipality:
+    municipality = classes.Municipality(municipality, layers, attrs, parameters.runDays)
+    parameters.transmissionLog.setMunicipality(municipality.name)
+    
+    if not parameters.seedMunicipality or municipality.name == parameters.seedMunicipality:
         model.seedState(attrs, parameters)
     
     modelFunctions.setStrategy(layers, attrs, parameters)
-        
-    municipality = classes.Municipality(municipality, layers, attrs)
 
     return municipality
 
 
 def nationalModelSetup(parameters, region='trondelag'):
     parameters.municipalityList = nationalModelFunctions.getMunicipalityList(region)
+    if parameters.checkpoint:
+        checkpoint.startSetup(parameters)
     nationalLayers, nationalAttrs = nationalModelFunctions.buildNationalLayers(parameters.municipalityList, parameters)
 
     parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
     parameters.p = modelFunctions.setInfectionProbabilities(
         parameters.inputVector, SARS_CoV_2.probability, parameters)
     
+    parameters.transmissionLog = classes.TransmissionLog()
     municipalities = []
     for (municipality, layers), attrs in zip(nationalLayers.items(), nationalAttrs.values()):
         municipality = municipalitySetup(layers, attrs, parameters, municipality)
@@ -235,8 +316,28 @@ def nationalModelSetup(parameters, region='trondelag'):
 
 
 def runNationalModel(parameters):
+    parameters.validate()
+    if parameters.engine == 'arrays':
+        population, cliques, parameters = nationalArrayModel.nationalModelSetup(parameters)
+        stateLog, dailyR = nationalArrayModel.fullRun(population, cliques, parameters)
+        modelUtilities.savePickle((stateLog, dailyR), 'latest_sim', folder='')
+        return stateLog, dailyR
+
+    if parameters.focus:
+        stateLog, dailyR = metapopulation.Hybrid(parameters).run()
+        modelUtilities.savePickle((stateLog, dailyR), 'latest_sim', folder='')
+        return stateLog, dailyR
+
+    if parameters.lazy:
+        stateLog, dailyR = lazyModel.LazyModel(parameters).run()
+        modelUtilities.savePickle((stateLog, dailyR), 'latest_sim', folder='')
+        return stateLog, dailyR
+
     municipalities, parameters = nationalModelSetup(parameters)
-    stateLog, dailyR = fullRun(municipalities, parameters)
+    if parameters.workers > 1:
+        stateLog, dailyR = parallelModel.fullRun(municipalities, parameters, parameters.workers)
+    else:
+        stateLog, dailyR = fullRun(municipalities, parameters)
     modelUtilities.savePickle((stateLog, dailyR), 'latest_sim', folder='')
     
     return stateLog, dailyR
@@ -7,136 +7,317 @@ This file contains model functions for the national model.
 """
 
 import random
-import re
+from collections import Counter
+import numpy as np
 from parameters import *
 import classes
+import modelFunctions
+import networkCache
 
 
-def readMunicipality(municipality):
-    '''Builds clique and commuter structure from file'''
-    folderPath = f'networkGeneration/output/{municipality}'
-    ageFile = f'{folderPath}/idAndAge_{municipality}_1.txt'
-    cliqueFile = f'{folderPath}/socialNetwork_{municipality}_1.txt'
+def normalizeName(name):
+    return name.replace(' ', '_').replace('-', '_').lower()
 
-    nodes = {}
-    layers = {'BH':{}, 'BS':{}, 'US':{}, 'VS':{}, 'W':{}, 'HH':{}, 'NH':{}, 'R':{}, 'C':{}}
-    for layer in layers:
-        layers[layer] = classes.Layer(layer)
 
-    translations = {'Kindergarten': 'BH', 'PrimarySchool': 'BS', 
-                    'Household': 'HH', 'SecondarySchool': 'US',
-                    'UpperSecondarySchool': 'VS', 'Workplace': 'W', 
-                    'NursingHome': 'NH', 'Commuters': 'C'}
+def commuterGraph(names):
+    '''Population and symmetric commuter matrix of the given municipalities,
+    from data/municipalities_data.csv and data/commuter_df.csv. Names missing
+    in the data get the mean population and no commuters.'''
+    import pandas as pd
+    data = pd.read_csv('data/municipalities_data.csv')
+    populations = dict(zip(data.municipality.map(normalizeName), data.population_model))
+    commuters = pd.read_csv('data/commuter_df.csv', index_col=0)
+    commuters.index = commuters.index.map(normalizeName)
+    commuters.columns = commuters.columns.map(normalizeName)
+    commuters = commuters.groupby(level=0).sum().T.groupby(level=0).sum().T
 
-    # Create nodes with ID and age
-    f = open(ageFile)
-    for line in f:
-        line = line.rstrip().split(';')
-        nodeID = line[0]
-        age = int(line[1])
-        nodes[nodeID] = classes.Person(nodeID, age)
-    f.close()
+    keys = [normalizeName(name) for name in names]
+    weights = np.array([populations.get(key, np.nan) for key in keys], dtype=float)
+    weights[np.isnan(weights)] = np.nanmean(weights) if not np.isnan(weights).all() else 1
+
+    known = [i for i, key in enumerate(keys) if key in commuters.index]
+    flows = np.zeros((len(names), len(names)))
+    if known:
+        matrix = commuters.loc[[keys[i] for i in known], [keys[i] for i in known]].to_numpy(dtype=float)
+        flows[np.ix_(known, known)] = matrix + matrix.T
+    np.fill_diagonal(flows, 0)
+    missing = [name for name, key in zip(names, keys) if key not in commuters.index]
+
+    return weights, flows, missing
+
+
+def matchName(key, keys, words):
+    '''The key of keys that a normalized name refers to: the name itself, or
+    else the one key that is a word prefix of it, or that it is a word prefix
+    of. words are the keys by their first word. Returns None if no key
+    matches, and the list of matches if more than one does.'''
+    if key in keys:
+        return key
+    matches = [k for k in words.get(key.split('_')[0], [])
+               if k.startswith(key + '_') or key.startswith(k + '_')]
+    if len(matches) == 1:
+        return matches[0]
+    return matches or None
+
+
+class CommuterIndex:
+    '''Commuter cliques of the loaded municipalities, by the normalized names
+    of home and destination. The network files name other municipalities by
+    their first word only, e.g. midtre for Midtre_Gauldal, so the names are
+    resolved with matchName, and every (home, destination) only once. Names
+    matching no key or more than one, and commuters beyond the end of their
+    clique, are counted by (home, destination) for report().'''
+
+    def __init__(self):
+        self.homes, self.homeWords = {}, {}
+        self.destinations, self.destinationWords = {}, {}
+        self.resolved = {}
+        self.unresolved, self.ambiguous, self.outOfRange = Counter(), Counter(), Counter()
+
+    def __repr__(self):
+        return f'CommuterIndex: {len(self.homes)} municipalities.'
+
+    def addMunicipality(self, home, commuters):
+        '''Adds the commuter cliques of a municipality, as (destination,
+        members).'''
+        key = normalizeName(home)
+        self.homes[key] = home
+        self.homeWords.setdefault(key.split('_')[0], []).append(key)
+        destinations, words = self.destinations.setdefault(key, {}), self.destinationWords.setdefault(key, {})
+        for destination, members in commuters:
+            destination = normalizeName(destination)
+            destinations[destination] = members
+            words.setdefault(destination.split('_')[0], []).append(destination)
+        self.resolved.clear()
+
+    def resolve(self, home, destination):
+        '''Keys of home and destination, as returned by matchName.'''
+        if (home, destination) not in self.resolved:
+            homeKey = matchName(normalizeName(home), self.homes, self.homeWords)
+            destinationKey = None
+            if isinstance(homeKey, str):
+                destinationKey = matchName(normalizeName(destination),
+                                           self.destinations[homeKey], self.destinationWords[homeKey])
+            self.resolved[(home, destination)] = homeKey, destinationKey
+        return self.resolved[(home, destination)]
+
+    def isLoaded(self, home):
+        '''True if home refers to a loaded municipality, or to more than one.'''
+        return self.resolve(home, '')[0] is not None
+
+    def name(self, home):
+        '''The loaded municipality home refers to, or None.'''
+        key = self.resolve(home, '')[0]
+        return self.homes[key] if isinstance(key, str) else None
+
+    def commuter(self, home, destination, i):
+        '''Commuter i from home to destination, or None if it cannot be found.'''
+        homeKey, destinationKey = self.resolve(home, destination)
+        if isinstance(homeKey, list) or isinstance(destinationKey, list):
+            self.ambiguous[(home, destination)] += 1
+            return None
+        if homeKey is None or destinationKey is None:
+            self.unresolved[(home, destination)] += 1
+            return None
+        members = self.destinations[homeKey][destinationKey]
+        if int(i) >= len(members):
+            self.outOfRange[(home, destination)] += 1
+            return None
+        return members[int(i)]
+
+    def failures(self):
+        return {'unresolved': dict(self.unresolved), 'ambiguous': dict(self.ambiguous),
+                'outOfRange': dict(self.outOfRange)}
+
+    def report(self):
+        '''Prints the commuters that could not be linked, by home and
+        destination.'''
+        for kind, counter in [('unresolved', self.unresolved), ('ambiguous', self.ambiguous),
+                              ('out of range', self.outOfRange)]:
+            for (home, destination), n in sorted(counter.items()):
+                print(f'{n} commuters from {home} to {destination} not linked: {kind}')
 
-    # Create cliques and fill them with nodes
-    f = open(cliqueFile)
-    for line in f:
-        splitLine = line.rstrip().split(';')
-
-        # Create commuter clique
-        if 'Commuters' in splitLine[0]:
-            municipalityCommute = splitLine[0].split('_',1)[1].capitalize()
-
-            cliques = next((c for c in layers['C'] if (c.commuteDestination in municipalityCommute)), None)
-            if cliques:
-                clique = cliques
-            else:
-                clique = classes.Clique(municipality)
-                clique.commuteDestination = municipalityCommute
-                layers['C'].addClique(clique)
-            for i in splitLine[1:]:
-                nodes[i] = classes.Commuter(nodes[i], municipality, municipalityCommute)
-                clique.nodes.append(nodes[i])
-
-        # Create regular clique
-        elif splitLine[1] != '':
-            cliqueName = translations[splitLine[0]]
-            clique = classes.Clique(municipality)
 
-            cliqueCommuters = []
+def readMunicipality(municipality, network=None):
+    '''Builds clique and commuter structure from file, or from its cache,
+    or from the arrays of networkCache.loadNetworks if given'''
+    if network is None:
+        network = networkCache.loadNetwork(*networkCache.municipalityFiles(municipality))
 
-            for i in splitLine[1:]:
-                if i.isdigit():
-                    clique.nodes.append(nodes[i])
-                else: # if the clique has commuters
-                    splitCommute = re.split('(\d+)',i)
-                    municipality_home = splitCommute[0].capitalize()
-                    nodeID = splitCommute[1]
-                    cliqueCommuters.append((municipality_home, municipality, nodeID))
-            if cliqueCommuters:
-                clique.cliqueCommuters = cliqueCommuters
+    ids = [str(i) for i in network['ids'].tolist()]
+    nodeList = [classes.Person(nodeID, age, index=i)
+                for i, (nodeID, age) in enumerate(zip(ids, network['ages'].tolist()))]
+    nodes = dict(zip(ids, nodeList))
+    layers = {'BH':{}, 'BS':{}, 'US':{}, 'VS':{}, 'W':{}, 'HH':{}, 'NH':{}, 'R':{}, 'C':{}}
+    for layer in layers:
+        layers[layer] = classes.Layer(layer)
 
-            if cliqueName == 'NH':
-                for node in clique:
-                    if node.age > 70:
-                        node.inNursing = True
+    # Create cliques and fill them with nodes
+    for cliqueName, members, visitors in networkCache.cliques(network):
+        clique = classes.Clique(municipality)
+        for i in members:
+            clique.addNode(nodeList[i])
+        if visitors:
+            clique.cliqueCommuters = [(home, municipality, nodeID) for home, nodeID in visitors]
+
+        if cliqueName == 'NH':
+            for node in clique:
+                if node.age > 70:
+                    node.inNursing = True
 
-            layers[cliqueName].addClique(clique)
+        layers[cliqueName].addClique(clique)
 
-    f.close()
+    # Create commuter cliques, one per destination
+    commuterCliques = {}
+    for municipalityCommute, members in networkCache.commuters(network):
+        clique = commuterCliques.get(normalizeName(municipalityCommute))
+        if clique is None:
+            clique = classes.Clique(municipality)
+            clique.commuteDestination = municipalityCommute
+            layers['C'].addClique(clique)
+            commuterCliques[normalizeName(municipalityCommute)] = clique
+        for i in members:
+            nodeList[i] = classes.Commuter(nodeList[i], municipality, municipalityCommute)
+            nodes[ids[i]] = nodeList[i]
+            clique.addNode(nodeList[i])
 
     for clique in layers['W'].cliques:
         clique.openRating = random.random()
 
     layers['R'].cliques = [list(nodes.values())]
 
+    modelFunctions.indexNetwork(layers, network)
+
     return layers, nodes
 
 
+def linkVisitors(layers, index, parameters):
+    '''Adds the commuters from other municipalities to the cliques of one
+    municipality, as the agents of their commuter clique if their home is in
+    the index, and as new agents if not.'''
+    for layer in layers.values():
+        if layer.name in ['C', 'HH', 'R']:
+            continue
+        for clique in layer:
+            for home, destination, i in getattr(clique, 'cliqueCommuters', []):
+                if random.random() >= parameters.commuterFraction:
+                    continue
+                if index.isLoaded(home):
+                    commuterNode = index.commuter(home, destination, i)
+                    if commuterNode is None:
+                        continue
+                else:
+                    commuterNode = classes.Commuter(classes.Person(
+                        f'{i}_{destination}', random.randint(20, 60)), home, destination)
+                    commuterNode.missingHome = True
+                clique.addNode(commuterNode)
+                layers['R'].cliques.append(commuterNode)
+                if commuterNode.sick and commuterNode.isPresent(clique.name):
+                    clique.addCases(1)
+            if hasattr(clique, 'cliqueCommuters'):
+                del clique.cliqueCommuters
+
+
+# attributes a commuter made by linkVisitors for a home that was not loaded
+# hands to its agent, with the state, presence and quarantine
+transferred = [name for name in classes.Person.mutable if name not in ['state', 'sick', 'present', 'quarantine']]
+
+
+def transferCommuter(node, agent, day):
+    '''Puts an agent in the cliques of the commuter made for it, or just
+    removes the commuter if there is no agent. An infected commuter hands
+    its state, course of disease, presence and quarantine to the agent,
+    if the agent is still susceptible.'''
+    sick = node.sick
+    node.setSick(False)
+    if agent is not None and node.state != 'S' and agent.state == 'S':
+        agent.setState(node.state)
+        for name in transferred:
+            setattr(agent, name, getattr(node, name))
+        for present in [False, True]:
+            agent.setPresent([layer for layer in layerBits if node.isPresent(layer) == present], present)
+        agent.quarantine = node.quarantine
+        if agent.nextDay > day:
+            agent.calendar.push(agent, agent.nextDay)
+        agent.setSick(sick)
+        agent.updateResidentLayer()
+    node.nextDay = -1
+    node.calendar = None
+    for clique in node.cliques:
+        if agent is None:
+            clique.nodes.remove(node)
+            continue
+        clique.nodes[clique.nodes.index(node)] = agent
+        agent.cliques.append(clique)
+        if agent.sick and agent.isPresent(clique.name):
+            clique.addCases(1)
+
+
+def replaceVisitors(municipalities, home, index, day, parameters):
+    '''Replaces the commuters from home in the loaded municipalities, which
+    linkVisitors made while home was not loaded, with the agents of home in
+    the index, through transferCommuter. Commuters that linkVisitors would
+    not have linked are removed. The municipalities with replaced commuters
+    are indexed again, and the replaced commuters waiting in
+    parameters.exposed are swapped for their agents, or dropped if they
+    were removed.'''
+    replaced = {}
+    for municipality in municipalities:
+        residents = municipality.layers['R'].cliques
+        kept = residents[:1]
+        found = False
+        for node in residents[1:]:
+            if not hasattr(node, 'missingHome') or index.name(node.municipality_home) != home:
+                kept.append(node)
+                continue
+            agent = index.commuter(home, node.municipality_commute, node.id_number.split('_')[0])
+            transferCommuter(node, agent, day)
+            if agent is not None:
+                kept.append(agent)
+            replaced[node] = agent
+            found = True
+        if found:
+            residents[:] = kept
+            municipality.layers['R'].activity = None
+            municipality.findVisitors()
+            modelFunctions.indexCliques(municipality.layers, municipality.attrs)
+    if replaced and parameters.exposed:
+        exposed = [replaced.get(node, node) for node in parameters.exposed]
+        parameters.exposed = [node for node in exposed if node is not None]
+
+
 def linkCommuters(nationalLayers, nationalAttrs, parameters):
-    indexfails, destinationfails = set(), set()
-    
-    for municipality in nationalLayers:
-        for layer in nationalLayers[municipality].values():
-            if layer.name not in ['C','HH','R']:
-                for clique in layer:
-                    if hasattr(clique, 'cliqueCommuters'):
-                        for commuter in clique.cliqueCommuters:
-                            if random.random() < parameters.commuterFraction:
-                                home, destination, i = commuter
-                                if home in nationalLayers.keys():
-                                    try:
-                                        commuterClique = next(c for c in nationalLayers[home]['C'] if (
-                                            c.commuteDestination in destination))
-                                        commuterNode = commuterClique[int(i)]
-                                    except StopIteration:
-                                        destinationfails.add(destination)
-                                    except IndexError:
-                                        indexfails.add((municipality,home))
-                                else:
-                                    commuterNode = classes.Commuter(classes.Person(
-                                        i, random.randint(20, 60)), home, destination)
-                                    commuterNode.missingHome = True
-                                clique.nodes.append(commuterNode)
-                                nationalLayers[destination]['R'].cliques.append(commuterNode)
-                        del clique.cliqueCommuters
+    '''Links the commuters between all municipalities with linkVisitors.
+    Commuters that cannot be found are reported, and kept in
+    parameters.commuterFailures.'''
+    index = CommuterIndex()
+    for municipality, layers in nationalLayers.items():
+        index.addMunicipality(municipality, [(c.commuteDestination, c) for c in layers['C']])
+    for layers in nationalLayers.values():
+        linkVisitors(layers, index, parameters)
+    index.report()
+    parameters.commuterFailures = index.failures()
     
     for municipality in nationalLayers:
+        for clique in nationalLayers[municipality]['C']:
+            for node in clique:
+                node.cliques.remove(clique)
         del nationalLayers[municipality]['C']
+        modelFunctions.indexCliques(nationalLayers[municipality], nationalAttrs[municipality])
     
     return nationalLayers, nationalAttrs
 
 
 def buildNationalLayers(municipalityList, parameters):
+    '''Reads all municipalities, with the files read in parallel, and links
+    the commuters between them. Municipalities that cannot be read are left
+    out, and reported.'''
     nationalLayers, nationalNodes = {}, {}
-    fails = []
-    
-    for municipality in municipalityList:
-        try:
-            layers, nodes = readMunicipality(municipality)
-            nationalLayers[municipality] = layers
-            nationalNodes[municipality] = nodes
-        except Exception:
-            fails.append(municipality)
+    networks, failures = networkCache.loadNetworks(municipalityList, parameters)
+    networkCache.reportFailures(failures, parameters)
+
+    for municipality, network in networks.items():
+        nationalLayers[municipality], nationalNodes[municipality] = readMunicipality(municipality, network)
 
     nationalLayers, nationalNodes = linkCommuters(nationalLayers, nationalNodes, parameters)
 
@@ -165,24 +346,20 @@ def getMunicipalityList(region=None):
     return municipalityList
 
 
-def createEdgeNetwork(municipalities, filename):
+def createEdgeNetwork(log, filename):
     import pandas as pd
     
-    edges = []
-    for municipality in municipalities:
-        for node in municipality.attrs.values():
-            if len(node.infDesc) > 0:
-                for desc in node.infDesc:
-                    if isinstance(desc[0], classes.Commuter):
-                        municipality_2 = desc[0].municipality_home
-                    else:
-                        municipality_2 = municipality.name
-                    edges.append([node.id_number, desc[0].id_number, municipality.name, municipality_2,
-                                 desc[2], desc[1]])
+    ancestors, descendants = log['ancestor'], log['descendant']
+    spread = ancestors >= 0
+    ancestors, descendants = ancestors[spread], descendants[spread]
+    ids, homes = np.array(log.ids, dtype=object), np.array(log.homes)
+    municipalityNames = np.array(log.municipalities, dtype=object)
+    edges = {'ancestor': ids[ancestors], 'anc_home': municipalityNames[homes[ancestors]],
+             'descendant': ids[descendants], 'desc_home': municipalityNames[homes[descendants]],
+             'day': log['day'][spread], 'layer': np.array(list(layers))[log['layer'][spread]]}
     
     filename = filename.replace('StateLog','edges').replace('.pkl','').split("/")[-1]
-    df = pd.DataFrame(edges, index=None, columns=[
-                      'ancestor', 'anc_home', 'descendant', 'desc_home', 'day', 'layer'])
+    df = pd.DataFrame(edges)
     df.to_csv(f'./results/networks/{filename}.csv')
  
 
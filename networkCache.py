@@ -0,0 +1,244 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: networkCache.py
+
+Binary cache of the network files. The age and clique files of a
+municipality are parsed once into NumPy arrays, which are saved as .npy
+files in a folder next to the text files, e.g.
+networkGeneration/output/Trondheim/network_Trondheim_1/. The readers of the
+models load the arrays with loadNetwork(), memory-mapped from the cache if
+it is newer than the text files, or parsed from the text files if not, and
+build their persons and cliques from the arrays.
+
+The arrays of a network are:
+    ids, ages: one row per person, in the order of the age file
+    cliqueLayer: layer code of every clique, in the order of the clique file
+    cliqueOffsets, cliqueMembers: the local index of the members, as CSR
+    visitorOffsets, visitorHomes, visitorIndex: commuters from other
+        municipalities in every clique, as an index into homes, and their
+        number in the commuter clique of their home
+    homes: home municipalities of the visitors
+    commuterDestinations, commuterOffsets, commuterMembers: one row per
+        commuter line, with the destination and the local index of members
+
+Run this file to convert all municipalities of a region:
+    python networkCache.py trondelag
+
+"""
+
+import multiprocessing as mp
+import os
+import re
+import shutil
+import sys
+import time
+import numpy as np
+
+from parameters import *
+
+
+translations = {'Kindergarten': 'BH', 'PrimarySchool': 'BS', 'Household': 'HH',
+                'SecondarySchool': 'US', 'UpperSecondarySchool': 'VS',
+                'Workplace': 'W', 'NursingHome': 'NH'}
+
+
+def municipalityFiles(municipality):
+    folderPath = f'networkGeneration/output/{municipality}'
+    return f'{folderPath}/idAndAge_{municipality}_1.txt', f'{folderPath}/socialNetwork_{municipality}_1.txt'
+
+
+def cityFiles(cityName):
+    return f'data/idAndAge_{cityName}.txt', f'data/socialNetwork_{cityName}.txt'
+
+
+def cacheFolder(ageFile):
+    folder, name = os.path.split(ageFile)
+    return os.path.join(folder, name.replace('idAndAge_', 'network_').replace('.txt', ''))
+
+
+def readText(ageFile, cliqueFile):
+    '''Parses the age and clique files into the arrays of a network.'''
+    ids, ages = [], []
+    with open(ageFile) as f:
+        for line in f:
+            line = line.rstrip().split(';')
+            ids.append(line[0])
+            ages.append(int(line[1]))
+    index = {nodeID: i for i, nodeID in enumerate(ids)}
+
+    cliqueLayer, cliqueSizes, cliqueMembers = [], [], []
+    visitorSizes, visitorHomes, visitorIndex = [], [], []
+    commuterDestinations, commuterSizes, commuterMembers = [], [], []
+    homes = {}
+    with open(cliqueFile) as f:
+        for line in f:
+            splitLine = line.rstrip().split(';')
+            if 'Commuters' in splitLine[0]:
+                members = [index[i] for i in splitLine[1:]]
+                commuterDestinations.append(splitLine[0].split('_', 1)[1].capitalize())
+                commuterSizes.append(len(members))
+                commuterMembers.extend(members)
+
+            elif splitLine[1] != '':
+                members, visitors = [], 0
+                for i in splitLine[1:]:
+                    if i.isdigit():
+                        members.append(index[i])
+                    else:
+                        splitCommute = re.split(r'(\d+)', i)
+                        home = splitCommute[0].capitalize()
+                        visitorHomes.append(homes.setdefault(home, len(homes)))
+                        visitorIndex.append(int(splitCommute[1]))
+                        visitors += 1
+                cliqueLayer.append(layerCodes[translations[splitLine[0]]])
+                cliqueSizes.append(len(members))
+                cliqueMembers.extend(members)
+                visitorSizes.append(visitors)
+
+    numbers = np.array(ids, dtype=np.int64)
+    if [str(i) for i in numbers.tolist()] != ids:
+        raise ValueError(f'{ageFile} has ids that are not plain integers.')
+
+    return {
+        'ids': numbers,
+        'ages': np.array(ages, dtype=np.int16),
+        'cliqueLayer': np.array(cliqueLayer, dtype=np.int8),
+        'cliqueOffsets': np.cumsum([0] + cliqueSizes, dtype=np.int64),
+        'cliqueMembers': np.array(cliqueMembers, dtype=np.int32),
+        'visitorOffsets': np.cumsum([0] + visitorSizes, dtype=np.int64),
+        'visitorHomes': np.array(visitorHomes, dtype=np.int16),
+        'visitorIndex': np.array(visitorIndex, dtype=np.int32),
+        'homes': np.array(list(homes), dtype=str).reshape(-1),
+        'commuterDestinations': np.array(commuterDestinations, dtype=str).reshape(-1),
+        'commuterOffsets': np.cumsum([0] + commuterSizes, dtype=np.int64),
+        'commuterMembers': np.array(commuterMembers, dtype=np.int32),
+    }
+
+
+def isFresh(ageFile, cliqueFile):
+    '''True if the cache of the files exists, and is newer than both.'''
+    marker = os.path.join(cacheFolder(ageFile), 'ids.npy')
+    if not os.path.isfile(marker):
+        return False
+    return os.path.getmtime(marker) >= max(os.path.getmtime(ageFile), os.path.getmtime(cliqueFile))
+
+
+def writeCache(ageFile, cliqueFile):
+    '''Parses the text files and writes their cache. The arrays are written
+    to a temporary folder first, and ids.npy last, so a cache that was not
+    completely written is never loaded.'''
+    network = readText(ageFile, cliqueFile)
+    folder = cacheFolder(ageFile)
+    temporary = f'{folder}.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, array in network.items():
+        if name != 'ids':
+            np.save(os.path.join(temporary, f'{name}.npy'), array)
+    np.save(os.path.join(temporary, 'ids.npy'), network['ids'])
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(temporary, folder)
+    return network
+
+
+def loadNetwork(ageFile, cliqueFile):
+    '''The arrays of a network, memory-mapped from the cache if it is fresh,
+    and parsed from the text files if not.'''
+    if isFresh(ageFile, cliqueFile):
+        folder = cacheFolder(ageFile)
+        return {name[:-4]: np.load(os.path.join(folder, name), mmap_mode='r')
+                for name in os.listdir(folder) if name.endswith('.npy')}
+    return readText(ageFile, cliqueFile)
+
+
+def readNetwork(municipality):
+    '''Worker of loadNetworks. Returns the name, and the network or the error
+    that stopped it from being read.'''
+    try:
+        return municipality, loadNetwork(*municipalityFiles(municipality)), None
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        return municipality, None, e
+
+
+def loadNetworks(municipalityList, parameters):
+    '''The networks of all municipalities that can be read, in the order of
+    the list, and the error of every municipality that cannot. Fresh caches
+    are memory-mapped here, and the text files of the others are parsed on a
+    process pool of parameters.loadWorkers processes, or one per CPU if it is
+    0. The workers return the arrays only, so they are cheap to send back.'''
+    fresh, stale = [], []
+    for municipality in municipalityList:
+        try:
+            (fresh if isFresh(*municipalityFiles(municipality)) else stale).append(municipality)
+        except OSError:
+            stale.append(municipality)
+
+    results = [readNetwork(municipality) for municipality in fresh]
+    workers = min(parameters.loadWorkers or mp.cpu_count(), len(stale))
+    if workers > 1:
+        with mp.get_context('fork').Pool(workers) as pool:
+            results.extend(pool.imap_unordered(readNetwork, stale))
+    else:
+        results.extend(readNetwork(municipality) for municipality in stale)
+
+    found = {municipality: (network, error) for municipality, network, error in results}
+    networks = {m: found[m][0] for m in municipalityList if found[m][1] is None}
+    failures = {m: found[m][1] for m in municipalityList if found[m][1] is not None}
+    return networks, failures
+
+
+def reportFailures(failures, parameters):
+    '''Prints the municipalities that could not be read, and keeps them in
+    parameters.loadFailures.'''
+    parameters.loadFailures.update(failures)
+    for municipality, error in failures.items():
+        print(f'{municipality} not loaded: {error!r}')
+
+
+def cliques(network):
+    '''Layer, members and visitors of every clique, in file order, with the
+    visitors as (home, number).'''
+    layerNames = list(layers)
+    cliqueOffsets = network['cliqueOffsets'].tolist()
+    members = network['cliqueMembers'].tolist()
+    visitorOffsets = network['visitorOffsets'].tolist()
+    homes = network['homes'].tolist()
+    visitors = list(zip([homes[h] for h in network['visitorHomes'].tolist()],
+                        [str(i) for i in network['visitorIndex'].tolist()]))
+    for c, layer in enumerate(network['cliqueLayer'].tolist()):
+        yield (layerNames[layer], members[cliqueOffsets[c]:cliqueOffsets[c+1]],
+               visitors[visitorOffsets[c]:visitorOffsets[c+1]])
+
+
+def layerIndex(network, layer):
+    '''Offsets and members of the cliques of one layer, as CSR arrays.'''
+    offsets = np.asarray(network['cliqueOffsets'])
+    sizes = np.diff(offsets)
+    selected = np.asarray(network['cliqueLayer']) == layerCodes[layer]
+    members = np.asarray(network['cliqueMembers'])[np.repeat(selected, sizes)]
+    return np.cumsum(np.concatenate([[0], sizes[selected]])), members
+
+
+def commuters(network):
+    '''Destination and members of every commuter line, in file order.'''
+    offsets = network['commuterOffsets'].tolist()
+    members = network['commuterMembers'].tolist()
+    for c, destination in enumerate(network['commuterDestinations'].tolist()):
+        yield destination, members[offsets[c]:offsets[c+1]]
+
+
+def main():
+    import nationalModelFunctions
+    region = sys.argv[1] if len(sys.argv) > 1 else 'trondelag'
+    for municipality in nationalModelFunctions.getMunicipalityList(region):
+        start = time.time()
+        try:
+            writeCache(*municipalityFiles(municipality))
+            print(f'{municipality}: {time.time() - start:.2f} s')
+        except (OSError, ValueError, KeyError) as e:
+            print(f'{municipality}: failed, {e!r}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: networkStore.py
+
+Shared store of the linked network of a region, for concurrent runs of the
+array engine. The network is read and linked once, by
+nationalArrayModel.linkNational, and its arrays are saved as .npy files in
+data/store_<region>/. Runs with store=True memory-map them read-only, so the
+ages, clique arrays and commuters are kept once in the page cache and shared
+by all runs on a node, and each run only holds the states of its agents and
+cliques, and its transmission log.
+
+The store is written by the first run that finds it missing or older than
+the network files of the region, while the others wait for it. run.sh writes
+it before starting the runs:
+    python networkStore.py trondelag
+
+"""
+
+import contextlib
+import fcntl
+import os
+import shutil
+import sys
+import time
+import numpy as np
+
+from parameters import *
+import networkCache
+
+
+def storeFolder(region):
+    return f'data/store_{region}'
+
+
+@contextlib.contextmanager
+def lock(region):
+    '''Holds the lock of a store, so only one process writes it.'''
+    os.makedirs('data', exist_ok=True)
+    with open(f'{storeFolder(region)}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def isFresh(region, municipalityList):
+    '''True if the store exists, and is newer than the network files and
+    caches of all municipalities of the list.'''
+    marker = os.path.join(storeFolder(region), 'names.npy')
+    if not os.path.isfile(marker):
+        return False
+    files = [f for m in municipalityList for f in networkCache.municipalityFiles(m)]
+    files += [os.path.join(networkCache.cacheFolder(f), 'ids.npy') for f in files[::2]]
+    newest = max((os.path.getmtime(f) for f in files if os.path.isfile(f)), default=0)
+    return os.path.getmtime(marker) >= newest
+
+
+def writeStore(region, network, loadFailures):
+    '''Writes the arrays of a linked network, and the municipalities that
+    could not be read, as the store of a region. As in
+    networkCache.writeCache, names.npy is written last to a temporary folder.'''
+    folder = storeFolder(region)
+    temporary = f'{folder}.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    network = dict(network, failed=np.array(list(loadFailures), dtype=str).reshape(-1),
+                   errors=np.array([repr(e) for e in loadFailures.values()], dtype=str).reshape(-1))
+    for name, array in network.items():
+        if name != 'names':
+            np.save(os.path.join(temporary, f'{name}.npy'), array)
+    np.save(os.path.join(temporary, 'names.npy'), network['names'])
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(temporary, folder)
+
+
+def loadStore(region, parameters):
+    '''The arrays of the store of a region, memory-mapped read-only. The
+    municipalities that could not be read are added to
+    parameters.loadFailures.'''
+    folder = storeFolder(region)
+    network = {name[:-4]: np.load(os.path.join(folder, name), mmap_mode='r')
+               for name in os.listdir(folder) if name.endswith('.npy')}
+    parameters.loadFailures.update(zip(network.pop('failed').tolist(), network.pop('errors').tolist()))
+    return network
+
+
+def main():
+    import nationalArrayModel
+    import nationalModelFunctions
+    region = sys.argv[1] if len(sys.argv) > 1 else 'trondelag'
+    parameters = Parameters(region=region)
+    parameters.municipalityList = nationalModelFunctions.getMunicipalityList(region)
+    start = time.time()
+    with lock(region):
+        network = nationalArrayModel.linkNational(parameters.municipalityList, parameters)
+        writeStore(region, network, parameters.loadFailures)
+    size = sum(array.nbytes for array in network.values())
+    print(f'{storeFolder(region)}: {len(network["names"])} municipalities, '
+          f'{size/2**20:.0f} MB in {time.time() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
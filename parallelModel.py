@@ -0,0 +1,417 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: parallelModel.py
+
+Parallel version of the national model. The municipalities are split in
+partitions, each stepped by its own worker process, which keeps its
+municipalities for the whole run.
+
+Municipalities only interact through commuters, so a commuter with home and
+destination in different partitions is stepped by the worker of its home
+municipality, and kept as a ghost in the worker of its destination. At the
+end of every day, the workers exchange the state of these commuters, and
+the infections of ghosts, which are carried out by the home worker.
+
+"""
+
+import random
+import time
+import multiprocessing as mp
+import numpy as np
+
+from parameters import *
+import classes
+import modelFunctions
+import modelUtilities
+import nationalModel
+import nationalModelFunctions
+
+
+def growPartitions(weights, flows, workers):
+    '''Greedy growth: each partition starts from the largest free municipality,
+    and takes the free municipality with the most commuters to it until it
+    has its share of the population.'''
+    n = len(weights)
+    labels = np.full(n, -1)
+    target = weights.sum() / workers
+    for part in range(workers):
+        free = labels < 0
+        if not free.any():
+            break
+        if part == workers - 1:
+            labels[free] = part
+            break
+        labels[np.flatnonzero(free)[np.argmax(weights[free])]] = part
+        load = weights[labels == part].sum()
+        while load < target:
+            free = np.flatnonzero(labels < 0)
+            if not len(free):
+                break
+            connection = flows[np.ix_(free, np.flatnonzero(labels == part))].sum(axis=1)
+            candidate = free[np.lexsort((-weights[free], -connection))[0]]
+            if load + weights[candidate] - target > target - load:
+                break
+            labels[candidate] = part
+            load += weights[candidate]
+
+    return labels
+
+
+def refinePartitions(labels, weights, flows, workers, tolerance=0.05, passes=20):
+    '''Moves single municipalities to the partition they have the most 
+    commuters to, as long as this lowers the cut and keeps every partition
+    within the tolerance of its share, or does not increase the largest load.'''
+    limit = weights.sum() / workers * (1 + tolerance)
+    loads = np.bincount(labels, weights, workers)
+    for _ in range(passes):
+        moved = False
+        for i in np.argsort(-weights):
+            connection = np.bincount(labels, flows[i], workers)
+            gains = connection - connection[labels[i]]
+            for part in np.argsort(-gains):
+                if gains[part] <= 0:
+                    break
+                newLoad = loads[part] + weights[i]
+                if newLoad <= max(limit, loads[labels[i]]):
+                    loads[labels[i]] -= weights[i]
+                    loads[part] += weights[i]
+                    labels[i] = part
+                    moved = True
+                    break
+        if not moved:
+            break
+
+    return labels
+
+
+def partitionReport(labels, weights, flows, workers):
+    '''Load imbalance (largest load over the mean load, minus one), and the
+    number of commuters crossing between partitions, in total and as a
+    fraction of all commuters.'''
+    loads = np.bincount(labels, weights, workers)
+    cut = flows[labels[:, None] != labels[None, :]].sum() / 2
+    total = flows.sum() / 2
+    return {'imbalance': loads.max() / loads.mean() - 1, 'cut': cut,
+            'cutFraction': cut / total if total else 0.0, 'loads': loads.tolist()}
+
+
+def partition(names, workers, region=None, folder='./data/partitions'):
+    '''Splits the municipalities in balanced partitions with few commuters
+    between them. Returns a list of municipality names per partition, and the
+    report of the partitioning. Results are cached per region and number
+    of workers.'''
+    import os
+    import pickle
+    workers = max(1, min(workers, len(names)))
+    filename = f'{folder}/{region}_{workers}.pkl'
+    if region and os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            cachedNames, partitions, report = pickle.load(f)
+        if cachedNames == list(names):
+            return partitions, report
+
+    weights, flows, missing = nationalModelFunctions.commuterGraph(names)
+    labels = growPartitions(weights, flows, workers)
+    labels = refinePartitions(labels, weights, flows, workers)
+    partitions = [[name for name, label in zip(names, labels) if label == part] for part in range(workers)]
+    partitions = [p for p in partitions if p]
+    report = partitionReport(labels, weights, flows, workers)
+    report['missing'] = missing
+
+    if region:
+        os.makedirs(folder, exist_ok=True)
+        with open(filename, 'wb') as f:
+            pickle.dump((list(names), partitions, report), f)
+
+    return partitions, report
+
+
+def nodeKey(node):
+    return node.id_number, node.municipality_home
+
+
+def findVisitors(municipalities):
+    '''Commuters of each municipality with their home in another of the given
+    municipalities.'''
+    names = {m.name for m in municipalities}
+    visitors = {}
+    for municipality in municipalities:
+        visitors[municipality.name] = [
+            node for node in municipality.layers['R']
+            if isinstance(node, classes.Commuter) and not hasattr(node, 'missingHome')
+            and node.municipality_home != municipality.name
+            and node.municipality_home in names]
+
+    return visitors
+
+
+def snapshot(node):
+    return node.state, node.sick, node.present, getattr(node, 'relInfectivity', 0)
+
+
+def updateGhost(node, update):
+    '''Sets the state of a ghost to that of the commuter in its home worker.
+    A ghost infected today is not set back to S.'''
+    state, sick, present, relInfectivity = update
+    if state == 'S' and node.state != 'S':
+        return
+    if state != node.state:
+        node.setState(state)
+        node.virus = SARS_CoV_2()
+    node.setInfectivity(relInfectivity)
+    changed = present ^ node.present
+    node.setPresent([l for l, bit in layerBits.items() if changed & bit & present], True)
+    node.setPresent([l for l, bit in layerBits.items() if changed & bit & ~present], False)
+    node.setSick(sick)
+
+
+def infectRemote(node, infection, parameters):
+    '''Infects a commuter, from an infection of its ghost in another worker.'''
+    day, layer, destination, ancestor = infection
+    if node.state != 'S':
+        return
+    node.setState('E')
+    node.lastDay = day
+    node.infDay = day
+    node.virus = SARS_CoV_2()
+
+    log = parameters.transmissionLog
+    home = log.municipality
+    log.setMunicipality(destination)
+    anc = -1 if ancestor is None else log.foreignUid(*ancestor)
+    log.addMany([anc], [log.uid(node)], layer, day)
+    log.municipality = home
+
+    node.scheduleIncubation(day, parameters)
+
+
+def stepDay(municipalities, parameters, day):
+    '''One day of the given municipalities, as in nationalModel.fullRun.'''
+    rows, cont = {}, False
+    for municipality in municipalities:
+        cont_, linfs, dailyInfected = nationalModel.municipalityDay(municipality, parameters, day)
+
+        if parameters.testRules:
+            tests = nationalModel.testing(municipality, parameters, day)
+        nationalModel.dailyCommuterSpread(municipality, day, parameters)
+
+        rows[municipality.name] = modelFunctions.logStates(municipality.counts, municipality.attrs, parameters)
+        cont = cont or cont_
+
+    return rows, cont
+
+
+def ghostInfections(ghosts, parameters, start, day):
+    '''Finds the ghosts infected since start of the log, and removes their
+    infections from the log, as they are logged by the home worker.'''
+    log = parameters.transmissionLog
+    infected = {node.uid: key for key, node in ghosts if node.state != 'S' and node.uid >= 0}
+    descendants = log['descendant'][start:]
+    remote = np.isin(descendants, list(infected))
+
+    infections = []
+    layerNames = list(layers)
+    for i in np.flatnonzero(remote) + start:
+        anc = int(log['ancestor'][i])
+        infections.append((infected[int(log['descendant'][i])],
+                           (day, layerNames[log['layer'][i]],
+                            log.municipalities[log['municipality'][i]],
+                            None if anc < 0 else log.key(anc))))
+    log.filter(~remote, start)
+
+    return infections
+
+
+def worker(conn, municipalities, parameters, names, seed):
+    '''Steps a partition of the municipalities, one day for every message,
+    until told to finish.'''
+    np.random.seed(seed)
+    random.seed(seed)
+
+    local = [m for m in municipalities if m.name in names]
+    visitors = findVisitors(municipalities)
+    ghosts = {nodeKey(node): node for m in local for node in visitors[m.name]
+              if node.municipality_home not in names}
+    shared = {nodeKey(node): node for m in municipalities if m.name not in names
+              for node in visitors[m.name] if node.municipality_home in names}
+    sent = {key: snapshot(node) for key, node in shared.items()}
+    start = len(parameters.transmissionLog)
+
+    while True:
+        message = conn.recv()
+        if message[0] == 'finish':
+            break
+
+        _, day, updates, infections = message
+        for key, update in updates:
+            if key in ghosts:
+                updateGhost(ghosts[key], update)
+        for key, infection in infections:
+            infectRemote(shared[key], infection, parameters)
+
+        susceptible = [(key, node) for key, node in ghosts.items() if node.state == 'S']
+        logStart = len(parameters.transmissionLog)
+        rows, cont = stepDay(local, parameters, day)
+
+        infections = ghostInfections(susceptible, parameters, logStart, day)
+        updates = []
+        for key, node in shared.items():
+            state = snapshot(node)
+            if state != sent[key]:
+                updates.append((key, state))
+                sent[key] = state
+        conn.send((rows, cont, updates, infections))
+
+    recovered = {m.name: [(node.id_number, m.name if not hasattr(node, 'municipality_home')
+                           else node.municipality_home, node.infDay, node.lastDay)
+                          for node in m.attrs.values() if node.state == 'R' and node.uid >= 0]
+                 for m in local}
+    conn.send((parameters.transmissionLog, start, recovered))
+    conn.close()
+
+
+class ParallelModel:
+    '''Runs the municipalities in worker processes, forked from the current
+    state of the model. The municipalities of the calling process are not
+    changed by the run.'''
+
+    def __init__(self, municipalities, parameters, workers=None):
+        self.parameters = parameters
+        self.names = [m.name for m in municipalities]
+        self.partitions, self.report = partition(self.names, workers or mp.cpu_count(), parameters.region)
+        if parameters.printResults:
+            print(f'{len(self.partitions)} partitions, load imbalance {self.report["imbalance"]:.1%}, '
+                  f'{self.report["cut"]:.0f} commuters between partitions ({self.report["cutFraction"]:.1%}).')
+        self.owner = {name: i for i, names in enumerate(self.partitions) for name in names}
+        self.destination = {nodeKey(node): self.owner[name] 
+                            for name, nodes in findVisitors(municipalities).items() for node in nodes}
+
+        context = mp.get_context('fork')
+        seeds = np.random.randint(2**31, size=len(self.partitions)).tolist()
+        self.connections, self.processes = [], []
+        for names, seed in zip(self.partitions, seeds):
+            conn, child = context.Pipe()
+            process = context.Process(target=worker, args=(child, municipalities, parameters, names, seed), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(conn)
+            self.processes.append(process)
+
+        self.updates = [[] for _ in self.partitions]
+        self.infections = [[] for _ in self.partitions]
+
+    def __repr__(self):
+        return f'ParallelModel: {len(self.names)} municipalities in {len(self.partitions)} workers.'
+
+    def step(self, day):
+        '''Steps all municipalities one day. Returns the state log row of every
+        municipality, and whether the run should continue.'''
+        for conn, updates, infections in zip(self.connections, self.updates, self.infections):
+            conn.send(('day', day, updates, infections))
+
+        rows, cont = {}, False
+        self.updates = [[] for _ in self.partitions]
+        self.infections = [[] for _ in self.partitions]
+        for i, conn in enumerate(self.connections):
+            workerRows, workerCont, updates, infections = conn.recv()
+            rows.update(workerRows)
+            cont = cont or workerCont or bool(infections)
+            for key, update in updates:
+                self.updates[self.destination[key]].append((key, update))
+            for key, infection in infections:
+                self.infections[self.owner[key[1]]].append((key, infection))
+
+        return {name: rows[name] for name in self.names}, cont
+
+    def finish(self):
+        '''Stops the workers, and merges their transmission logs into the log
+        of the parameters. Returns the daily R of every municipality and the
+        whole region.'''
+        log = self.parameters.transmissionLog
+        recovered = {}
+        for conn in self.connections:
+            conn.send(('finish',))
+        for conn, process in zip(self.connections, self.processes):
+            workerLog, start, workerRecovered = conn.recv()
+            log.merge(workerLog, start)
+            recovered.update(workerRecovered)
+            process.join()
+
+        keys = {log.key(uid): uid for uid in range(len(log.ids))}
+        offspring = log.offspring()
+        runDays = self.parameters.runDays
+        dailyR, total = {}, []
+        for name in self.names:
+            nodes = recovered[name]
+            total.extend(nodes)
+            dailyR[name] = self.dailyR(nodes, keys, offspring, runDays)
+        dailyR[self.parameters.region] = self.dailyR(total, keys, offspring, runDays)
+
+        return dailyR
+
+    @staticmethod
+    def dailyR(nodes, keys, offspring, runDays):
+        uids = [keys[(i, home)] for i, home, infDay, lastDay in nodes]
+        infDay = np.array([node[2] for node in nodes], dtype=np.int64)
+        lastDay = np.array([node[3] for node in nodes], dtype=np.int64)
+        return modelFunctions.dailyR(offspring[uids], infDay, lastDay, runDays)
+
+
+def checkParameters(parameters):
+    '''Raises a ValueError for options the parallel runs do not support.'''
+    if parameters.checkpoint:
+        raise ValueError('Checkpoints are not supported with workers > 1, run with workers=1 or checkpoint=\'\'.')
+
+
+def fullRun(municipalities, parameters, workers=None):
+    '''Full run of the national model, with the municipalities stepped in
+    parallel. Same output as nationalModel.fullRun, but without checkpoints.'''
+    checkParameters(parameters)
+    stateLog = {m.name: [] for m in municipalities}
+    timeUsed = []
+    cont = 1
+    day = 0
+
+    model = ParallelModel(municipalities, parameters, workers)
+    while cont and (day < parameters.runDays):
+        day += 1
+        dayTime = time.time()
+        rows, cont = model.step(day)
+        for name, row in rows.items():
+            stateLog[name].append(row)
+
+        timeUsed.append(time.time() - dayTime)
+        if parameters.printResults:
+            modelUtilities.printProgress(day, parameters.runDays, timeUsed, bar_length=50)
+
+    dailyR = model.finish()
+
+    return stateLog, dailyR
+
+
+def timedRun(municipalities, parameters, day, runDays, workers=None):
+    '''Timed run of the national model after initRun(), with the
+    municipalities stepped in parallel. Same output as nationalModel.timedRun,
+    but without checkpoints.'''
+    checkParameters(parameters)
+    stateLog = {m.name: [] for m in municipalities}
+    timeUsed = []
+    cont = 1
+    endDay = runDays + day
+
+    model = ParallelModel(municipalities, parameters, workers)
+    while cont and (day < endDay):
+        day += 1
+        dayTime = time.time()
+        rows, cont = model.step(day)
+        for name, row in rows.items():
+            stateLog[name].append(row)
+
+        timeUsed.append(time.time() - dayTime)
+        if parameters.printResults:
+            modelUtilities.printProgress(day, endDay, timeUsed, bar_length=30)
+
+    model.finish()
+
+    return stateLog
@@ -13,6 +13,12 @@ stateList = ['S', 'E', 'Ia', 'Ip', 'Is', 'R', 'H', 'ICU', 'D']
 states = ['Susceptible', 'Exposed', 'Asymptomatic ', 'Presymptomatic',
           'Symptomatic', 'Recovered', 'Hospitalised', 'ICU', 'Dead']
 
+# integer codes used by the array engine
+stateCodes = {state: i for i, state in enumerate(stateList)}
+layerBits = {layer: 1 << i for i, layer in enumerate(layers)}
+allLayers = sum(layerBits.values())
+layerCodes = {layer: i for i, layer in enumerate(layers)}
+
 
 class Parameters:
     """The default parameters used in the model."""
@@ -25,6 +31,25 @@ class Parameters:
         self.prevalence = kwargs.get('prevalence', 0.005)
         self.seedMunicipality = kwargs.get('seedMunicipality', None)
         self.region = kwargs.get('region', 'Trondheim')
+        self.engine = kwargs.get('engine', 'objects')
+        self.randomLayer = kwargs.get('randomLayer', 'loop')
+        self.debugCounters = kwargs.get('debugCounters', False)
+        self.presample = kwargs.get('presample', False)
+        self.workers = kwargs.get('workers', 1)
+        self.loadWorkers = kwargs.get('loadWorkers', 0)
+        self.checkpoint = kwargs.get('checkpoint', '')
+        self.checkpointDays = kwargs.get('checkpointDays', 10)
+        self.focus = kwargs.get('focus', [])
+        self.promotionThreshold = kwargs.get('promotionThreshold', 0.001)
+        self.metapopulationR = kwargs.get('metapopulationR', 1.7)
+        self.screeningR = kwargs.get('screeningR', 1.9)
+        self.lazy = kwargs.get('lazy', False)
+        self.store = kwargs.get('store', False)
+        self.setupRandomState = None
+        self.loadFailures = {}
+        self.commuterFailures = {}
+        self.exposed = []
+        self.transmissionLog = None
         
         self.activity = kwargs.get(
             'activity', {'mode': 10, 'var': 3, 'exp': -0.75})
@@ -37,15 +62,31 @@ class Parameters:
         self.commuterFraction = kwargs.get('commuterFraction', 1.0)
         self.commuter_prevalence = kwargs.get(
             'commuter_prevalence', self.prevalence)
+        self.commuterImports = kwargs.get('commuterImports', False)
         self.removeWorkers = 0.0
 
         self.saveResults = kwargs.get('saveResults', False)
         self.printResults = kwargs.get('printResults', False)
         self.plotResults = kwargs.get('plotResults', False)
+
+        self.validate()
         
     def __repr__(self):
         return f'{self.cityName}: {self.runDays} days, {self.n} infected.'
 
+    def validate(self, engine=None):
+        '''Raises a ValueError for options the engine, parameters.engine by 
+        default, or the mode of the run does not support.'''
+        engine = engine or self.engine
+        if engine == 'arrays' and (self.testing or self.testRules):
+            raise ValueError("Testing is not supported by the array engine, use engine='objects'.")
+        if self.checkpoint:
+            unsupported = [mode for mode, used in [('the array engine', engine == 'arrays'),
+                                                   ('focus municipalities', self.focus), ('the lazy model', self.lazy),
+                                                   ('workers > 1', self.workers > 1)] if used]
+            if unsupported:
+                raise ValueError(f"Checkpoints are not supported with {unsupported[0]}, use checkpoint=''.")
+
 
 
 class SARS_CoV_2():
@@ -76,10 +117,8 @@ class SARS_CoV_2():
             'HH': 0.15, 'NH': 0.15, 'dynR': 0.015
         },
         
-        """
         # 'rec' : 0.1,
         # 'inc' : 1, # asymptomatic
-        """
         
         # chance of developing symptoms
         'S': {
@@ -95,9 +134,7 @@ class SARS_CoV_2():
         'ICU': 0.3,
         'NI': 0,
 
-        """
-        'infRatio' : {'B': 0.25, 'A1': 1, 'A2': 1, 'E1': 1, 'E2': 1},
-        """
+        # 'infRatio' : {'B': 0.25, 'A1': 1, 'A2': 1, 'E1': 1, 'E2': 1},
 
         # hospitalisation by age bracket
         'Hage': {
@@ -4,6 +4,14 @@ Date: May 2021
 File: run.py
 
 Script for running the simulations in HUNT from the command line.
+    python run.py <run> [engine]
+The engine is objects by default. With the engine arrays, which is opt-in,
+the runs share the network of the region from networkStore.py, so more of
+them fit on a node, but they are not checkpointed, and use the array engine
+and its daily R estimate instead of those of nationalModel.py. Write the
+store before starting them:
+    python networkStore.py trondelag
+    head -40 runs.txt | parallel python3 run.py {} arrays
 """
 
 import sys
@@ -12,9 +20,12 @@ import pickle
 import pandas as pd
 
 from nationalModel import *
+import nationalArrayModel
 
 def isSimulated(filename):
-    return os.path.isfile(filename)
+    '''True if the results of a run are saved, or it is running. A run that
+    was stopped and left its placeholder and checkpoint is resumed.'''
+    return os.path.isfile(filename) and not os.path.isfile(f'{filename}.checkpoint.npz')
 
 def createFilename(mut, com, strat, prev, run, region, seed, name=''):
     if name == 'seeds':
@@ -35,7 +46,7 @@ def getSimulationCount(runParams, runs):
     return n
 
 
-def fullSim(runParams, run, name, overwrite=False):
+def fullSim(runParams, run, name, overwrite=False, engine='objects'):
     for mutation in runParams['mutations']:
         for commuter in runParams['commuters']:
             for strat in runParams['strategies']:
@@ -53,7 +64,10 @@ def fullSim(runParams, run, name, overwrite=False):
                             prevalence=prevalence,
                             region=runParams['region'],
                             seedMunicipality=seed,
-                            infected=100 if name == 'seed' else 0
+                            infected=100 if name == 'seed' else 0,
+                            checkpoint=filename if engine != 'arrays' else '',
+                            engine=engine,
+                            store=engine == 'arrays'
                         )
                         
                         if not overwrite and isSimulated(filename):
@@ -61,17 +75,25 @@ def fullSim(runParams, run, name, overwrite=False):
                         try:
                             pickle.dump(0, open(filename, 'wb')) # create temp file
                             
-                            municipalities, parameters = nationalModelSetup(
-                                parameters, runParams['region'])
-                            
-                            states, r = fullRun(municipalities, parameters)
+                            if engine == 'arrays':
+                                population, cliques, parameters = nationalArrayModel.nationalModelSetup(
+                                    parameters, runParams['region'])
+                                states, r = nationalArrayModel.fullRun(population, cliques, parameters)
+                            else:
+                                municipalities, parameters = nationalModelSetup(
+                                    parameters, runParams['region'])
+                                states, r = fullRun(municipalities, parameters)
                             
                             pickle.dump(states, open(filename, 'wb'))
                             pickle.dump(r, open(filename.replace('States','R'), 'wb'))
+                            checkpoint.removeCheckpoint(parameters)
                             
-                        except KeyboardInterrupt: # delete temp file if simulation is interrupted
+                        except KeyboardInterrupt: # delete temp file if simulation is interrupted, the checkpoint is kept
                             os.remove(filename)
                             sys.exit(0)
+                        except Exception: # delete temp file if simulation fails, the checkpoint is kept
+                            os.remove(filename)
+                            raise
 
 
 def createResultFile(runParams, name, runs):
@@ -231,13 +253,13 @@ def getParams():
     return params
 
 
-def run(run, simulate=True, overwrite=False, saveSummary=False):
+def run(run, simulate=True, overwrite=False, saveSummary=False, engine='objects'):
     params = getParams()
     runs = range(1,101)
     
     for name, runParams in params.items():
         if simulate:
-            fullSim(runParams, run, name, overwrite)
+            fullSim(runParams, run, name, overwrite, engine)
         if saveSummary:
             try:
                 createResultFile(runParams, name, runs)
@@ -247,7 +269,9 @@ def run(run, simulate=True, overwrite=False, saveSummary=False):
                 [os.remove(f) for f in createSummaryFilename(name)]
 
 
-if len(sys.argv) > 1:
+if len(sys.argv) > 2:
+    run(sys.argv[1], engine=sys.argv[2])
+elif len(sys.argv) > 1:
     run(sys.argv[1])
 else:
     run(0, simulate=False, saveSummary=True)
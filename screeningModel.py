@@ -0,0 +1,220 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: screeningModel.py
+
+Fast screening version of the national model, to try out scenarios before
+running them with agents. All municipalities in data/municipalities_data.csv
+are run as a stochastic SEIR metapopulation, with compartments by decade,
+coupled through data/commuter_df.csv as in metapopulation.py. The decades
+of each municipality are drawn from its mean and standard deviation of age,
+or the mean of all municipalities where these are missing.
+
+The states are those of stateList, with Is, H and ICU split by their next
+state, so the branching and mean durations follow SARS_CoV_2. Every day,
+each compartment is left with probability 1/(duration+1), the mean time
+between transitions in Person. Nursing homes are not modelled.
+
+The transmission rate is set from parameters.screeningR, which can be
+fitted to state logs of the agent-based model with calibrate().
+
+"""
+
+import time
+import numpy as np
+
+from parameters import *
+import metapopulation
+import nationalModelFunctions
+
+
+compartments = ['S', 'E', 'Ia', 'Ip', 'IsR', 'IsH', 'HR', 'HICU', 'HD', 'ICUR', 'ICUD', 'R', 'D']
+logged = ['S', 'E', 'Ia', 'Ip', 'Is', 'Is', 'H', 'H', 'H', 'ICU', 'ICU', 'R', 'D']
+
+
+def decadeTable(key):
+    probability = SARS_CoV_2.probability[key]
+    return np.array([probability[10*a] for a in range(9)])
+
+
+def transitions():
+    '''Duration and branches of every compartment that is left, with the
+    probability of each branch by decade.'''
+    S, HR, ICU, DR = decadeTable('S'), decadeTable('HRage'), decadeTable('ICUage'), decadeTable('DRage')
+    return {
+        'E': ('I-E', [('Ip', S), ('Ia', 1 - S)]),
+        'Ia': ('AS-R', [('R', 1)]),
+        'Ip': ('PS-I', [('IsH', HR), ('IsR', 1 - HR)]),
+        'IsR': ('I-R', [('R', 1)]),
+        'IsH': ('I-H', [('HICU', ICU), ('HD', (1 - ICU)*DR), ('HR', (1 - ICU)*(1 - DR))]),
+        'HR': ('H-R', [('R', 1)]),
+        'HD': ('H-D', [('D', 1)]),
+        'HICU': ('H-ICU', [('ICUD', DR), ('ICUR', 1 - DR)]),
+        'ICUR': ('ICU-R', [('R', 1)]),
+        'ICUD': ('ICU-D', [('D', 1)]),
+    }
+
+
+def ageDecades(population, mean, std):
+    '''Persons in each decade, from a normal distribution of age cut to 0-99.'''
+    ages = np.arange(100)
+    density = np.exp(-0.5*((ages - mean)/std)**2)
+    shares = np.bincount(np.minimum(ages // 10, 8), density, minlength=9)
+    shares /= shares.sum()
+    counts = np.floor(population*shares).astype(np.int64)
+    counts[np.argmax(shares)] += int(population) - counts.sum()
+    return counts
+
+
+class ScreeningModel:
+    '''Compartments of all municipalities, or the given ones, as counts by
+    compartment, municipality and decade. Built once, and run any number of
+    times with different parameters.'''
+
+    def __init__(self, names=None):
+        import pandas as pd
+        data = pd.read_csv('data/municipalities_data.csv')
+        data['population_model'] = data.population_model.fillna(data.population)
+        data = data.fillna({'age_mean': data.age_mean.mean(), 'age_std': data.age_std.mean()})
+        data.index = data.municipality.map(nationalModelFunctions.normalizeName)
+        data = data[~data.index.duplicated()]
+        if names is None:
+            names = data.municipality.tolist()
+        keys = [nationalModelFunctions.normalizeName(name) for name in names]
+        self.missing = [name for name, key in zip(names, keys) if key not in data.index]
+        self.names = [name for name, key in zip(names, keys) if key in data.index]
+        data = data.loc[[key for key in keys if key in data.index]]
+
+        self.population = np.array([ageDecades(*row) for row in zip(
+            data.population_model, data.age_mean, data.age_std)]).reshape(-1, 9)
+        self.size = np.maximum(self.population.sum(axis=1), 1)
+        weights, self.flows, missing = nationalModelFunctions.commuterGraph(self.names)
+
+        self.index = {name: c for c, name in enumerate(compartments)}
+        self.logMatrix = np.zeros((len(stateList), len(compartments)), dtype=np.int64)
+        for c, state in enumerate(logged):
+            self.logMatrix[stateCodes[state], c] = 1
+        self.infectivity = np.zeros((len(compartments), 9))
+        for c, state in enumerate(logged):
+            self.infectivity[c] = metapopulation.relInfectivity[stateCodes[state]]
+
+        self.steps = []
+        for name, (key, branches) in transitions().items():
+            targets = [self.index[target] for target, p in branches]
+            left = 1.0
+            conditional = []
+            for target, p in branches[:-1]:
+                conditional.append(np.clip(p / np.maximum(left, 1e-12), 0, 1))
+                left = left - p
+            self.steps.append((self.index[name], 1/(SARS_CoV_2.duration[key] + 1), targets, conditional))
+
+    def __repr__(self):
+        return f'ScreeningModel: {len(self.names)} municipalities.'
+
+    def beta(self, R):
+        shares = self.population.sum(axis=0) / max(self.population.sum(), 1)
+        return R / (shares * metapopulation.susceptibility * metapopulation.infectiousDays()).sum()
+
+    def seed(self, counts, parameters):
+        '''Exposes n persons, or a share prevalence, of the seed municipalities,
+        spread over the decades as a multinomial draw.'''
+        seed = nationalModelFunctions.normalizeName(parameters.seedMunicipality or '')
+        seeded = np.array([not seed or nationalModelFunctions.normalizeName(name) == seed for name in self.names])
+        population = self.population[seeded]
+        n = np.full(len(population), parameters.n) if parameters.n else (
+            population.sum(axis=1)*parameters.prevalence).astype(np.int64)
+        n = np.minimum(n, population.sum(axis=1))
+
+        exposed = np.zeros_like(population)
+        left = population.sum(axis=1)
+        for a in range(9):
+            share = population[:, a] / np.maximum(left, 1)
+            exposed[:, a] = np.minimum(np.random.binomial(n, share), population[:, a])
+            left = left - population[:, a]
+            n = n - exposed[:, a]
+        counts[self.index['S'], seeded] -= exposed
+        counts[self.index['E'], seeded] += exposed
+
+    def run(self, parameters):
+        '''Runs parameters.runDays days. Returns the state counts of every day
+        and municipality, as an array of shape (runDays, municipalities,
+        states), in the order of stateList.'''
+        mixing = metapopulation.mixingMatrix(self.flows, self.size, parameters.commuterFraction)
+        beta = self.beta(parameters.screeningR)
+        susceptibility = metapopulation.susceptibility
+        S, E = self.index['S'], self.index['E']
+
+        counts = np.zeros((len(compartments), len(self.names), 9), dtype=np.int64)
+        counts[S] = self.population
+        self.seed(counts, parameters)
+        log = np.zeros((parameters.runDays, len(self.names), len(stateList)), dtype=np.int64)
+
+        for day in range(parameters.runDays):
+            prevalence = np.einsum('cma,ca->m', counts, self.infectivity) / self.size
+            force = beta * mixing @ prevalence
+            exposed = np.random.binomial(counts[S], 1 - np.exp(-force[:, None]*susceptibility))
+
+            moves = []
+            for c, rate, targets, conditional in self.steps:
+                leaving = np.random.binomial(counts[c], rate)
+                moves.append((c, -leaving))
+                for target, p in zip(targets, conditional):
+                    branch = np.random.binomial(leaving, p)
+                    moves.append((target, branch))
+                    leaving = leaving - branch
+                moves.append((targets[-1], leaving))
+
+            counts[S] -= exposed
+            counts[E] += exposed
+            for c, change in moves:
+                counts[c] += change
+            log[day] = np.einsum('sc,cma->ms', self.logMatrix, counts)
+
+        return log
+
+    def stateLog(self, log):
+        '''The counts of run() as a state log, as returned by the national model.'''
+        return {name: [dict(zip(stateList, row)) for row in log[:, m].tolist()]
+                for m, name in enumerate(self.names)}
+
+
+def infected(stateLog):
+    '''Total number ever infected on each day, over all municipalities of a
+    state log.'''
+    return np.sum([[sum(row.values()) - row['S'] for row in rows] for rows in stateLog.values()], axis=0)
+
+
+def calibrate(stateLogs, parameters, values=np.round(np.arange(1.0, 3.01, 0.05), 2), runs=10):
+    '''Finds the screeningR that best fits state logs of agent-based runs of
+    the same scenario. The fit is by the squared error of the log of the total
+    number ever infected, averaged over the runs. Returns the best value, 
+    and the error of every value.'''
+    model = ScreeningModel(list(stateLogs[0]))
+    target = np.log(np.mean([infected(stateLog) for stateLog in stateLogs], axis=0))
+    runDays, R = parameters.runDays, parameters.screeningR
+    parameters.runDays = len(target)
+
+    errors = []
+    for value in values:
+        parameters.screeningR = value
+        total = [model.run(parameters).sum(axis=1)[:, 1:].sum(axis=1) for i in range(runs)]
+        errors.append(np.mean((np.log(np.maximum(np.mean(total, axis=0), 1)) - target)**2))
+    parameters.runDays, parameters.screeningR = runDays, R
+    return values[int(np.argmin(errors))], errors
+
+
+def main():
+    parameters = Parameters(
+        prevalence=0.005,
+        seedMunicipality = 'Trondheim',
+        runDays=60,
+    )
+    model = ScreeningModel()
+    start = time.time()
+    log = model.run(parameters)
+    print(f'{len(model.names)} municipalities, {parameters.runDays} days in {time.time() - start:.3f} s')
+    print(dict(zip(stateList, log[-1].sum(axis=0).tolist())))
+
+
+if __name__ == '__main__':
+    main()
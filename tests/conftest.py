@@ -0,0 +1,21 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: conftest.py
+
+Shared setup of the tests. The modules of the model are in the folder above,
+and read their data with paths relative to it.
+"""
+
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+
+@pytest.fixture(autouse=True)
+def inRoot(monkeypatch):
+    monkeypatch.chdir(root)
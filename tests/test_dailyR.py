@@ -0,0 +1,83 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: test_dailyR.py
+
+modelFunctions.getDailyR and dailyR against the loop they replaced, kept
+here as referenceDailyR, on synthetic nodes and on a short run of Frøya.
+"""
+
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+from parameters import *
+import classes
+import modelFunctions
+import nationalModel
+import nationalModelFunctions
+
+
+def referenceDailyR(infsCaused, startDay, recDay, runDays):
+    '''The loop of getDailyR before it was vectorized.'''
+    infsByRecDay = [[] for i in range(runDays)]
+    for i in range(len(recDay)):
+        for j in range(startDay[i], recDay[i]):
+            infsByRecDay[j].append(infsCaused[i])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return [np.nanmean(infsByRecDay[i]) for i in range(runDays)]
+
+
+def referenceGetDailyR(attrs, runDays, log):
+    offspring = log.offspring()
+    infsCaused, recDay, startDay = [], [], []
+    for node in attrs.values():
+        if node.state == 'R' and node.uid >= 0:
+            infsCaused.append(offspring[node.uid])
+            recDay.append(node.lastDay)
+            startDay.append(node.infDay)
+    return referenceDailyR(infsCaused, startDay, recDay, runDays)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_dailyRMatchesLoop(seed):
+    rng = np.random.default_rng(seed)
+    runDays = int(rng.integers(5, 60))
+    n = int(rng.integers(0, 200))
+    startDay = rng.integers(0, runDays, n)
+    recDay = np.minimum(startDay + rng.integers(0, 15, n), runDays)
+    infsCaused = rng.poisson(1.5, n)
+    # leaves the last days without infectious nodes, so they are nan
+    if n and seed % 2:
+        startDay, recDay = startDay // 2, recDay // 2
+
+    expected = referenceDailyR(infsCaused.tolist(), startDay.tolist(), recDay.tolist(), runDays)
+    result = modelFunctions.dailyR(infsCaused, startDay, recDay, runDays)
+    assert len(result) == runDays
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+
+
+def test_getDailyRMatchesLoopOnRun():
+    random.seed(3)
+    np.random.seed(3)
+    runDays = 30
+    parameters = Parameters(runDays=runDays, prevalence=0.01, region='Frøya')
+    layers, attrs = nationalModelFunctions.readMunicipality('Frøya')
+    nationalModelFunctions.linkCommuters({'Frøya': layers}, {'Frøya': attrs}, parameters)
+    parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
+    parameters.p = modelFunctions.setInfectionProbabilities(
+        parameters.inputVector, SARS_CoV_2.probability, parameters)
+    parameters.transmissionLog = classes.TransmissionLog()
+    municipality = nationalModel.municipalitySetup(layers, attrs, parameters, 'Frøya')
+    for day in range(1, runDays+1):
+        nationalModel.municipalityDay(municipality, parameters, day)
+
+    log = parameters.transmissionLog
+    assert sum(node.state == 'R' for node in attrs.values()) > 10
+    expected = referenceGetDailyR(attrs, runDays, log)
+    result = modelFunctions.getDailyR(attrs, runDays, log)
+    np.testing.assert_allclose(result, expected, rtol=1e-12, equal_nan=True)
+    assert np.isfinite(expected).any()
@@ -0,0 +1,127 @@
+"""
+Author: Helge Bergo
+Date: June 2021
+File: test_randomLayer.py
+
+The vectorized random layer spread of model.py against the loop it replaces.
+Both are run many times from the same state, with infectNode recording the
+infections instead of changing the nodes, and the distributions of the
+number of infections are compared, and the arrays the nodes keep up to date
+on the layer are checked against the nodes after a run.
+"""
+
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from parameters import *
+import classes
+import model
+import modelFunctions
+import nationalModel
+import nationalModelFunctions
+
+
+trials = 3000
+
+
+def randomLayer():
+    '''A random layer of 300 nodes, 30 of them commuters, with 25 sick and
+    20 not present in the layer.'''
+    rng = np.random.default_rng(0)
+    nodes = []
+    for i in range(300):
+        node = classes.Person(str(i), int(rng.integers(0, 90)), index=i)
+        if i % 10 == 0:
+            node = classes.Commuter(node, 'Home', 'Here')
+        node.activity = int(rng.integers(1, 20))
+        nodes.append(node)
+    for i in rng.choice(len(nodes), 25, replace=False).tolist():
+        nodes[i].state = 'Ip'
+        nodes[i].sick = True
+        nodes[i].relInfectivity = float(rng.uniform(0.3, 1))
+    for i in rng.choice(len(nodes), 20, replace=False).tolist():
+        nodes[i].present &= ~layerBits['R']
+    layer = classes.Layer('R')
+    layer.cliques.append(nodes)
+    return layer
+
+
+def spread(kernel, layer, seed, monkeypatch):
+    '''Number of infections, infected commuters and infected nodes that were
+    not susceptible and present, in every trial, and all ancestors.'''
+    infections = []
+    monkeypatch.setattr(classes.Person, 'infectNode',
+                        lambda node, anc, layerName, day, parameters: infections.append((node, anc)))
+    parameters = SimpleNamespace(p={'inf': {'dynR': 0.02}}, randomLayer=kernel)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    counts, commuters, invalid, ancestors = [], 0, 0, set()
+    for trial in range(trials):
+        infections.clear()
+        model.randomLayerDay(layer, parameters, 1)
+        counts.append(len(infections))
+        for node, anc in infections:
+            commuters += isinstance(node, classes.Commuter)
+            invalid += node.state != 'S' or not node.isPresent('R')
+            ancestors.add(anc)
+    return np.array(counts), commuters, invalid, ancestors
+
+
+def ks(a, b):
+    '''Two-sample Kolmogorov-Smirnov statistic.'''
+    values = np.union1d(a, b)
+    cdfA = np.searchsorted(np.sort(a), values, side='right') / len(a)
+    cdfB = np.searchsorted(np.sort(b), values, side='right') / len(b)
+    return np.abs(cdfA - cdfB).max()
+
+
+@pytest.fixture(scope='module')
+def layer():
+    return randomLayer()
+
+
+def test_vectorizedMatchesLoop(layer, monkeypatch):
+    loop, loopCommuters, loopInvalid, loopAncestors = spread('loop', layer, 1, monkeypatch)
+    vectorized, vectorCommuters, vectorInvalid, vectorAncestors = spread('vectorized', layer, 2, monkeypatch)
+
+    assert loop.mean() > 2
+    assert loopInvalid == vectorInvalid == 0
+    sick = {node for node in layer.cliques[0] if node.sick and node.isPresent('R')}
+    assert loopAncestors <= sick and vectorAncestors <= sick
+
+    error = np.sqrt(loop.var()/trials + vectorized.var()/trials)
+    assert abs(loop.mean() - vectorized.mean()) < 4*error
+    assert 0.85 < vectorized.var() / loop.var() < 1.15
+    # critical value of the two-sample test at a significance of 0.001
+    assert ks(loop, vectorized) < 1.95*np.sqrt(2/trials)
+
+    shareLoop, shareVector = loopCommuters / loop.sum(), vectorCommuters / vectorized.sum()
+    share = (loopCommuters + vectorCommuters) / (loop.sum() + vectorized.sum())
+    assert abs(shareLoop - shareVector) < 4*np.sqrt(share*(1 - share)*(1/loop.sum() + 1/vectorized.sum()))
+
+
+def test_layerArraysFollowNodes():
+    random.seed(4)
+    np.random.seed(4)
+    parameters = Parameters(runDays=30, prevalence=0.01, region='Frøya', randomLayer='vectorized')
+    layers, attrs = nationalModelFunctions.readMunicipality('Frøya')
+    nationalModelFunctions.linkCommuters({'Frøya': layers}, {'Frøya': attrs}, parameters)
+    parameters.inputVector = modelFunctions.convertVector(parameters.strategy)
+    parameters.p = modelFunctions.setInfectionProbabilities(
+        parameters.inputVector, SARS_CoV_2.probability, parameters)
+    parameters.transmissionLog = classes.TransmissionLog()
+    municipality = nationalModel.municipalitySetup(layers, attrs, parameters, 'Frøya')
+    for day in range(1, parameters.runDays+1):
+        nationalModel.municipalityDay(municipality, parameters, day)
+
+    layer, nodes = layers['R'], layers['R'].cliques[0]
+    assert sum(node.state != 'S' for node in nodes) > 10
+    for node in nodes[::7]:
+        node.quarantineNode()
+    np.testing.assert_array_equal(layer.sick, [node.sick and node.isPresent('R') for node in nodes])
+    np.testing.assert_array_equal(layer.susceptible, [node.state == 'S' and node.isPresent('R') for node in nodes])
+    np.testing.assert_array_equal(layer.relInfectivity, [node.relInfectivity for node in nodes])